@@ -1,5 +1,6 @@
 """Django/PostgreSQL implementation of the Meteor server."""
 from __future__ import unicode_literals
+import inspect
 import sys
 from gevent.local import local
 from dddp import alea
@@ -13,6 +14,12 @@ ADDED = 'added'
 CHANGED = 'changed'
 REMOVED = 'removed'
 
+# transaction policies for dispatching DDP messages.
+TX_NONE = 'none'  # autocommit, DB connection only used if handler needs it.
+TX_ATOMIC = 'atomic'  # handler runs in a single (read/write) transaction.
+TX_SNAPSHOT = 'snapshot'  # handler runs in a read-only REPEATABLE READ.
+TX_POLICIES = (TX_NONE, TX_ATOMIC, TX_SNAPSHOT)
+
 _GREEN = {}
 
 
@@ -81,6 +88,139 @@ class MeteorError(Exception):
         return result
 
 
+class ArgSpec(object):
+
+    """
+    Argument specification of `func`, compiled once for fast call validation.
+
+    >>> def func(id_, name, extra=None):
+    ...     pass
+    >>> func.err = 'Bad arguments'
+    >>> spec = ArgSpec(func)
+    >>> kwargs = {'id': 'a', 'name': 'b'}
+    >>> spec.validate_kwargs(kwargs)
+    >>> sorted(kwargs)
+    ['id_', 'name']
+    >>> try:
+    ...     spec.validate_kwargs({'name': 'b', 'other': 1})
+    ... except MeteorError as err:
+    ...     print(err.args[2])
+    Missing required arguments to func: id
+    >>> spec.validate_args([1, 2, 3])
+    >>> try:
+    ...     spec.validate_args([1, 2, 3, 4, 5])
+    ... except MeteorError as err:
+    ...     print(err.args[0])
+    400
+    """
+
+    def __init__(self, func, skip_self=None):
+        """
+        Compile argument specification for `func`.
+
+        Args:
+            func (callable): Function or method to be called.
+            skip_self (Optional[bool]): Whether the first argument is supplied
+                implicitly (defaults to `True` for bound methods).
+        """
+        if skip_self is None:
+            skip_self = getattr(func, '__self__', None) is not None
+        self.func = func
+        self.name = func.__name__
+        try:
+            argspec = inspect.getfullargspec(func)
+            # keyword-only args without defaults can't be checked by count.
+            self.exact = not (
+                set(argspec.kwonlyargs) - set(argspec.kwonlydefaults or ())
+            )
+        except AttributeError:
+            argspec = inspect.getargspec(func)  # pylint: disable=W1505
+            self.exact = True
+        all_args = argspec.args[:]
+        defaults = list(argspec.defaults or [])
+
+        # positional args, excluding the implicit first argument.
+        positional = all_args[:]
+        if skip_self:
+            positional[:1] = []
+        self.max_args = len(positional)
+        self.min_args = max(len(positional) - len(defaults), 0)
+        self.varargs = argspec.varargs is not None
+
+        # ignore implicit 'self' argument
+        if skip_self and all_args[:1] == ['self']:
+            all_args[:1] = []
+        self.all_args = frozenset(all_args)
+
+        # don't require arguments that have defaults
+        if defaults:
+            self.required = all_args[:-len(defaults)]
+        else:
+            self.required = all_args[:]
+
+        # translate 'foo_' to avoid reserved names like 'id'
+        self.trans = {
+            arg: arg.endswith('_') and arg[:-1] or arg
+            for arg
+            in all_args
+        }
+        self.adjusted = {
+            arg[:-1]: arg
+            for arg
+            in all_args
+            if arg.endswith('_')
+        }
+
+    def validate_kwargs(self, kwargs):
+        """Validate (and translate in place) kwargs to be supplied to func."""
+        for key in list(kwargs):
+            key_adj = self.adjusted.get(key, None)
+            if key_adj is not None:
+                kwargs[key_adj] = kwargs.pop(key)
+
+        # figure out what we're missing
+        missing = [
+            self.trans.get(arg, arg) for arg in self.required
+            if arg not in kwargs
+        ]
+        if missing:
+            raise MeteorError(
+                400,
+                self.func.err,
+                'Missing required arguments to %s: %s' % (
+                    self.name,
+                    ' '.join(missing),
+                ),
+            )
+
+        # figure out what is extra
+        extra = [
+            arg for arg in sorted(kwargs)
+            if arg not in self.all_args
+        ]
+        if extra:
+            raise MeteorError(
+                400,
+                self.func.err,
+                'Unknown arguments to %s: %s' % (self.name, ' '.join(extra)),
+            )
+
+    def validate_args(self, args):
+        """Validate positional args to be supplied to func."""
+        num_args = len(args)
+        if self.exact and (
+            self.min_args <= num_args
+        ) and (
+            self.varargs or num_args <= self.max_args
+        ):
+            return
+        # slow path only to get the exact same message Python would give.
+        try:
+            inspect.getcallargs(self.func, *args)  # pylint: disable=W1505
+        except TypeError as err:
+            raise MeteorError(400, '%s' % err)
+
+
 class AlreadyRegistered(Exception):
 
     """Raised when registering over the top of an existing registration."""
@@ -163,6 +303,8 @@ THREAD_LOCAL_FACTORIES = {
     'user_id': lambda: None,
     'user_ddp_id': lambda: None,
     'user': lambda: None,
+    # replaced with a real callback while running a DDP method.
+    'unblock': lambda: lambda: None,
 }
 THREAD_LOCAL = this = ThreadLocal()  # pylint: disable=invalid-name
 METEOR_ID_CHARS = u'23456789ABCDEFGHJKLMNPQRSTWXYZabcdefghijkmnopqrstuvwxyz'
@@ -177,6 +319,20 @@ def meteor_random_id(name=None, length=17):
     return stream.random_string(length, METEOR_ID_CHARS)
 
 
+def meteor_random_ids(name=None, count=1, length=17):
+    """
+    Generate `count` new IDs, optionally using namespace of given `name`.
+
+    Same IDs as `count` calls to `meteor_random_id`, but much faster for many
+    IDs (eg: for `bulk_create`).
+    """
+    if name is None:
+        stream = THREAD_LOCAL.alea_random
+    else:
+        stream = THREAD_LOCAL.random_streams[name]
+    return stream.random_strings(count, length, METEOR_ID_CHARS)
+
+
 def autodiscover():
     """Import all `ddp` submodules from `settings.INSTALLED_APPS`."""
     from django.utils.module_loading import autodiscover_modules
@@ -68,7 +68,6 @@ class Subscription(admin.ModelAdmin):
         'sub_id',
         'publication',
         'publication_class',
-        'params_ejson',
     ]
     list_display = [
         'sub_id',
@@ -81,6 +80,12 @@ class Subscription(admin.ModelAdmin):
         'user__email',
         'publication',
     ]
+    exclude = [
+        'params',
+    ]
+    readonly_fields = [
+        'params_ejson',
+    ]
     inlines = [
         SubscriptionCollectionInline,
     ]
@@ -107,3 +112,4 @@ admin.site.register(models.ObjectMapping, ObjectMapping)
 admin.site.register(models.Subscription, Subscription)
 admin.site.register(models.SubscriptionCollection, SubscriptionCollection)
 admin.site.register(models.Connection)
+admin.site.register(models.Heartbeat)
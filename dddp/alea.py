@@ -48,17 +48,124 @@ True
     'tHBM5k8z4TZOmU0zgsv9H4ZIl4CJSXic_T3iF2KFJnm'
 True
 
+
+>>> random = Alea("my", 3, "seeds")
+>>> random.random_strings(2, 17, UNMISTAKABLE) == \
+    ['JYRduBwQtjpeCkqP7', 'HLxYtpZBtSain84zj']
+True
+
+>>> random.randoms(2) == [0.865990184713155, 0.13759524305351079]
+True
+
 """
 from __future__ import unicode_literals
 
-from math import floor
+import binascii
 import os
-import random
-import time
+import struct
 
 UNMISTAKABLE = '23456789ABCDEFGHJKLMNPQRSTWXYZabcdefghijkmnopqrstuvwxyz'
 BASE64 = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_'
 
+# max number of seeded initial states remembered.
+SEED_CACHE_SIZE = 1024
+
+# Alea is a lag-3 multiply-with-carry generator, x[n] = (A x[n-3] + c) mod B,
+# which is equivalent to a linear congruential generator with modulus M where
+# each step multiplies the state by the inverse of B (mod M).  Runs of values
+# are then the base B digits of state / M, which Python's big integers can
+# produce in bulk rather than one step at a time.
+A = 2091639
+B = 0x100000000  # 2^32
+M = A * B ** 3 - 1
+B_INVERSE = A * B ** 2  # B * B_INVERSE = A * B^3 = 1 (mod M)
+# max values produced by one big integer division.
+BATCH_SIZE = 4096
+# fewer values than this are quicker to produce one step at a time.
+BATCH_MIN = 64
+# 2^(32 * BATCH_SIZE + 128) / M, so dividing by M becomes a multiplication.
+BATCH_RECIPROCAL = (1 << (32 * BATCH_SIZE + 128)) // M
+MASK_128 = (1 << 128) - 1
+
+try:
+    int.from_bytes
+except AttributeError:  # Python 2
+    def int_to_bytes(value, length):
+        """Return value as `length` little endian bytes."""
+        return binascii.unhexlify('%0*x' % (length * 2, value))[::-1]
+
+    def int_from_bytes(data):
+        """Return integer from little endian bytes."""
+        return int(binascii.hexlify(bytes(data[::-1])), 16)
+else:
+    def int_to_bytes(value, length):
+        """Return value as `length` little endian bytes."""
+        return value.to_bytes(length, 'little')
+
+    def int_from_bytes(data):
+        """Return integer from little endian bytes."""
+        return int.from_bytes(data, 'little')
+
+
+def expand(state, count):
+    """
+    Return the first `count` base 2^32 digits of state / M as an integer.
+
+    >>> all(
+    ...     expand(state, BATCH_SIZE) == (state << 32 * BATCH_SIZE) // M
+    ...     for state in (1, M // 3, M - 1)
+    ... )
+    True
+    """
+    if count != BATCH_SIZE:
+        return (state << 32 * count) // M
+    digits = (state * BATCH_RECIPROCAL) >> 128  # may be 1 too small
+    # (state << 32 * count) - digits * M is below 2^128, so the low bits of
+    # digits * M give the remainder.
+    if (-(digits & MASK_128) * M) & MASK_128 >= M:
+        digits += 1
+    return digits
+
+
+def scaled(words, size):
+    """
+    Return bytes of `word * size / 2^32` for little endian 32 bit words.
+
+    All words are scaled at once by spreading them out into 64 bit lanes of
+    one big integer, so size must be no more than 256.
+
+    >>> list(bytearray(scaled(struct.pack('<3L', 0, 2 ** 31, B - 1), 55)))
+    [0, 27, 54]
+    """
+    count = len(words) // 4
+    lanes = bytearray(8 * count)
+    for offset in range(4):
+        lanes[offset::8] = words[offset::4]
+    return int_to_bytes(int_from_bytes(lanes) * size, 8 * count)[4::8]
+
+
+# {alphabet: bytes.translate() table mapping index to character}
+_TABLES = {}
+
+
+def translation(alphabet):
+    """Return table to translate `scaled` bytes to alphabet (or None)."""
+    try:
+        return _TABLES[alphabet]
+    except KeyError:
+        pass
+    except TypeError:
+        return None  # unhashable, eg: a list.
+    try:
+        encoded = bytearray(alphabet.encode('ascii'))
+    except (AttributeError, UnicodeError):
+        return None  # not a plain ASCII string.
+    table = None
+    if len(encoded) <= 256:
+        table = bytes(encoded + bytearray(256 - len(encoded)))
+    _TABLES[alphabet] = table
+    return table
+
 
 class Mash(object):
 
@@ -80,18 +187,28 @@ class Mash(object):
 
     def __call__(self, data):
         """Return mash, updating internal state."""
-        data = str(data)
-        for byte in data:
-            self.n += ord(byte)
-            h = 0.02519603282416938 * self.n
-            self.n = floor(h)
-            h -= self.n
-            h *= self.n
-            self.n = floor(h)
-            h -= self.n
-            self.n += h * 0x100000000
-        res = self.n * 2.3283064365386963e-10  # 2^-32
-        return res
+        n = self.n
+        for code in map(ord, str(data)):
+            n += code
+            h = 0.02519603282416938 * n
+            n = int(h)  # same as floor(h) as h is never negative.
+            h -= n
+            h *= n
+            n = int(h)
+            h -= n
+            n += h * 0x100000000
+        self.n = n
+        return n * 2.3283064365386963e-10  # 2^-32
+
+
+# every seeding starts by mashing three spaces, do that just once.
+_MASH = Mash()
+INITIAL_STATE = (_MASH(' '), _MASH(' '), _MASH(' '))
+INITIAL_MASH_N = _MASH.n
+del _MASH
+
+# {tuple of seed values: (c, s0, s1, s2)}
+_SEEDED = {}
 
 
 class Alea(object):
@@ -111,18 +228,29 @@ class Alea(object):
         """Seed internal state from supplied values."""
         if not values:
             # Meteor uses epoch seconds as the seed if no args supplied, we use
-            # a much more secure seed by default to avoid hash collisions.
-            seed_ids = [int, str, random, self, values, self.__class__]
-            random.shuffle(seed_ids)
-            values = list(map(id, seed_ids)) + [time.time(), os.urandom(512)]
+            # a much more secure seed by default to avoid hash collisions,
+            # taking the state straight from the OS rather than via Mash.
+            self.c = 1
+            self.s0, self.s1, self.s2 = [
+                val * 2.3283064365386963e-10  # 2^-32
+                for val in struct.unpack('<3L', os.urandom(12))
+            ]
+            return
+
+        # seeding with the same values always gives the same state.
+        key = tuple(str(val) for val in values)
+        try:
+            self.c, self.s0, self.s1, self.s2 = _SEEDED[key]
+            return
+        except KeyError:
+            pass
 
         mash = Mash()
+        mash.n = INITIAL_MASH_N
         self.c = 1
-        self.s0 = mash(' ')
-        self.s1 = mash(' ')
-        self.s2 = mash(' ')
+        self.s0, self.s1, self.s2 = INITIAL_STATE
 
-        for val in values:
+        for val in key:
             self.s0 -= mash(val)
             if self.s0 < 0:
                 self.s0 += 1
@@ -133,6 +261,10 @@ class Alea(object):
             if self.s2 < 0:
                 self.s2 += 1
 
+        if len(_SEEDED) >= SEED_CACHE_SIZE:
+            _SEEDED.clear()
+        _SEEDED[key] = (self.c, self.s0, self.s1, self.s2)
+
     @property
     def state(self):
         """Return internal state, useful for testing."""
@@ -141,21 +273,120 @@ class Alea(object):
     def __call__(self):
         """Get the next psuedo random number, updating state."""
         t = 2091639 * self.s0 + self.c * 2.3283064365386963e-10  # 2^-32
-        self.c = floor(t)
+        self.c = int(t)
         self.s0 = self.s1
         self.s1 = self.s2
         self.s2 = t - self.c
         return self.s2
 
+    def exact(self):
+        """
+        Return True if state is whole multiples of 2^-32.
+
+        Seeding leaves fractions finer than that, which are rounded away by
+        the first few steps.  From then on, all floating point arithmetic in
+        `__call__` is exact so integer arithmetic gives the same results.
+        """
+        return (
+            (self.s0 * B).is_integer()
+        ) and (
+            (self.s1 * B).is_integer()
+        ) and (
+            (self.s2 * B).is_integer()
+        )
+
+    def values(self, count):
+        """Step `count` times, return list of values (x 2^32)."""
+        c = self.c
+        x0, x1, x2 = int(self.s0 * B), int(self.s1 * B), int(self.s2 * B)
+        result = []
+        for _ in range(count):
+            t = A * x0 + c
+            c = t >> 32
+            x0, x1, x2 = x1, x2, t & 0xffffffff
+            result.append(x2)
+        self.c = c
+        self.s0 = x0 * 2.3283064365386963e-10  # 2^-32
+        self.s1 = x1 * 2.3283064365386963e-10
+        self.s2 = x2 * 2.3283064365386963e-10
+        return result
+
+    def words(self, count):
+        """Step `count` times, return values (x 2^32) as 32 bit words."""
+        old = struct.pack(
+            '<3L', int(self.s0 * B), int(self.s1 * B), int(self.s2 * B),
+        )
+        x0, x1, x2 = struct.unpack('<3L', old)
+        state = self.c + A * ((x2 * B + x1) * B + x0)
+        state = state * pow(B_INVERSE, count, M) % M
+        # digits of state / M step backwards to where we are, so the most
+        # recent value is the most significant.
+        words = int_to_bytes(expand(state, count), 4 * count)
+        x0, x1, x2 = struct.unpack('<3L', (old + words)[-12:])
+        self.c = state - A * ((x2 * B + x1) * B + x0)
+        self.s0 = x0 * 2.3283064365386963e-10  # 2^-32
+        self.s1 = x1 * 2.3283064365386963e-10
+        self.s2 = x2 * 2.3283064365386963e-10
+        return words
+
+    def randoms(self, count):
+        """Return list of the next `count` psuedo random numbers."""
+        result = []
+        while count and not self.exact():
+            result.append(self())
+            count -= 1
+        while count:
+            batch = min(count, BATCH_SIZE)
+            if batch < BATCH_MIN:
+                values = self.values(batch)
+            else:
+                values = struct.unpack('<%dL' % batch, self.words(batch))
+            result.extend(
+                val * 2.3283064365386963e-10  # 2^-32
+                for val in values
+            )
+            count -= batch
+        return result
+
     def choice(self, seq):
         """Choose an element from the sequence `seq`."""
         return seq[int(self() * len(seq))]
 
     def random_string(self, length, alphabet):
         """Return string of `length` elements chosen from `alphabet`."""
-        return ''.join(
-            self.choice(alphabet) for n in range(length)
-        )
+        size = len(alphabet)
+        table = translation(alphabet)
+        chars = []
+        while length and not self.exact():
+            chars.append(alphabet[int(self() * size)])
+            length -= 1
+        while length:
+            batch = min(length, BATCH_SIZE)
+            if batch < BATCH_MIN:
+                chars.extend(
+                    alphabet[val * size >> 32] for val in self.values(batch)
+                )
+            elif table is None:
+                chars.extend(
+                    alphabet[val * size >> 32]
+                    for val in struct.unpack('<%dL' % batch, self.words(batch))
+                )
+            else:
+                chars.append(
+                    scaled(self.words(batch), size).translate(table).decode(
+                        'ascii',
+                    ),
+                )
+            length -= batch
+        return ''.join(chars)
+
+    def random_strings(self, count, length, alphabet):
+        """Return list of `count` strings from successive `random_string`."""
+        chars = self.random_string(count * length, alphabet)
+        return [
+            chars[start:start + length]
+            for start in range(0, count * length, length)
+        ]
 
     def hex_string(self, digits):
         """Return a hex string of `digits` length."""
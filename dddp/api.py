@@ -4,7 +4,7 @@ from __future__ import absolute_import, unicode_literals, print_function
 # standard library
 import collections
 from copy import deepcopy
-import inspect
+import functools
 import uuid
 
 # requirements
@@ -22,13 +22,20 @@ from django.utils.module_loading import import_string
 from django.db import DatabaseError
 from django.db.models import signals
 import ejson
+import gevent.pool
 import six
 
 # django-ddp
-from dddp import AlreadyRegistered, this, ADDED, CHANGED, REMOVED, MeteorError
+from dddp import (
+    AlreadyRegistered, ArgSpec, this, ADDED, CHANGED, REMOVED, MeteorError,
+    TX_POLICIES, prepared,
+)
 from dddp.models import (
     AleaIdField, Connection, Subscription, get_meteor_id, get_meteor_ids,
+    create_meteor_ids, EAGER_OBJECT_MAPPINGS, ID_RESOLVER,
 )
+from dddp.changelog import CHANGE_LOG, log_change
+from dddp.replica import read_replica
 
 
 API_ENDPOINT_DECORATORS = [
@@ -39,6 +46,9 @@ API_ENDPOINT_DECORATORS = [
 
 XMIN = {'select': {'xmin': "'xmin'"}}
 
+# max number of collection queries to run concurrently for a subscription.
+SUB_QUERY_CONCURRENCY = int(getattr(settings, 'DDP_SUB_QUERY_CONCURRENCY', 1))
+
 # Only do this if < django1.9?
 
 if django.VERSION < (1, 9):
@@ -51,13 +61,15 @@ else:
     from django.contrib.postgres.aggregates import ArrayAgg
 
 
-def api_endpoint(path_or_func=None, decorate=True):
+def api_endpoint(path_or_func=None, decorate=True, tx_policy=None):
     """
     Decorator to mark a method as an API endpoint for later registration.
 
     Args:
         path_or_func: either the function to be decorated or its API path.
         decorate (bool): Apply API_ENDPOINT_DECORATORS if True (default).
+        tx_policy (Optional[str]): Transaction policy for method calls, one
+            of `dddp.TX_POLICIES` (default from DDP_TRANSACTION_POLICIES).
 
     Returns:
         Callable: Decorated function (with optionally applied decorators).
@@ -81,10 +93,19 @@ def api_endpoint(path_or_func=None, decorate=True):
         ...         '''Decrement counter value by `amount`.'''
         ...         self.value -= amount
         ...         return self.value
+        ...
+        ...     # doesn't need the database, skip the transaction.
+        ...     @api_endpoint(tx_policy='none')
+        ...     def get_value(self):
+        ...         return self.value
 
     """
+    if tx_policy not in (None,) + TX_POLICIES:
+        raise ValueError('Invalid tx_policy: %r' % tx_policy)
+
     def maybe_decorated(func):
         """Apply API_ENDPOINT_DECORATORS to func."""
+        func.tx_policy = tx_policy
         if decorate:
             for decorator in API_ENDPOINT_DECORATORS:
                 func = decorator()(func)
@@ -145,6 +166,7 @@ class APIMixin(object):
     api_providers = []
     api_path_prefix = '/'
     _api_path_cache = None
+    _api_argspec_cache = None
 
     def api_path_map(self):
         """Cached dict of api_path: func."""
@@ -154,11 +176,22 @@ class APIMixin(object):
                 for api_path, func
                 in api_endpoints(self)
             }
+            self._api_argspec_cache = {
+                api_path: ArgSpec(func)
+                for api_path, func
+                in self._api_path_cache.items()
+            }
         return self._api_path_cache
 
+    def api_argspec_map(self):
+        """Cached dict of api_path: ArgSpec, compiled with api_path_map."""
+        self.api_path_map()
+        return self._api_argspec_cache
+
     def clear_api_path_map_cache(self):
         """Clear out cache for api_path_map."""
         self._api_path_cache = None
+        self._api_argspec_cache = None
         for api_provider in self.api_providers:
             if six.get_method_self(
                 api_provider.clear_api_path_map_cache,
@@ -211,6 +244,8 @@ class Collection(APIMixin):
     order_by = None
     user_rel = None
     always_allow_superusers = True
+    # seconds to hold back repeated `changed` msgs per object (None disables)
+    coalesce_window = None
 
     def get_queryset(self, base_qs=None):
         """Return a filtered, ordered queryset for this collection."""
@@ -490,7 +525,16 @@ class PublicationMeta(APIMeta):
 @six.add_metaclass(PublicationMeta)
 class Publication(APIMixin):
 
-    """DDP Publication (a set of queries)."""
+    """
+    DDP Publication (a set of queries).
+
+    Publications taking params may implement `get_params_filter(model, obj)`
+    to narrow down which subscriptions need to be considered when `obj`
+    changes.  It should return a value which the subscription params must
+    contain (JSONB `@>` semantics, so `[obj.list_id]` matches any params list
+    that includes `obj.list_id`), or `None` if subscriptions with any params
+    may see the object.
+    """
 
     name = None
     queries = None
@@ -586,7 +630,7 @@ class DDP(APIMixin):
     def sub_unique_objects(self, obj, params=None, pub=None, *args, **kwargs):
         """Return objects that are only visible through given subscription."""
         if params is None:
-            params = ejson.loads(obj.params_ejson)
+            params = obj.params
         if pub is None:
             pub = self.get_pub_by_name(obj.publication)
         queries = collections.OrderedDict(
@@ -651,7 +695,7 @@ class DDP(APIMixin):
             user_id=getattr(this, 'user_id', None),
             defaults={
                 'publication': pub.name,
-                'params_ejson': ejson.dumps(params),
+                'params': list(params),
             },
         )
         this.subs.setdefault(sub.publication, set()).add(sub.pk)
@@ -661,6 +705,7 @@ class DDP(APIMixin):
             return
         # re-read from DB so we can get transaction ID (xmin)
         sub = Subscription.objects.extra(**XMIN).get(pk=sub.pk)
+        col_queries = []
         for col, qs in self.sub_unique_objects(
                 sub, params, pub, xmin__lte=sub.xmin,
         ):
@@ -668,30 +713,161 @@ class DDP(APIMixin):
                 model_name=model_name(qs.model),
                 collection_name=col.name,
             )
-            if isinstance(col.model._meta.pk, AleaIdField):
-                meteor_ids = None
-            elif len([
-                field
-                for field
-                in col.model._meta.local_fields
-                if (
-                    isinstance(field, AleaIdField)
-                ) and (
-                    field.unique
-                ) and (
-                    not field.null
-                )
-            ]) == 1:
+            col_queries.append((col, qs))
+        dbs = set(qs.db for _, qs in col_queries)
+        using = dbs.pop() if len(dbs) == 1 else None
+        with read_replica(using) as replica:
+            if replica is not None:
+                payload_lists = self.replica_added_msgs(col_queries, replica)
+        if replica is not None:
+            pass  # already read from replica.
+        elif (
+            SUB_QUERY_CONCURRENCY > 1
+        ) and (
+            len(col_queries) > 1
+        ) and (
+            using is not None
+        ) and (
+            connections[using].in_atomic_block
+        ):
+            payload_lists = self.concurrent_added_msgs(col_queries, using)
+        else:
+            payload_lists = (
+                self.added_msgs(col, qs) for col, qs in col_queries
+            )
+        # send in order of collections, regardless of query completion order.
+        for payloads in payload_lists:
+            for payload in payloads:
+                this.send(payload)
+        if not silent:
+            this.send({'msg': 'ready', 'subs': [id_]})
+
+    @staticmethod
+    def added_msgs(col, qs):
+        """Yield `added` messages for all objects in qs."""
+        if not ID_RESOLVER.strategy(col.model).object_mapping:
+            meteor_ids = None
+        else:
+            object_ids = qs.values_list('pk', flat=True)
+            if qs.db != router.db_for_read(qs.model):
+                # can't use a subquery across databases (eg: replica).
+                object_ids = list(object_ids)
+            meteor_ids = get_meteor_ids(qs.model, object_ids)
+        for obj in qs.select_related():
+            yield col.obj_change_as_msg(obj, ADDED, meteor_ids)
+
+    def replica_added_msgs(self, col_queries, replica):
+        """Return lists of `added` messages for col_queries from replica."""
+        with transaction.atomic(using=replica):
+            cursor = connections[replica].cursor()
+            # read all collections from the same snapshot.
+            cursor.execute(
+                'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY',
+            )
+            return [
+                list(self.added_msgs(col, qs.using(replica)))
+                for col, qs
+                in col_queries
+            ]
+
+    def concurrent_added_msgs(self, col_queries, using):
+        """
+        Yield lists of `added` messages for each (col, qs) in col_queries.
+
+        Queries run concurrently in separate greenlets (each with their own
+        database connection, borrowed from the DDP_DB_POOL_SIZE pool if
+        enabled) which share the snapshot of the current transaction via
+        `pg_export_snapshot()`, so all collections are read from a consistent
+        view of the database.  Snapshot transactions only read objects, any
+        ObjectMappings needed are created afterwards in the current
+        transaction.  Results are yielded in the order of `col_queries`.
+        """
+        cursor = connections[using].cursor()
+        cursor.execute('SELECT pg_export_snapshot()')
+        (snapshot_id,) = cursor.fetchone()
+        db_pool = getattr(this.ws, 'db_pool', None)
+        if db_pool is not None and db_pool.alias != using:
+            db_pool = None  # pool lends connections to another database.
+        pool = gevent.pool.Pool(SUB_QUERY_CONCURRENCY)
+        for (col, qs), objs in zip(
+                col_queries,
+                pool.imap(
+                    functools.partial(
+                        self.snapshot_objects, snapshot_id, using, db_pool,
+                    ),
+                    [qs for _, qs in col_queries],
+                ),
+        ):
+            if not ID_RESOLVER.strategy(col.model).object_mapping:
                 meteor_ids = None
             else:
                 meteor_ids = get_meteor_ids(
-                    qs.model, qs.values_list('pk', flat=True),
+                    qs.model, [obj.pk for obj in objs],
                 )
-            for obj in qs.select_related():
-                payload = col.obj_change_as_msg(obj, ADDED, meteor_ids)
-                this.send(payload)
-        if not silent:
-            this.send({'msg': 'ready', 'subs': [id_]})
+            yield [
+                col.obj_change_as_msg(obj, ADDED, meteor_ids)
+                for obj in objs
+            ]
+
+    def snapshot_objects(self, snapshot_id, using, db_pool, qs):
+        """Return list of objects in qs read within snapshot."""
+        if db_pool is None:
+            try:
+                return self.read_snapshot(snapshot_id, using, qs)
+            finally:
+                # connections are greenlet local, don't leave one lying about.
+                connections[using].close()
+        with db_pool.connection():
+            return self.read_snapshot(snapshot_id, using, qs)
+
+    @staticmethod
+    def read_snapshot(snapshot_id, using, qs):
+        """Return list of objects in qs from a read only snapshot."""
+        with transaction.atomic(using=using):
+            cursor = connections[using].cursor()
+            cursor.execute(
+                'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY',
+            )
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot_id])
+            return list(qs.select_related())
+
+    @transaction.atomic
+    def resync(self, websocket):
+        """Resend current state of all subscriptions for websocket."""
+        col_names = set()
+        visible = collections.defaultdict(set)
+        col_queries = []
+        for sub in Subscription.objects.filter(
+                connection=websocket.connection,
+        ).order_by('pk'):
+            pub = self.get_pub_by_name(sub.publication)
+            for qs in pub.user_queries(sub.user, *sub.params):
+                qs, col = self.qs_and_collection(qs)
+                col_names.add(col.name)
+                col_queries.append(
+                    (col, col.objects_for_user(user=sub.user_id, qs=qs)),
+                )
+        dbs = set(qs.db for _, qs in col_queries)
+        with read_replica(dbs.pop() if len(dbs) == 1 else None) as replica:
+            if replica is not None:
+                payload_lists = self.replica_added_msgs(col_queries, replica)
+            else:
+                payload_lists = (
+                    self.added_msgs(col, qs) for col, qs in col_queries
+                )
+            for payloads in payload_lists:
+                for payload in payloads:
+                    # sent as `changed` if client already has the object.
+                    visible[payload['collection']].add(payload['id'])
+                    websocket.send(payload)
+        # remove objects the client may have which are no longer visible.
+        for name in col_names:
+            for meteor_id in sorted(
+                    websocket.remote_ids[name].difference(visible[name]),
+            ):
+                websocket.send({
+                    'msg': REMOVED, 'collection': name, 'id': meteor_id,
+                })
 
     @api_endpoint
     def unsub(self, id_):
@@ -700,11 +876,13 @@ class DDP(APIMixin):
 
     def do_unsub(self, id_, silent):
         """Unsubscribe the current thread from the specified subscription id."""
-        sub = Subscription.objects.get(
-            connection=this.ws.connection, sub_id=id_,
+        sub = prepared.get(
+            Subscription.objects.filter(
+                connection=this.ws.connection, sub_id=id_,
+            ),
         )
         for col, qs in self.sub_unique_objects(sub):
-            if isinstance(col.model._meta.pk, AleaIdField):
+            if not ID_RESOLVER.strategy(col.model).object_mapping:
                 meteor_ids = None
             else:
                 meteor_ids = get_meteor_ids(
@@ -725,10 +903,7 @@ class DDP(APIMixin):
             handler = self.api_path_map()[method]
         except KeyError:
             raise MeteorError(404, 'Method not found', method)
-        try:
-            inspect.getcallargs(handler, *params)
-        except TypeError as err:
-            raise MeteorError(400, '%s' % err)
+        self.api_argspec_map()[method].validate_args(params)
         result = handler(*params)
         msg = {'msg': 'result', 'id': id_}
         if result is not None:
@@ -797,12 +972,18 @@ class DDP(APIMixin):
             return  # never send migration or DDP internal models
         obj = kwargs['instance']
         using = kwargs['using']
+        params_obj = obj
+        if obj.pk is not None and self.params_filter_pubs():
+            # instance already has new values, filter params on prior state.
+            params_obj = sender.objects.using(using).filter(
+                pk=obj.pk,
+            ).first() or obj
         self._ddp_subscribers.setdefault(
             using, {},
         ).setdefault(
             sender, {},
         )[obj.pk] = self.valid_subscribers(
-            model=sender, obj=obj, using=using,
+            model=sender, obj=obj, using=using, params_obj=params_obj,
         )
 
     def on_m2m_changed(self, sender, **kwargs):
@@ -846,6 +1027,8 @@ class DDP(APIMixin):
         """Post-save signal handler."""
         if self._in_migration:
             return
+        if EAGER_OBJECT_MAPPINGS and kwargs['created']:
+            self.create_object_mapping(sender, kwargs['instance'])
         self.send_notify(
             model=sender,
             obj=kwargs['instance'],
@@ -853,6 +1036,23 @@ class DDP(APIMixin):
             using=kwargs['using'],
         )
 
+    def create_object_mapping(self, model, obj):
+        """Create ObjectMapping for a new object of a published model."""
+        try:
+            self.get_collection(model)
+        except KeyError:
+            return  # not published, nobody will ask for its meteor ID.
+        strategy = ID_RESOLVER.strategy(model)
+        if not strategy.object_mapping:
+            return  # meteor ID is the primary key or an AleaIdField.
+        if (
+            strategy.alea_field is not None
+        ) and (
+            getattr(obj, strategy.alea_field.attname)
+        ):
+            return  # nullable AleaIdField has a value, use that.
+        create_meteor_ids(model, [obj.pk])
+
     def on_post_delete(self, sender, **kwargs):
         """Post-delete signal handler."""
         if self._in_migration:
@@ -864,13 +1064,43 @@ class DDP(APIMixin):
             using=kwargs['using'],
         )
 
-    def valid_subscribers(self, model, obj, using):
+    def params_filter_pubs(self):
+        """Return publications that implement `get_params_filter`."""
+        return [
+            api_provider
+            for api_provider
+            in self.api_providers
+            if isinstance(api_provider, Publication)
+            and hasattr(api_provider, 'get_params_filter')
+        ]
+
+    def params_filter(self, model, obj):
+        """Return Q object matching subscriptions whose params may see obj."""
+        restricted = []
+        allowed = Q()
+        for pub in self.params_filter_pubs():
+            contains = pub.get_params_filter(model, obj)
+            if contains is None:
+                continue  # any params may match
+            restricted.append(pub.name)
+            allowed |= Q(publication=pub.name, params__contains=contains)
+        if not restricted:
+            return None
+        return ~Q(publication__in=restricted) | allowed
+
+    def valid_subscribers(self, model, obj, using, params_obj=None):
         """Calculate valid subscribers (connections) for obj."""
         col_user_ids = {}
         col_connection_ids = collections.defaultdict(set)
-        for sub in Subscription.objects.filter(
-                collections__model_name=model_name(model),
-        ).prefetch_related('collections'):
+        subs = Subscription.objects.filter(
+            collections__model_name=model_name(model),
+        )
+        params_q = self.params_filter(
+            model, obj if params_obj is None else params_obj,
+        )
+        if params_q is not None:
+            subs = subs.filter(params_q)
+        for sub in prepared.objects(subs):
             pub = self.get_pub_by_name(sub.publication)
             try:
                 queries = list(pub.user_queries(sub.user, *sub.params))
@@ -886,7 +1116,7 @@ class DDP(APIMixin):
                     continue  # wrong model on queryset
 
                 # check if obj is included in this subscription
-                if not qs.filter(pk=obj.pk).exists():
+                if not prepared.exists(qs.filter(pk=obj.pk)):
                     continue  # subscription doesn't include this obj
 
                 # filter qs using user_rel paths on collection
@@ -938,11 +1168,16 @@ class DDP(APIMixin):
                     continue  # nobody subscribed
                 payload = col.obj_change_as_msg(obj, msg, meteor_ids)
                 payload['_connection_ids'] = sorted(connection_ids)
+                cursor = connections[using].cursor()
                 if my_connection_id is not None:
                     payload['_sender'] = my_connection_id
                     if my_connection_id in connection_ids:
                         # msg must go to connection that initiated the change
                         payload['_tx_id'] = this.ws.get_tx_id()
+                if CHANGE_LOG:
+                    # so listeners can catch up if they miss the NOTIFY, logged
+                    # with _tx_id so a replay fills the sender's reorder gap.
+                    payload['_change_id'] = log_change(cursor, payload)
                 # header is sent in every payload
                 header = {
                     'uuid': uuid.uuid1().int,  # UUID1 should be unique
@@ -950,7 +1185,6 @@ class DDP(APIMixin):
                     'fin': 0,  # zero if more chunks expected, 1 if last chunk.
                 }
                 data = ejson.dumps(payload)
-                cursor = connections[using].cursor()
                 while data:
                     hdr = ejson.dumps(header)
                     # use all available payload space for chunk
@@ -3,6 +3,7 @@ import warnings
 
 from django.apps import AppConfig
 from django.conf import settings, ImproperlyConfigured
+from django.db.models import signals
 
 from dddp import autodiscover
 
@@ -31,5 +32,15 @@ class DjangoDDPConfig(AppConfig):
                     ),
                     UserWarning,
                 )
+        # work out how meteor IDs are found for each model up front.
+        from dddp.models import ID_RESOLVER
+        ID_RESOLVER.populate(self.apps.get_models())
         self.api = autodiscover()
         self.api.ready()
+        # cached mappings must go when the ObjectMapping does.
+        from dddp.idcache import on_object_mapping_deleted
+        signals.post_delete.connect(
+            on_object_mapping_deleted,
+            sender=self.get_model('ObjectMapping'),
+            dispatch_uid='dddp.idcache',
+        )
@@ -0,0 +1,550 @@
+"""
+Django DDP asyncio server engine, exposed as an ASGI application.
+
+Speaks the same DDP protocol, using the same API, collections and
+publications as the gevent launcher (`dddp` command), but without monkey
+patching so it can run under any ASGI server alongside other asyncio code::
+
+    # myproject/asgi.py
+    import django
+    django.setup()
+
+    from dddp.asgi import DDPApplication
+    application = DDPApplication()
+
+    $ uvicorn myproject.asgi:application
+
+The event loop only handles websocket I/O and change notifications (received
+by an asyncio LISTEN consumer), the ORM is called from a pool of
+`DDP_ASGI_THREADS` threads.  Messages from any one connection are processed
+in order, one at a time (`this.unblock()` has no effect).  HTTP requests for
+anything other than SockJS info are passed to `http_app` if given.
+
+Requires Python 3.5 or later (`async`/`await` syntax), so this module is
+not installed on older Python releases - the rest of `dddp` doesn't import
+it, import it directly as above.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import concurrent.futures
+import functools
+import io
+import logging
+import re
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, DatabaseError
+import psycopg2
+
+from dddp import this
+from dddp.api import SUB_QUERY_CONCURRENCY
+from dddp.main import ddpp_sockjs_info, ddpp_sockjs_xhr
+from dddp.postgres import ChangeReceiver, keepalive, reassemble
+from dddp.reaper import ReaperGreenlet
+from dddp.websocket import (
+    DDPWebSocketApplication, HEARTBEAT_INTERVAL, RECV_QUEUE_MAX, safe_call,
+)
+
+
+# number of threads making ORM calls on behalf of DDP connections.
+ASGI_THREADS = int(getattr(settings, 'DDP_ASGI_THREADS', 10))
+
+WEBSOCKET_PATH = re.compile(r'^/(websocket|sockjs/\d+/\w+/websocket)$')
+SOCKJS_PATHS = [
+    (re.compile(r'^/sockjs/\d+/\w+/xhr$'), ddpp_sockjs_xhr),
+    (re.compile(r'^/sockjs/info$'), ddpp_sockjs_info),
+]
+
+
+def scope_environ(scope):
+    """Return WSGI style environ for an ASGI connection scope."""
+    client = scope.get('client') or ('', 0)
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': client[1],
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.url_scheme': 'https' if scope.get('scheme', 'http') in (
+            'https', 'wss',
+        ) else 'http',
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_%s' % key
+        value = value.decode('latin-1')
+        if key in environ:
+            value = '%s,%s' % (environ[key], value)
+        environ[key] = value
+    return environ
+
+
+class Background(object):
+
+    """Adapt a concurrent future to the greenlet `kill()` interface."""
+
+    def __init__(self, future):
+        """Wrap future."""
+        self.future = future
+
+    def kill(self, block=True):
+        """Cancel the future (from any thread)."""
+        del block  # never blocks.
+        self.future.cancel()
+
+
+class ThreadsafeEvent(object):
+
+    """Event waited on in the event loop, which any thread may set."""
+
+    def __init__(self, loop):
+        """Create event (in the event loop thread)."""
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        """Set the event."""
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class ASGIWebSocket(object):
+
+    """The parts of a geventwebsocket WebSocket used by DDP connections."""
+
+    def __init__(self, scope, send, loop):
+        """Wrap ASGI `send` for connection scope."""
+        self.environ = scope_environ(scope)
+        self.logger = logging.getLogger('dddp.asgi')
+        self.closed = False
+        self._send = send
+        self._loop = loop
+
+    async def send_frame(self, data):
+        """Send text frame."""
+        await self._send({'type': 'websocket.send', 'text': data})
+
+    def close(self):
+        """Close connection (from any thread)."""
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.run_coroutine_threadsafe(
+            self._send({'type': 'websocket.close'}), self._loop,
+        )
+
+
+class ASGIDDPConnection(DDPWebSocketApplication):
+
+    """
+    DDP connection driven by the asyncio event loop.
+
+    Message handlers run in executor threads, so the state shared with the
+    event loop (tx buffer, outbox, coalescing) is guarded by a lock and the
+    greenlet local `this` state is carried between threads.
+    """
+
+    def __init__(self, app, scope, send):
+        """Prepare connection (in the event loop thread)."""
+        self.loop = asyncio.get_event_loop()
+        super(ASGIDDPConnection, self).__init__(
+            ASGIWebSocket(scope, send, self.loop),
+        )
+        self.api = app.api
+        self.pgworker = app.listener
+        self.server_addr = app.reaper.server_addr
+        self.executor = app.executor
+        self._outbox_event = ThreadsafeEvent(self.loop)
+        self._lock = threading.RLock()
+        self._state = {}
+
+    async def run_sync(self, func, *args, save=True):
+        """Call `func(*args)` in an executor thread, return the result."""
+        return await self.loop.run_in_executor(
+            self.executor,
+            functools.partial(self.call_in_thread, func, args, save),
+        )
+
+    def call_in_thread(self, func, args, save):
+        """Call `func(*args)` with `this` state of this connection."""
+        state = this.__dict__
+        state.clear()
+        state.update(self._state)
+        try:
+            return func(*args)
+        finally:
+            if save:
+                self._state = dict(state)
+            state.clear()
+
+    def start_greenlets(self):
+        """Start writer and heartbeat tasks in the event loop."""
+        self._writer_greenlet = Background(
+            asyncio.run_coroutine_threadsafe(self.writer(), self.loop),
+        )
+        if HEARTBEAT_INTERVAL:
+            self._heartbeat_greenlet = Background(
+                asyncio.run_coroutine_threadsafe(
+                    self.heartbeat_task(), self.loop,
+                ),
+            )
+
+    def spawn(self, func, *args):
+        """Run `func(*args)` in an executor thread."""
+        return Background(
+            asyncio.run_coroutine_threadsafe(
+                self.run_sync(func, *args, save=False), self.loop,
+            ),
+        )
+
+    def spawn_later(self, seconds, func, *args):
+        """Run `func(*args)` in the event loop after `seconds`."""
+        return Background(
+            asyncio.run_coroutine_threadsafe(
+                self._later(seconds, func, *args), self.loop,
+            ),
+        )
+
+    async def _later(self, seconds, func, *args):
+        """Sleep, then call `func(*args)`."""
+        await asyncio.sleep(seconds)
+        with self._lock:
+            func(*args)
+
+    def on_message(self, message):
+        """Process messages in order, one at a time."""
+        if self.ws.closed:
+            return
+        safe_call(self.logger.debug, '< %s %r', self, message)
+        for data in self.ddp_frames_from_message(message):
+            self.process_pooled(data)
+
+    def get_tx_id(self):
+        """Get the next TX msg ID."""
+        with self._lock:
+            return super(ASGIDDPConnection, self).get_tx_id()
+
+    def _resync_next(self):
+        """Return True if another resync pass is due, marking it running."""
+        with self._lock:
+            return super(ASGIDDPConnection, self)._resync_next()
+
+    def send(self, data, tx_id=None):
+        """Send `data` (raw string or EJSON payload) to WebSocket client."""
+        with self._lock:
+            super(ASGIDDPConnection, self).send(data, tx_id=tx_id)
+
+    def coalesce(self, data):
+        """Send data, coalescing repeated `changed` messages for an object."""
+        with self._lock:
+            super(ASGIDDPConnection, self).coalesce(data)
+
+    async def reader(self, receive):
+        """Receive messages into `_inbox`, noting when each one arrived."""
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                await self._inbox.put(None)
+                return
+            self.last_recv = time.time()
+            text = message.get('text', None)
+            if text is None:
+                text = message['bytes'].decode('utf-8')
+            await self._inbox.put(text)
+
+    async def writer(self):
+        """Send queued messages, batching EJSON payloads into SockJS frames."""
+        wakeup = self._outbox_event.event
+        while True:
+            while not self._outbox:
+                wakeup.clear()
+                await wakeup.wait()
+            if self.ws.closed:
+                return
+            with self._lock:
+                data = self.next_frame()
+            try:
+                await self.ws.send_frame(data)
+            except Exception:  # pylint: disable=broad-except
+                # exception type depends on the ASGI server, peer is gone.
+                self.ws.close()
+                with self._lock:
+                    self._tx_buffer.clear()
+                    self._outbox.clear()
+                return
+
+    async def heartbeat_task(self):
+        """Send heartbeats while idle, tear down the connection if no reply."""
+        while not self.ws.closed:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            with self._lock:
+                alive = self.heartbeat()
+            if not alive:
+                return
+
+
+class AsyncListener(ChangeReceiver):
+
+    """
+    LISTEN for change notifications from the asyncio event loop.
+
+    Like the gevent PostgresGreenlet, the connection uses TCP keepalives and
+    is re-established when lost, catching up on missed changes from the
+    change log (or resyncing all connections if there is none).
+    """
+
+    # max seconds between attempts to (re)connect to the database.
+    max_retry_delay = 5.0
+
+    def __init__(self, loop, executor):
+        """Prepare listener."""
+        self.logger = logging.getLogger('dddp.asgi')
+        self.loop = loop
+        self.executor = executor
+        self.connections = {}
+        self.chunks = {}
+        self.delivered = None
+        # time (if any) the LISTEN connection was lost, for catching up.
+        self.lost_at = None
+        self.conn = None
+        self._reconnect_task = None
+
+    def connect(self):
+        """Open the LISTEN connection (blocking, so call from a thread)."""
+        conn = connection.get_new_connection(
+            keepalive(connection.get_connection_params()),
+        )
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('LISTEN "ddp";')
+            # notifications wait for start(), so none are missed meanwhile.
+            self.recover()
+        except BaseException:
+            conn.close()
+            raise
+        self.conn = conn
+
+    def start(self):
+        """Process notifications as they arrive (from the event loop)."""
+        self.loop.add_reader(self.conn.fileno(), self.poll)
+        self.logger.info('=> Started AsyncListener.')
+        self.poll()  # notifications received while catching up.
+
+    def stop(self):
+        """Stop listening."""
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self.conn is not None:
+            self.loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.conn = None
+
+    def poll(self):
+        """Read notifications, delivering each change once reassembled."""
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            self.logger.exception('Lost LISTEN connection, reconnecting.')
+            self.lost()
+            return
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            data = reassemble(self.chunks, notify.payload)
+            if data is not None:
+                self.receive(data)
+
+    def lost(self):
+        """Close lost LISTEN connection and start reconnecting."""
+        if self.lost_at is None:
+            self.lost_at = time.time()
+        self.stop()
+        self.chunks.clear()  # partial messages won't be completed.
+        self._reconnect_task = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        """Reconnect (with backoff) until listening again."""
+        delay = 0.1
+        while True:
+            try:
+                await self.loop.run_in_executor(self.executor, self.connect)
+            except (psycopg2.Error, DatabaseError) as err:
+                self.logger.warning(
+                    'LISTEN connection failed, retrying in %.1fs: %s',
+                    delay, ('%s' % err).strip(),
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            self._reconnect_task = None
+            self.start()
+            return
+
+
+class DDPApplication(object):
+
+    """ASGI application serving DDP over websockets."""
+
+    def __init__(self, http_app=None, api=None, threads=ASGI_THREADS):
+        """Prepare application, resources are acquired on startup."""
+        if SUB_QUERY_CONCURRENCY > 1:
+            raise ImproperlyConfigured(
+                'DDP_SUB_QUERY_CONCURRENCY > 1 requires the gevent launcher.',
+            )
+        self.logger = logging.getLogger('dddp.asgi')
+        self.http_app = http_app
+        self.api = api or apps.get_app_config('dddp').api
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        # not started, we call beat()/reap() ourselves.
+        self.reaper = ReaperGreenlet(on_lost=self.close_reaped)
+        self.listener = None
+        self._started = None
+        self._heartbeat_task = None
+
+    async def __call__(self, scope, receive, send):
+        """Handle ASGI connection."""
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'websocket' and WEBSOCKET_PATH.match(
+                scope['path'],
+        ):
+            await self.startup()
+            await self.websocket(scope, receive, send)
+        elif scope['type'] == 'http' and self.sockjs_app(scope) is not None:
+            await self.sockjs(scope, send)
+        elif self.http_app is not None:
+            await self.http_app(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close'})
+        else:
+            await send({
+                'type': 'http.response.start',
+                'status': 404,
+                'headers': [(b'content-type', b'text/plain; charset=UTF-8')],
+            })
+            await send({'type': 'http.response.body', 'body': b'Not found.'})
+
+    async def lifespan(self, receive, send):
+        """Start and stop with the ASGI server."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        """Start heartbeat and LISTEN consumer (once)."""
+        if self._started is None:
+            self._started = asyncio.ensure_future(self._startup())
+        await self._started
+
+    async def _startup(self):
+        """Heartbeat before accepting connections, then start listening."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.beat)
+        self.listener = AsyncListener(loop, self.executor)
+        await loop.run_in_executor(self.executor, self.listener.connect)
+        self.listener.start()
+        self.api.pgworker = self.listener
+        self._heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+    async def shutdown(self):
+        """Stop listening and release all connections of this server."""
+        if self._started is None:
+            return
+        await self._started
+        self._heartbeat_task.cancel()
+        self.listener.stop()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.reaper.release)
+        self._started = None
+
+    async def heartbeat(self):
+        """Heartbeat this server and reap connections of dead ones."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.reaper.interval)
+            try:
+                await loop.run_in_executor(self.executor, self.beat)
+            except DatabaseError:
+                self.logger.exception('Heartbeat failed, will retry.')
+
+    def close_reaped(self):
+        """Close connections that were reaped by peers (from any thread)."""
+        # subscriptions are gone too, so clients must reconnect to get updates.
+        for conn in list(self.listener.connections.values()):
+            conn.abort()
+
+    def beat(self):
+        """Heartbeat, then reap dead servers and old changes (in a thread)."""
+        self.reaper.beat()
+        self.reaper.reap()
+        self.reaper.prune()
+
+    async def websocket(self, scope, receive, send):
+        """Run DDP connection until the client disconnects."""
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type': 'websocket.accept'})
+        conn = ASGIDDPConnection(self, scope, send)
+        conn._inbox = asyncio.Queue(RECV_QUEUE_MAX)
+        await conn.run_sync(conn.on_open)
+        reader = asyncio.ensure_future(conn.reader(receive))
+        try:
+            while True:
+                text = await conn._inbox.get()
+                if text is None:
+                    break
+                await conn.run_sync(conn.on_message, text)
+        finally:
+            reader.cancel()
+            conn.ws.closed = True
+            await asyncio.shield(conn.run_sync(conn.on_close))
+
+    def sockjs_app(self, scope):
+        """Return WSGI app handling SockJS HTTP request (if any)."""
+        for path, wsgi_app in SOCKJS_PATHS:
+            if path.match(scope['path']):
+                return wsgi_app
+        return None
+
+    async def sockjs(self, scope, send):
+        """Respond to SockJS HTTP request."""
+        response = []
+        body = ''.join(
+            self.sockjs_app(scope)(
+                scope_environ(scope),
+                lambda status, headers: response.extend([status, headers]),
+            ),
+        )
+        status, headers = response
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [
+                (name.lower().encode('latin-1'), val.encode('latin-1'))
+                for name, val
+                in headers
+            ],
+        })
+        await send({
+            'type': 'http.response.body', 'body': body.encode('utf-8'),
+        })
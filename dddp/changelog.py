@@ -0,0 +1,144 @@
+"""Django DDP change log, for catching up on changes missed while offline."""
+
+from __future__ import absolute_import
+
+import collections
+import time
+
+import ejson
+from django.conf import settings
+from django.db import connection
+
+
+# record each change sent by NOTIFY so listeners can replay missed changes,
+# costs an INSERT per published write (otherwise listeners resync instead).
+CHANGE_LOG = getattr(settings, 'DDP_CHANGE_LOG', False)
+# seconds that changes are kept in the log.
+CHANGE_LOG_RETENTION = float(
+    getattr(settings, 'DDP_CHANGE_LOG_RETENTION', 300),
+)
+# max changes replayed after reconnecting, more than this resyncs instead.
+CHANGE_LOG_MAX_REPLAY = int(
+    getattr(settings, 'DDP_CHANGE_LOG_MAX_REPLAY', 10000),
+)
+# seconds before a lost connection to start replaying from (changes may be
+# committed some time after being logged, so arrive out of order).
+CHANGE_LOG_REPLAY_SLACK = float(
+    getattr(settings, 'DDP_CHANGE_LOG_REPLAY_SLACK', 30),
+)
+
+
+def table():
+    """Return quoted change log table name."""
+    # imported here as dddp.postgres (hence this module) is imported by the
+    # launcher and relay before Django apps are loaded.
+    from dddp.models import ChangeLog
+    # Django model._meta is public API -> pylint: disable=W0212
+    return connection.ops.quote_name(ChangeLog._meta.db_table)
+
+
+def log_change(cursor, payload):
+    """Record change payload using cursor, returning the change ID."""
+    cursor.execute(
+        'INSERT INTO %s (created, payload) VALUES (now(), %%s) '
+        'RETURNING id' % table(),
+        [ejson.dumps(payload)],
+    )
+    return cursor.fetchone()[0]
+
+
+def prune():
+    """Delete changes older than CHANGE_LOG_RETENTION, return count."""
+    with connection.cursor() as cur:
+        cur.execute(
+            "DELETE FROM %s WHERE created < now() - %%s * INTERVAL '1 second'"
+            % table(),
+            [CHANGE_LOG_RETENTION],
+        )
+        return cur.rowcount
+
+
+def max_change_id():
+    """Return ID of the latest change logged (or 0)."""
+    with connection.cursor() as cur:
+        cur.execute('SELECT COALESCE(MAX(id), 0) FROM %s' % table())
+        return cur.fetchone()[0]
+
+
+def changes_since(change_id):
+    """
+    Return list of changes logged after change_id (in order).
+
+    Returns None if there are more than CHANGE_LOG_MAX_REPLAY changes.
+    """
+    with connection.cursor() as cur:
+        cur.execute(
+            'SELECT id, payload FROM %s WHERE id > %%s '
+            'ORDER BY id LIMIT %%s' % table(),
+            [change_id, CHANGE_LOG_MAX_REPLAY + 1],
+        )
+        rows = cur.fetchall()
+    if len(rows) > CHANGE_LOG_MAX_REPLAY:
+        return None
+    changes = []
+    for pk, payload in rows:
+        data = ejson.loads(payload)
+        data['_change_id'] = pk
+        changes.append(data)
+    return changes
+
+
+class DeliveredChanges(object):
+
+    """
+    IDs of changes delivered within the last `retention` seconds.
+
+    Changes commit out of order, so a replay starts from the latest change
+    delivered some time before the connection was lost, skipping any later
+    changes that were already delivered.
+
+    >>> import functools
+    >>> clock = functools.partial(next, iter([0, 10, 20, 200]))
+    >>> delivered = DeliveredChanges(baseline=1, retention=100, clock=clock)
+    >>> delivered.add(3), delivered.add(2), delivered.add(5), delivered.add(3)
+    (True, True, True, False)
+    >>> delivered.replay_from(15), delivered.replay_from(-1)
+    (3, 1)
+    >>> delivered.add(6), delivered.replay_from(0)  # 2, 3 and 5 expired
+    (True, 5)
+    """
+
+    def __init__(
+            self, baseline=0, retention=CHANGE_LOG_RETENTION, clock=time.time,
+    ):
+        """Track changes delivered after `baseline` change ID."""
+        self.baseline = baseline
+        self.retention = retention
+        self.clock = clock
+        self._delivered = collections.OrderedDict()  # id: time delivered
+
+    def add(self, change_id):
+        """Record delivery of change_id, return False if already delivered."""
+        if change_id in self._delivered:
+            return False
+        now = self.clock()
+        self._delivered[change_id] = now
+        while True:
+            oldest, delivered_at = next(iter(self._delivered.items()))
+            if delivered_at >= now - self.retention:
+                break
+            # too old to matter, everything up to here is accounted for.
+            del self._delivered[oldest]
+            self.baseline = max(self.baseline, oldest)
+        return True
+
+    def replay_from(self, since):
+        """Return change ID to replay from for a connection lost at since."""
+        return max(
+            [self.baseline] + [
+                change_id
+                for change_id, delivered_at
+                in self._delivered.items()
+                if delivered_at <= since
+            ],
+        )
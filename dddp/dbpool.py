@@ -0,0 +1,174 @@
+"""Bounded gevent aware pool of Django database connections."""
+
+from __future__ import absolute_import, division
+
+import collections
+import contextlib
+import logging
+import time
+
+import gevent.lock
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.utils import OperationalError
+
+
+# max database connections shared by DDP greenlets (0 disables pooling).
+POOL_SIZE = int(getattr(settings, 'DDP_DB_POOL_SIZE', 0))
+# seconds a greenlet waits for a pooled connection before giving up.
+POOL_TIMEOUT = float(getattr(settings, 'DDP_DB_POOL_TIMEOUT', 30))
+
+
+class PoolTimeout(OperationalError):
+
+    """No pooled database connection became free in time."""
+
+
+class DatabasePool(object):
+
+    """
+    Lend Django database connections to greenlets from a bounded pool.
+
+    Django connections are thread (hence greenlet) local, so every greenlet
+    using the ORM would otherwise open (and close) its own connection.  The
+    pool hands the same DatabaseWrapper instances to whichever greenlet holds
+    a slot, keeping at most `size` connections open to the database.
+    """
+
+    def __init__(
+            self, alias=DEFAULT_DB_ALIAS, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+    ):
+        """Prepare empty pool."""
+        self.logger = logging.getLogger('dddp.dbpool')
+        self.alias = alias
+        self.size = size
+        self.timeout = timeout
+        self.in_use = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        # running totals: acquired, waited, timeouts, created, discarded.
+        self.counts = collections.Counter()
+        self._idle = []  # LIFO, so the warmest connections get reused.
+        self._slots = gevent.lock.BoundedSemaphore(size)
+
+    def _current(self):
+        """Return DatabaseWrapper held by the current greenlet (if any)."""
+        # pylint: disable=protected-access
+        return getattr(connections._connections, self.alias, None)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Lend a pooled connection to the current greenlet for the block."""
+        current = self._current()
+        if getattr(current, 'dddp_pool', None) is self:
+            yield current  # nested use, already holding a slot.
+            return
+        if current is not None:
+            # greenlet opened its own connection outside the pool.
+            current.close()
+        wrapper = self.acquire()
+        try:
+            yield wrapper
+        finally:
+            self.release(wrapper)
+
+    @contextlib.contextmanager
+    def direct(self):
+        """Open an unpooled connection for the block, closing it after."""
+        # pylint: disable=protected-access
+        local = connections._connections
+        saved = getattr(local, self.alias, None)
+        if saved is not None:
+            delattr(local, self.alias)
+        wrapper = connections[self.alias]  # new, greenlet local wrapper.
+        try:
+            yield wrapper
+        finally:
+            try:
+                wrapper.close()
+            finally:
+                delattr(local, self.alias)
+                if saved is not None:
+                    setattr(local, self.alias, saved)
+
+    def acquire(self):
+        """Wait for a free slot and attach a connection to this greenlet."""
+        start = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            self.counts['timeouts'] += 1
+            raise PoolTimeout(
+                'Timed out waiting %.1fs for a database connection.' % (
+                    self.timeout,
+                ),
+            )
+        waited = time.time() - start
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.counts['acquired'] += 1
+        if waited >= 0.001:
+            self.counts['waited'] += 1
+        self.in_use += 1
+        # pylint: disable=protected-access
+        local = connections._connections
+        if hasattr(local, self.alias):
+            delattr(local, self.alias)
+        if self._idle:
+            wrapper = self._idle.pop()
+            setattr(local, self.alias, wrapper)
+        else:
+            wrapper = connections[self.alias]  # new, greenlet local wrapper.
+            wrapper.dddp_pool = self
+            # wrapper will be used by other greenlets later on.
+            wrapper.allow_thread_sharing = True
+            self.counts['created'] += 1
+        return wrapper
+
+    def release(self, wrapper):
+        """Detach connection from this greenlet and return it to the pool."""
+        # pylint: disable=protected-access
+        local = connections._connections
+        if getattr(local, self.alias, None) is wrapper:
+            delattr(local, self.alias)
+        try:
+            if wrapper.connection is not None and (
+                wrapper.in_atomic_block or (
+                    wrapper.errors_occurred and not wrapper.is_usable()
+                )
+            ):
+                self.discard(wrapper)
+            else:
+                wrapper.errors_occurred = False
+                self._idle.append(wrapper)
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+
+    def discard(self, wrapper):
+        """Close connection that isn't fit for reuse."""
+        self.counts['discarded'] += 1
+        try:
+            wrapper.connection.close()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception('Error closing %r', wrapper)
+        wrapper.connection = None
+
+    def close_all(self):
+        """Close all idle connections (eg: at shutdown)."""
+        while self._idle:
+            wrapper = self._idle.pop()
+            if wrapper.connection is not None:
+                self.discard(wrapper)
+
+    def stats(self):
+        """Return dict of pool utilization and wait time statistics."""
+        acquired = self.counts['acquired']
+        result = collections.OrderedDict([
+            ('size', self.size),
+            ('in_use', self.in_use),
+            ('idle', len(self._idle)),
+            ('utilization', self.in_use / self.size),
+            ('avg_wait', self.wait_time / acquired if acquired else 0),
+            ('max_wait', self.max_wait_time),
+        ])
+        result.update(sorted(self.counts.items()))
+        return result
@@ -0,0 +1,116 @@
+"""In-process cache of ObjectMapping meteor ID <-> object ID pairs."""
+
+from __future__ import absolute_import
+
+import collections
+import threading
+
+from django.conf import settings
+
+
+# max (object ID, meteor ID) pairs cached per process (0 disables caching).
+ID_CACHE_SIZE = int(getattr(settings, 'DDP_ID_CACHE_SIZE', 100000))
+
+
+class MappingCache(object):
+
+    """
+    Bounded LRU cache of mappings, looked up by object ID or meteor ID.
+
+    Keys include the content type ID as object IDs are only unique per model.
+    Mappings never change once created, so entries only go away when evicted
+    or when the ObjectMapping is deleted.
+
+    >>> cache = MappingCache(maxsize=2)
+    >>> cache.add(1, 10, 'a')
+    >>> cache.update(1, [('11', 'b'), ('12', 'c')])  # evicts 10 <-> a
+    >>> cache.get_meteor_id(1, 10), cache.get_object_id(1, 'b')
+    (None, '11')
+    >>> cache.discard(1, '11', 'b')
+    >>> cache.get_meteor_id(1, 11), cache.get_meteor_id(1, 12)
+    (None, 'c')
+    >>> sorted(cache.stats.items())
+    [('evictions', 1), ('hits', 2), ('misses', 2)]
+    """
+
+    def __init__(self, maxsize=ID_CACHE_SIZE):
+        """Create empty cache."""
+        self.maxsize = maxsize
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        # (content_type_id, object_id): meteor_id, least recently used first.
+        self._by_object = collections.OrderedDict()
+        # (content_type_id, meteor_id): object_id
+        self._by_meteor = {}
+
+    def __len__(self):
+        """Number of mappings cached."""
+        return len(self._by_object)
+
+    def get_meteor_id(self, content_type_id, object_id):
+        """Return cached meteor ID for object (or None)."""
+        key = (content_type_id, str(object_id))
+        with self._lock:
+            meteor_id = self._by_object.pop(key, None)
+            if meteor_id is None:
+                self.stats['misses'] += 1
+                return None
+            self._by_object[key] = meteor_id  # most recently used
+            self.stats['hits'] += 1
+            return meteor_id
+
+    def get_object_id(self, content_type_id, meteor_id):
+        """Return cached object ID for meteor ID (or None)."""
+        with self._lock:
+            object_id = self._by_meteor.get((content_type_id, meteor_id))
+            if object_id is None:
+                self.stats['misses'] += 1
+                return None
+            key = (content_type_id, object_id)
+            self._by_object[key] = self._by_object.pop(key)
+            self.stats['hits'] += 1
+            return object_id
+
+    def add(self, content_type_id, object_id, meteor_id):
+        """Cache mapping."""
+        self.update(content_type_id, [(object_id, meteor_id)])
+
+    def update(self, content_type_id, pairs):
+        """Cache (object_id, meteor_id) pairs of one content type."""
+        if not self.maxsize:
+            return
+        with self._lock:
+            for object_id, meteor_id in pairs:
+                key = (content_type_id, str(object_id))
+                self._by_object.pop(key, None)
+                self._by_object[key] = meteor_id
+                self._by_meteor[(content_type_id, meteor_id)] = key[1]
+            while len(self._by_object) > self.maxsize:
+                (old_ct_id, _), old_meteor_id = self._by_object.popitem(
+                    last=False,
+                )
+                self._by_meteor.pop((old_ct_id, old_meteor_id), None)
+                self.stats['evictions'] += 1
+
+    def discard(self, content_type_id, object_id, meteor_id):
+        """Forget mapping (if cached)."""
+        with self._lock:
+            self._by_object.pop((content_type_id, str(object_id)), None)
+            self._by_meteor.pop((content_type_id, meteor_id), None)
+
+    def clear(self):
+        """Forget all mappings."""
+        with self._lock:
+            self._by_object.clear()
+            self._by_meteor.clear()
+
+
+ID_CACHE = MappingCache()
+
+
+def on_object_mapping_deleted(sender, instance, **kwargs):
+    """Forget deleted ObjectMapping (post_delete signal handler)."""
+    del sender, kwargs  # unused
+    ID_CACHE.discard(
+        instance.content_type_id, instance.object_id, instance.meteor_id,
+    )
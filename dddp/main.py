@@ -4,8 +4,14 @@ from __future__ import absolute_import, print_function
 
 import argparse
 import collections
+import functools
+import logging
 import os
 import signal
+import socket
+import sys
+import time
+import traceback
 
 import gevent
 from gevent.backdoor import BackdoorServer
@@ -71,16 +77,20 @@ class DDPLauncher(object):
     """Orchestrate the setup and launching of DDP greenlets in a sane manner."""
 
     pgworker = None
+    reaper = None
+    db_pool = None
+    replica_pool = None
 
-    def __init__(self, debug=False, verbosity=1):
+    def __init__(self, debug=False, verbosity=1, relay_path=None):
         """
         Spawn greenlets for handling websockets and PostgreSQL calls.
 
         Only one pgworker should be started for any process, and ideally only
         one instance per node as well (ie: use IPC to communicate events between
         processes on the same host).  This class handles the former (per
-        process), per host IPC is an excercise left to you, dear reader - pull
-        requests are of course welcome.  ;)
+        process), the latter is handled by `dddp --workers N` which runs a
+        single LISTEN relay per host - when `relay_path` is given the pgworker
+        receives changes from the relay on that Unix socket instead.
 
         For the record, there's no technical reason that you can't have multiple
         pgworker instances running on one host (or even one process), it's just
@@ -97,6 +107,10 @@ class DDPLauncher(object):
         self._stop_event.set()  # start in stopped state.
         self.logger = logging.getLogger('dddp.launcher')
 
+        if DDPLauncher.pgworker is None and relay_path is not None:
+            from dddp.relay import RelayClientGreenlet
+            DDPLauncher.pgworker = RelayClientGreenlet(relay_path)
+
         if DDPLauncher.pgworker is None:
             from django.db import connection, close_old_connections
             from dddp.postgres import PostgresGreenlet
@@ -105,6 +119,20 @@ class DDPLauncher(object):
 
             DDPLauncher.pgworker = PostgresGreenlet(connection)
 
+        if DDPLauncher.reaper is None:
+            from dddp.reaper import ReaperGreenlet
+            DDPLauncher.reaper = ReaperGreenlet(on_lost=self.close_reaped)
+
+        if DDPLauncher.db_pool is None:
+            from dddp.dbpool import DatabasePool, POOL_SIZE
+            if POOL_SIZE:
+                from dddp import replica
+                DDPLauncher.db_pool = DatabasePool()
+                if replica.READ_REPLICA is not None:
+                    DDPLauncher.replica_pool = replica.REPLICA_POOL = (
+                        DatabasePool(alias=replica.READ_REPLICA)
+                    )
+
         # use settings.WSGI_APPLICATION or fallback to default Django WSGI app
         from django.conf import settings
         self.wsgi_app = None
@@ -125,6 +153,10 @@ class DDPLauncher(object):
 
         # setup PostgresGreenlet to multiplex DB calls
         DDPWebSocketApplication.pgworker = self.pgworker
+        # connections are owned by this server (reaped if heartbeat expires)
+        DDPWebSocketApplication.server_addr = self.reaper.server_addr
+        # share a bounded set of DB connections between websocket greenlets
+        DDPWebSocketApplication.db_pool = self.db_pool
 
         self.resource = geventwebsocket.Resource(
             collections.OrderedDict([
@@ -145,14 +177,14 @@ class DDPLauncher(object):
             print(msg, *args, **kwargs)
 
     def add_web_servers(self, listen_addrs, debug=False, **ssl_args):
-        """Add WebSocketServer for each (host, port) in listen_addrs."""
+        """Add WebSocketServer for each (host, port) or socket given."""
         self.servers.extend(
             self.get_web_server(listen_addr, debug=debug, **ssl_args)
             for listen_addr in listen_addrs
         )
 
     def get_web_server(self, listen_addr, debug=False, **ssl_args):
-        """Setup WebSocketServer on listen_addr (host, port)."""
+        """Setup WebSocketServer on listen_addr (host, port) or socket."""
         return geventwebsocket.WebSocketServer(
             listen_addr,
             self.resource,
@@ -163,10 +195,22 @@ class DDPLauncher(object):
     def get_backdoor_server(self, listen_addr, **context):
         """Add a backdoor (debug) server."""
         from django.conf import settings
+        from dddp.idcache import ID_CACHE
+        from dddp.prepared import PREPARED_STATS
+        from dddp.replica import REPLICA_STATS
+        from dddp.websocket import SEND_QUEUE_STATS, TX_BUFFER_STATS
         local_vars = {
             'launcher': self,
             'servers': self.servers,
             'pgworker': self.pgworker,
+            'reaper': self.reaper,
+            'db_pool': self.db_pool,
+            'replica_pool': self.replica_pool,
+            'send_queue_stats': SEND_QUEUE_STATS,
+            'tx_buffer_stats': TX_BUFFER_STATS,
+            'prepared_stats': PREPARED_STATS,
+            'replica_stats': REPLICA_STATS,
+            'id_cache': ID_CACHE,
             'stop': self.stop,
             'api': self.api,
             'resource': self.resource,
@@ -184,12 +228,43 @@ class DDPLauncher(object):
         self.logger.debug('PostgresGreenlet stop')
         self._stop_event.set()
         # ask all threads to stop.
-        for server in self.servers + [DDPLauncher.pgworker]:
+        for server in self.servers + [
+                DDPLauncher.pgworker, DDPLauncher.reaper,
+        ]:
             self.logger.debug('Stopping %s', server)
             server.stop()
         # wait for all threads to stop.
-        gevent.joinall(self.threads + [DDPLauncher.pgworker])
+        gevent.joinall(
+            self.threads + [DDPLauncher.pgworker, DDPLauncher.reaper],
+        )
         self.threads = []
+        self.release_connections()
+        if DDPLauncher.db_pool is not None:
+            DDPLauncher.db_pool.close_all()
+        if DDPLauncher.replica_pool is not None:
+            DDPLauncher.replica_pool.close_all()
+
+    @staticmethod
+    def close_reaped():
+        """Close websockets whose connections were reaped by peers."""
+        # subscriptions are gone too, so clients must reconnect to get updates.
+        for websocket in list(DDPLauncher.pgworker.connections.values()):
+            websocket.abort()
+
+    def release_connections(self):
+        """Bulk delete all connections owned by this server."""
+        from django.db import DatabaseError
+        try:
+            counts = DDPLauncher.reaper.release()
+        except DatabaseError:
+            # reaped by other servers once our heartbeat expires.
+            self.logger.exception('Failed to release connections.')
+            return
+        self.logger.debug('Released %r', counts)
+        # rows are gone, don't let on_close delete them one by one.
+        for websocket in list(DDPLauncher.pgworker.connections.values()):
+            websocket.connection = None
+        DDPLauncher.pgworker.connections.clear()
 
     def start(self):
         """Run PostgresGreenlet and web/debug servers."""
@@ -203,6 +278,10 @@ class DDPLauncher(object):
         # start greenlets
         self.pgworker.start()
         self.print('=> Started PostgresGreenlet.')
+        # heartbeat before accepting connections so they can't be reaped.
+        self.reaper.beat()
+        self.reaper.start()
+        self.print('=> Started ReaperGreenlet (%s).' % self.reaper.server_addr)
         for server in self.servers:
             thread = gevent.spawn(server.serve_forever)
             gevent.sleep()  # yield to thread in case it can't start
@@ -234,7 +313,9 @@ class DDPLauncher(object):
         self.start()
         self._stop_event.wait()
         # wait for all threads to stop.
-        gevent.joinall(self.threads + [DDPLauncher.pgworker])
+        gevent.joinall(
+            self.threads + [DDPLauncher.pgworker, DDPLauncher.reaper],
+        )
         self.threads = []
 
 
@@ -252,7 +333,6 @@ def addr(val, default_port=8000, defualt_host='localhost'):
     Addr(host='0.0.0.0', port=8000)
     """
     import re
-    import socket
 
     match = re.match(r'\A(?P<host>.*?)(:(?P<port>(\d+|\w+)))?\Z', val)
     if match is None:
@@ -274,14 +354,168 @@ def addr(val, default_port=8000, defualt_host='localhost'):
     return Addr(host, port)
 
 
-def serve(listen, verbosity=1, debug_port=0, **ssl_args):
+def listen_socket(listen_addr, backlog=1024):
+    """Bind a listening socket for (host, port) to share with workers."""
+    host, port = listen_addr
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE,
+    )[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+class Supervisor(object):
+
+    """
+    Pre-fork worker processes, restart them if they die, reload on SIGHUP.
+
+    The supervisor itself never imports Django (or connects to the database),
+    so workers forked on reload pick up new code and settings.  An optional
+    `relay` process is started first and kept running across reloads.
+    """
+
+    # minimum seconds between restarts of a worker slot (crash loop guard).
+    restart_delay = 1.0
+
+    def __init__(self, num_workers, worker, relay=None):
+        """Prepare to run `worker(slot)` in `num_workers` processes."""
+        self.logger = logging.getLogger('dddp.supervisor')
+        self.num_workers = num_workers
+        self.worker = worker
+        self.relay = relay
+        self.pid = os.getpid()
+        self.generation = 0
+        self.workers = {}  # pid: (generation, slot, started, target)
+        self._stopping = False
+
+    def spawn(self, slot, target=None):
+        """Fork a new worker process for slot."""
+        if target is None:
+            target, generation = self.worker, self.generation
+        else:
+            generation = None  # not a worker, keep running across reloads.
+        pid = os.fork()
+        if pid == 0:
+            # reloading is the supervisor's job, SIGTERM kills the worker.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                target(slot)
+            except SystemExit as err:
+                code = err.code
+            except BaseException:  # pylint: disable=broad-except
+                traceback.print_exc(file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code or 0)  # pylint: disable=protected-access
+        self.workers[pid] = (generation, slot, time.time(), target)
+        self.logger.info('Started worker %s (pid=%d).', slot, pid)
+        return pid
+
+    def signal_workers(self, signum, pids=None):
+        """Send signum to workers (all of them by default)."""
+        for pid in list(self.workers) if pids is None else pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass  # already dead, will be reaped.
+
+    def reload(self):
+        """Gracefully replace all workers with freshly forked ones."""
+        self.logger.info('Reloading workers.')
+        old_pids = [
+            pid for pid, (generation, _, _, _) in self.workers.items()
+            if generation is not None
+        ]
+        self.generation += 1
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+        # old workers stop accepting, then finish up in their own time.
+        self.signal_workers(signal.SIGQUIT, old_pids)
+
+    def stop(self, signum=signal.SIGQUIT):
+        """Stop all workers and let run() finish."""
+        self._stopping = True
+        self.signal_workers(signum)
+
+    def reap(self):
+        """Collect dead workers, restarting those of current generation."""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break  # no more children.
+            if pid == 0:
+                break
+            try:
+                generation, slot, started, target = self.workers.pop(pid)
+            except KeyError:
+                continue  # not one of ours.
+            if self._stopping or generation not in (None, self.generation):
+                self.logger.info('Worker %s (pid=%d) exited.', slot, pid)
+                continue
+            self.logger.error(
+                'Worker %s (pid=%d) died (status=%d), restarting.',
+                slot, pid, status,
+            )
+            delay = self.restart_delay - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+            self.spawn(slot, None if generation is not None else target)
+
+    def run(self):
+        """Spawn workers and supervise them until stopped."""
+        def sighandler(signum=None, frame=None):
+            """Signal handler (only acts in the supervisor process)."""
+            del frame
+            if os.getpid() != self.pid:
+                return  # inherited by a worker, which has its own handlers.
+            if signum == signal.SIGHUP:
+                self.reload()
+            else:
+                self.stop()
+        for signum in [
+                signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM,
+        ]:
+            gevent.signal(signum, sighandler, signum)
+        if self.relay is not None:
+            self.spawn('relay', self.relay)
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+        while self.workers:
+            self.reap()
+            gevent.sleep(0.5)
+
+
+def serve(
+        listen, verbosity=1, debug_port=0, parent_pid=None, relay_path=None,
+        **ssl_args
+):
     """Spawn greenlets for handling websockets and PostgreSQL calls."""
-    launcher = DDPLauncher(debug=verbosity == 3, verbosity=verbosity)
+    import django
+    # DDPLauncher imports dddp models, so apps must be loaded first.
+    django.setup()
+    launcher = DDPLauncher(
+        debug=verbosity == 3, verbosity=verbosity, relay_path=relay_path,
+    )
     if debug_port:
         launcher.servers.append(
             launcher.get_backdoor_server('localhost:%d' % debug_port)
         )
     launcher.add_web_servers(listen, **ssl_args)
+    if parent_pid is not None:
+        def watch_parent():
+            """Stop if the supervisor goes away."""
+            while os.getppid() == parent_pid:
+                gevent.sleep(1)
+            launcher.logger.error('Supervisor died, stopping.')
+            launcher.stop()
+        gevent.spawn(watch_parent)
     # die gracefully with SIGINT or SIGQUIT
     sigmap = {
         val: name
@@ -303,6 +537,51 @@ def serve(listen, verbosity=1, debug_port=0, **ssl_args):
     launcher.run()
 
 
+def serve_relay(path, parent_pid=None):
+    """Run the host's only LISTEN connection, relaying to local workers."""
+    import django
+    django.setup()
+    from django.db import connection
+    from dddp.relay import RelayGreenlet
+    relay = RelayGreenlet(connection, path)
+    for signum in [signal.SIGINT, signal.SIGQUIT]:
+        gevent.signal(signum, relay.stop)
+    relay.start()
+    while not relay.ready():
+        if parent_pid is not None and os.getppid() != parent_pid:
+            relay.stop()  # supervisor went away.
+        gevent.wait([relay], timeout=1)
+    relay.get()
+
+
+def serve_workers(workers, listen, debug_port=0, **kwargs):
+    """Serve from `workers` processes sharing the same listen sockets."""
+    import shutil
+    import tempfile
+    sockets = [listen_socket(listen_addr) for listen_addr in listen]
+    relay_dir = tempfile.mkdtemp(prefix='dddp-')
+    relay_path = os.path.join(relay_dir, 'relay.sock')
+
+    def relay(_):
+        """Run LISTEN relay in its own process."""
+        serve_relay(relay_path, parent_pid=supervisor.pid)
+
+    def worker(slot):
+        """Run DDP service in a worker process."""
+        serve(
+            sockets,
+            debug_port=debug_port and debug_port + slot,
+            parent_pid=supervisor.pid,
+            relay_path=relay_path,
+            **kwargs
+        )
+    supervisor = Supervisor(workers, worker, relay=relay)
+    try:
+        supervisor.run()
+    finally:
+        shutil.rmtree(relay_dir, ignore_errors=True)
+
+
 def main():
     """Main entry point for `dddp` command."""
     parser = argparse.ArgumentParser(description=__doc__)
@@ -326,6 +605,11 @@ def main():
         'listen', metavar='address[:port]', nargs='*', type=addr,
         help='Listening address for HTTP(s) server.',
     )
+    http.add_argument(
+        '--workers', '-w', metavar='N', dest='workers', type=int, default=1,
+        help='Number of worker processes sharing the listen sockets, '
+        'SIGHUP reloads all workers gracefully [1].',
+    )
     ssl = parser.add_argument_group('SSL Options')
     ssl.add_argument('--ssl-version', metavar='SSL_VERSION', dest='ssl_version',
                      help="SSL version to use (see stdlib ssl module's) [3]",
@@ -341,7 +625,11 @@ def main():
     namespace = parser.parse_args()
     if namespace.settings:
         os.environ['DJANGO_SETTINGS_MODULE'] = namespace.settings
-    serve(
+    if namespace.workers > 1:
+        run = functools.partial(serve_workers, namespace.workers)
+    else:
+        run = serve
+    run(
         namespace.listen or [Addr('localhost', 8000)],
         debug_port=namespace.debug_port,
         keyfile=namespace.keyfile,
@@ -0,0 +1,64 @@
+"""Django DDP management command to fill empty AleaIdField values."""
+
+from __future__ import absolute_import
+
+import functools
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from dddp.migrations import backfill_alea_ids, print_progress
+
+
+class Command(BaseCommand):
+
+    """Fill empty AleaIdField values in batches, committing each batch."""
+
+    help = (
+        'Fill empty AleaIdField values of the given models in batches, each '
+        'committed as it completes.  Safe to interrupt and run again.'
+    )
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            'models', metavar='app_label.ModelName', nargs='+',
+            help='Models to backfill.',
+        )
+        parser.add_argument(
+            '--field', default='aid',
+            help='Name of the AleaIdField to fill (default: aid).',
+        )
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=10000,
+            help='Rows updated per transaction (default: 10000).',
+        )
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database to backfill (default: "%s").' % DEFAULT_DB_ALIAS,
+        )
+
+    def handle(self, *args, **options):
+        """Backfill each model in turn."""
+        verbosity = options['verbosity']
+        report = functools.partial(
+            print_progress, stdout=self.stdout, verbosity=verbosity,
+        )
+        for label in options['models']:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as err:
+                raise CommandError(err)
+            try:
+                done = backfill_alea_ids(
+                    model, options['field'],
+                    using=options['database'],
+                    batch_size=options['batch_size'],
+                    report=report,
+                )
+            except FieldDoesNotExist as err:
+                raise CommandError(err)
+            if verbosity:
+                self.stdout.write('%s: backfilled %d rows.' % (label, done))
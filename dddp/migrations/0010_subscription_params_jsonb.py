@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import dddp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dddp', '0009_auto_20150812_0856'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='params',
+            field=dddp.models.EJSONField(default=list),
+        ),
+        migrations.RunSQL(
+            sql='UPDATE dddp_subscription SET params = params_ejson::jsonb',
+            reverse_sql='UPDATE dddp_subscription '
+                        'SET params_ejson = params::text',
+        ),
+        migrations.RemoveField(
+            model_name='subscription',
+            name='params_ejson',
+        ),
+        migrations.RunSQL(
+            sql='CREATE INDEX dddp_subscription_params_gin '
+                'ON dddp_subscription USING GIN (params jsonb_path_ops)',
+            reverse_sql='DROP INDEX dddp_subscription_params_gin',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dddp', '0010_subscription_params_jsonb'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Heartbeat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('server_addr', models.CharField(unique=True, max_length=255)),
+                ('last_seen', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='connection',
+            name='server_addr',
+            field=models.CharField(max_length=255, db_index=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dddp', '0011_heartbeat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(db_index=True)),
+                ('payload', models.TextField()),
+            ],
+        ),
+        migrations.RunSQL(
+            # every change gets a row, don't run out of IDs.
+            sql='ALTER TABLE dddp_changelog ALTER COLUMN id TYPE bigint',
+            reverse_sql='ALTER TABLE dddp_changelog '
+                        'ALTER COLUMN id TYPE integer',
+        ),
+    ]
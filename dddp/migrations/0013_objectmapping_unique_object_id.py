@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dddp', '0012_changelog'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            # concurrent lookups may have mapped the same object twice, keep
+            # the first mapping created.
+            sql='DELETE FROM dddp_objectmapping AS dupe '
+                'USING dddp_objectmapping AS first '
+                'WHERE dupe.content_type_id = first.content_type_id '
+                'AND dupe.object_id = first.object_id '
+                'AND dupe.id > first.id',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name='objectmapping',
+            unique_together=set([('content_type', 'meteor_id'), ('content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='objectmapping',
+            index_together=set([('content_type', 'meteor_id')]),
+        ),
+    ]
@@ -1,7 +1,15 @@
+from __future__ import absolute_import, division, print_function
+
 import functools
-from django.db import migrations
+import sys
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, migrations, transaction
 from django.db.migrations.operations.base import Operation
-from dddp.models import AleaIdField, get_meteor_id
+from django.db.models import Q, signals
+from dddp import meteor_random_ids
+from dddp.models import AleaIdField, ObjectMapping
 
 
 class TruncateOperation(Operation):
@@ -40,20 +48,185 @@ class TruncateOperation(Operation):
         return "Truncate tables"
 
 
-def set_default_forwards(app_name, operation, apps, schema_editor):
-    """Set default value for AleaIdField."""
-    model = apps.get_model(app_name, operation.model_name)
-    for obj_pk in model.objects.values_list('pk', flat=True):
-        model.objects.filter(pk=obj_pk).update(**{
-            operation.name: get_meteor_id(model, obj_pk),
-        })
+# where the running `migrate` command writes its output, and how verbosely.
+MIGRATE_OUTPUT = {'stdout': None, 'verbosity': 1}
+
+
+def on_pre_migrate(sender, **kwargs):
+    """Note `migrate` output options for BackfillAleaIdField progress."""
+    del sender
+    MIGRATE_OUTPUT.update(
+        # pre_migrate doesn't pass stdout in older Django releases.
+        stdout=kwargs.get('stdout', None),
+        verbosity=kwargs.get('verbosity', 1),
+    )
+signals.pre_migrate.connect(on_pre_migrate, dispatch_uid='dddp.migrations')
+
+
+def print_progress(
+        model, name, done, total, elapsed, stdout=None, verbosity=1,
+):
+    """Report progress of backfill_alea_ids on stdout (if verbosity > 0)."""
+    if verbosity < 1:
+        return
+    if stdout is None:
+        stdout = sys.stdout
+    # Django model._meta is public API -> pylint: disable=W0212
+    stdout.write(
+        '\n  Backfilled %s.%s.%s: %d/%d rows (%.1f%%), %.0f rows/s' % (
+            model._meta.app_label,
+            model._meta.model_name,
+            name,
+            done,
+            total,
+            100.0 * done / max(total, 1),
+            done / max(elapsed, 0.001),
+        ),
+    )
+    stdout.flush()
+
+
+def backfill_alea_ids(
+        model, name, using='default', batch_size=10000, report=print_progress,
+):
+    """
+    Fill empty AleaIdField `name` of model in batches, return rows updated.
+
+    Rows are taken in primary key order, each batch is one `UPDATE ... FROM
+    (VALUES ...)` in its own transaction so it is committed straight away
+    (unless already inside a transaction, such as an atomic migration).  Rows
+    that already have a value are skipped, so an interrupted backfill picks up
+    where it left off when run again.  Meteor IDs already handed out through
+    ObjectMapping are kept, new ones are generated in bulk.
+
+    Works with historical models in migrations and with regular models (eg:
+    via `manage.py backfill_alea_ids`, to backfill before migrating).
+    """
+    # Django model._meta is public API -> pylint: disable=W0212
+    meta = model._meta
+    field = meta.get_field(name)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    pk_type = meta.pk.db_type(connection)
+    pk_type = {
+        'serial': 'integer', 'bigserial': 'bigint',
+    }.get(pk_type, pk_type)
+    empty = Q(**{'%s__isnull' % name: True}) | Q(**{name: ''})
+    content_type = ContentType.objects.db_manager(using).get_for_model(model)
+    seed = '/collection/%s' % meta
+    total = model._default_manager.using(using).filter(empty).count()
+    done = 0
+    start = time.time()
+    last_pk = None
+    while True:
+        with transaction.atomic(using=using):
+            query = model._default_manager.using(using).filter(empty)
+            if last_pk is not None:
+                query = query.filter(pk__gt=last_pk)
+            object_ids = list(
+                query.order_by('pk').values_list(
+                    'pk', flat=True,
+                )[:batch_size],
+            )
+            if not object_ids:
+                break
+            last_pk = object_ids[-1]
+            meteor_ids = dict(ObjectMapping.objects.using(using).filter(
+                content_type=content_type,
+                object_id__in=[str(obj_pk) for obj_pk in object_ids],
+            ).values_list('object_id', 'meteor_id'))
+            new_ids = iter(meteor_random_ids(
+                seed, len(object_ids) - len(meteor_ids), field.max_length,
+            ))
+            params = []
+            for obj_pk in object_ids:
+                params.extend([
+                    obj_pk, meteor_ids.get(str(obj_pk)) or next(new_ids),
+                ])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'UPDATE {table} AS obj SET {column} = new.aid '
+                    'FROM (VALUES {values}) AS new (pk, aid) '
+                    'WHERE obj.{pk} = new.pk '
+                    # don't clobber values set since we looked.
+                    "AND (obj.{column} IS NULL OR obj.{column} = '')".format(
+                        table=quote_name(meta.db_table),
+                        column=quote_name(field.column),
+                        pk=quote_name(meta.pk.column),
+                        values=', '.join(
+                            ['(%%s::%s, %%s)' % pk_type] * len(object_ids),
+                        ),
+                    ),
+                    params,
+                )
+                done += cursor.rowcount
+        if report is not None:
+            report(model, name, done, total, time.time() - start)
+    return done
+
+
+class BackfillAleaIdField(Operation):
+
+    """
+    Fill empty AleaIdField values in batches (see `backfill_alea_ids`).
+
+    Batches are only committed as they go when the migration isn't atomic
+    (`atomic = False` on the Migration, Django 1.10+), otherwise run
+    `manage.py backfill_alea_ids` first so this finds nothing left to do.
+    Reversing copies the values into ObjectMapping so objects keep their
+    meteor IDs.
+    """
+
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, name, batch_size=10000):
+        """Accept model and field names to backfill."""
+        self.model_name = model_name
+        self.name = name
+        self.batch_size = batch_size
+
+    def state_forwards(self, app_label, state):
+        """Mutate state to match schema changes."""
+        pass  # Backfill doesn't change schema.
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        """Use schema_editor to apply any forward changes."""
+        backfill_alea_ids(
+            model=from_state.apps.get_model(app_label, self.model_name),
+            name=self.name,
+            using=schema_editor.connection.alias,
+            batch_size=self.batch_size,
+            report=functools.partial(print_progress, **MIGRATE_OUTPUT),
+        )
 
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        """Use schema_editor to apply any reverse changes."""
+        model = to_state.apps.get_model(app_label, self.model_name)
+        # Django model._meta is public API -> pylint: disable=W0212
+        meta = model._meta
+        column = meta.get_field(self.name).column
+        quote_name = schema_editor.connection.ops.quote_name
+        content_type = ContentType.objects.db_manager(
+            schema_editor.connection.alias,
+        ).get_for_model(model)
+        schema_editor.execute(
+            'INSERT INTO {mapping} (content_type_id, object_id, meteor_id) '
+            'SELECT %s, {pk}::text, {column} FROM {table} '
+            "WHERE {column} IS NOT NULL AND {column} <> '' "
+            'ON CONFLICT DO NOTHING'.format(
+                # Django model._meta is public API -> pylint: disable=W0212
+                mapping=quote_name(ObjectMapping._meta.db_table),
+                pk=quote_name(meta.pk.column),
+                column=quote_name(column),
+                table=quote_name(meta.db_table),
+            ),
+            [content_type.pk],
+        )
 
-def set_default_reverse(app_name, operation, apps, schema_editor):
-    """Unset default value for AleaIdField."""
-    model = apps.get_model(app_name, operation.model_name)
-    for obj_pk in model.objects.values_list('pk', flat=True):
-        get_meteor_id(model, obj_pk)
+    def describe(self):
+        """Describe what the operation does in console output."""
+        return 'Backfill %s.%s' % (self.model_name, self.name)
 
 
 class DefaultAleaIdOperations(object):
@@ -73,13 +246,6 @@ class DefaultAleaIdOperations(object):
             if operation.field.null:
                 continue
             default_operations.append(
-                migrations.RunPython(
-                    code=functools.partial(
-                        set_default_forwards, self.app_name, operation,
-                    ),
-                    reverse_code=functools.partial(
-                        set_default_reverse, self.app_name, operation,
-                    ),
-                )
+                BackfillAleaIdField(operation.model_name, operation.name),
             )
         return default_operations + operations
@@ -2,9 +2,11 @@
 from __future__ import absolute_import
 
 import collections
+import functools
+import json
 import os
 
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.db.models.fields import NOT_PROVIDED
 from django.conf import settings
 from django.contrib.contenttypes.fields import (
@@ -14,7 +16,87 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.encoding import python_2_unicode_compatible
 import ejson
-from dddp import meteor_random_id
+import six
+from dddp import meteor_random_id, meteor_random_ids, prepared
+from dddp.idcache import ID_CACHE
+
+
+# create ObjectMappings as published objects are created (in post_save), so
+# looking up meteor IDs never has to write.
+EAGER_OBJECT_MAPPINGS = getattr(settings, 'DDP_EAGER_OBJECT_MAPPINGS', False)
+
+
+IdStrategy = collections.namedtuple(
+    'IdStrategy', ['alea_pk', 'alea_field', 'object_mapping'],
+)
+
+
+class MeteorIdResolver(object):
+
+    """
+    Per-model strategy for mapping object IDs to meteor IDs and back.
+
+    Either the primary key is an AleaIdField (`alea_pk`), there is a single
+    unique AleaIdField holding the meteor ID (`alea_field`), or meteor IDs are
+    kept in ObjectMapping.  When `alea_field` is nullable, objects without a
+    value fall back to ObjectMapping, so `object_mapping` is also set.
+
+    Strategies are worked out for all installed models when the app registry
+    is ready, and for any other model the first time it is seen.
+    """
+
+    def __init__(self):
+        """Start without any strategies."""
+        self._strategies = {}
+
+    def populate(self, all_models):
+        """Work out strategies for all_models."""
+        for model in all_models:
+            self._strategies[model] = self.build(model)
+
+    @staticmethod
+    def build(model):
+        """Return IdStrategy for model by inspecting its fields."""
+        # Django model._meta is now public API -> pylint: disable=W0212
+        meta = model._meta
+        if isinstance(meta.pk, AleaIdField):
+            return IdStrategy(True, None, False)
+        alea_unique_fields = [
+            field
+            for field in meta.local_fields
+            if isinstance(field, AleaIdField) and field.unique
+        ]
+        if len(alea_unique_fields) == 1:
+            field = alea_unique_fields[0]
+            return IdStrategy(False, field, field.null)
+        return IdStrategy(False, None, True)
+
+    def strategy(self, model):
+        """Return IdStrategy for model."""
+        try:
+            return self._strategies[model]
+        except KeyError:
+            strategy = self._strategies[model] = self.build(model)
+            return strategy
+
+
+ID_RESOLVER = MeteorIdResolver()
+
+
+def cache_mappings(content_type_id, pairs):
+    """Cache (object_id, meteor_id) pairs once they are known committed."""
+    # mappings read inside a transaction may have been created by it, so
+    # wait until it commits - a rollback must not leave stale entries.
+    callback = functools.partial(ID_CACHE.update, content_type_id, pairs)
+    using = router.db_for_write(ObjectMapping)
+    try:
+        on_commit = transaction.on_commit
+    except AttributeError:
+        # Django < 1.9 has no commit hooks, only cache outside transactions.
+        if not transaction.get_connection(using).in_atomic_block:
+            callback()
+    else:
+        on_commit(callback, using=using)
 
 
 def get_meteor_id(obj_or_model, obj_pk=None):
@@ -27,23 +109,22 @@ def get_meteor_id(obj_or_model, obj_pk=None):
     if model is ObjectMapping:
         # this doesn't make sense - raise TypeError
         raise TypeError("Can't map ObjectMapping instances through self.")
+    strategy = ID_RESOLVER.strategy(model)
 
     # try getting value of AleaIdField straight from instance if possible
     if isinstance(obj_or_model, model):
         # obj_or_model is an instance, not a model.
-        if isinstance(meta.pk, AleaIdField):
+        if strategy.alea_pk:
             return obj_or_model.pk
         if obj_pk is None:
             # fall back to primary key, but coerce as string type for lookup.
             obj_pk = str(obj_or_model.pk)
-    alea_unique_fields = [
-        field
-        for field in meta.local_fields
-        if isinstance(field, AleaIdField) and field.unique
-    ]
-    if len(alea_unique_fields) == 1:
+    elif strategy.alea_pk:
+        # primary_key is an AleaIdField, use it.
+        return obj_pk
+    if strategy.alea_field is not None:
         # found an AleaIdField with unique=True, assume it's got the value.
-        aid = alea_unique_fields[0].attname
+        aid = strategy.alea_field.attname
         if isinstance(obj_or_model, model):
             val = getattr(obj_or_model, aid)
         elif obj_pk is None:
@@ -61,54 +142,122 @@ def get_meteor_id(obj_or_model, obj_pk=None):
 
     # fallback to using AleaIdField from ObjectMapping model.
     content_type = ContentType.objects.get_for_model(model)
+    meteor_id = ID_CACHE.get_meteor_id(content_type.pk, obj_pk)
+    if meteor_id is not None:
+        return meteor_id
     try:
-        return ObjectMapping.objects.values_list(
-            'meteor_id', flat=True,
-        ).get(
-            content_type=content_type,
-            object_id=obj_pk,
+        meteor_id = prepared.get_value(
+            ObjectMapping.objects.filter(
+                content_type=content_type,
+                object_id=obj_pk,
+            ).values_list('meteor_id', flat=True),
         )
+        cache_mappings(content_type.pk, [(obj_pk, meteor_id)])
+        return meteor_id
     except ObjectDoesNotExist:
-        return ObjectMapping.objects.create(
-            content_type=content_type,
-            object_id=obj_pk,
-            meteor_id=meteor_random_id('/collection/%s' % meta),
-        ).meteor_id
+        return create_meteor_ids(model, [obj_pk])[str(obj_pk)]
 get_meteor_id.short_description = 'DDP ID'  # nice title for admin list_display
 
 
-def get_meteor_ids(model, object_ids):
-    """Return Alea ID mapping for all given ids of specified model."""
+def create_meteor_ids(model, object_ids):
+    """
+    Create ObjectMappings for given ids of model, return Alea ID mapping.
+
+    Mappings are inserted in one statement, skipping any that already exist
+    (eg: created concurrently by another process), which are then read back.
+    """
     # Django model._meta is now public API -> pylint: disable=W0212
     meta = model._meta
+    object_ids = list(collections.OrderedDict(
+        (str(obj_pk), None)
+        for obj_pk
+        in object_ids
+    ))
+    if not object_ids:
+        return {}
+    content_type = ContentType.objects.get_for_model(model)
+    using = router.db_for_write(ObjectMapping)
+    quote_name = connections[using].ops.quote_name
+    opts = ObjectMapping._meta
+    columns = [
+        quote_name(opts.get_field(name).column)
+        for name in ('content_type', 'object_id', 'meteor_id')
+    ]
+    params = []
+    for obj_pk, meteor_id in zip(
+            object_ids,
+            meteor_random_ids('/collection/%s' % meta, len(object_ids)),
+    ):
+        params.extend([content_type.pk, obj_pk, meteor_id])
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING '
+            'RETURNING %s, %s' % (
+                quote_name(opts.db_table),
+                ', '.join(columns),
+                ', '.join(['(%s, %s, %s)'] * len(object_ids)),
+                columns[1],
+                columns[2],
+            ),
+            params,
+        )
+        result = dict(cursor.fetchall())
+    existing = [obj_pk for obj_pk in object_ids if obj_pk not in result]
+    if existing:
+        query = list(ObjectMapping.objects.using(using).filter(
+            content_type=content_type,
+            object_id__in=existing,
+        ).values_list('object_id', 'meteor_id'))
+        cache_mappings(content_type.pk, query)
+        result.update(query)
+    missing = [obj_pk for obj_pk in object_ids if obj_pk not in result]
+    if missing:
+        # generated meteor_id was already taken, try again with new ones.
+        result.update(create_meteor_ids(model, missing))
+    return result
+
+
+def get_meteor_ids(model, object_ids):
+    """Return Alea ID mapping for all given ids of specified model."""
+    strategy = ID_RESOLVER.strategy(model)
     result = collections.OrderedDict(
         (str(obj_pk), None)
         for obj_pk
         in object_ids
     )
-    if isinstance(meta.pk, AleaIdField):
+    if strategy.alea_pk:
         # primary_key is an AleaIdField, use it.
         return collections.OrderedDict(
             (obj_pk, obj_pk) for obj_pk in object_ids
         )
-    alea_unique_fields = [
-        field
-        for field in meta.local_fields
-        if isinstance(field, AleaIdField) and field.unique and not field.null
-    ]
-    if len(alea_unique_fields) == 1:
-        aid = alea_unique_fields[0].name
-        query = model.objects.filter(
-            pk__in=object_ids,
-        ).values_list('pk', aid)
-    else:
+    if strategy.alea_field is not None:
+        for obj_pk, meteor_id in model.objects.filter(
+                pk__in=object_ids,
+        ).values_list('pk', strategy.alea_field.name):
+            if meteor_id or not strategy.object_mapping:
+                result[str(obj_pk)] = meteor_id
+    if strategy.object_mapping:
+        # only objects without an AleaIdField value (if any) need mappings.
         content_type = ContentType.objects.get_for_model(model)
-        query = ObjectMapping.objects.filter(
+        unmapped = [
+            obj_pk for obj_pk, meteor_id in result.items()
+            if meteor_id is None
+        ]
+        for obj_pk in unmapped:
+            result[obj_pk] = ID_CACHE.get_meteor_id(content_type.pk, obj_pk)
+        query = list(ObjectMapping.objects.filter(
             content_type=content_type,
-            object_id__in=list(result)
-        ).values_list('object_id', 'meteor_id')
-    for obj_pk, meteor_id in query:
-        result[str(obj_pk)] = meteor_id
+            object_id__in=[
+                obj_pk for obj_pk in unmapped
+                if result[obj_pk] is None
+            ],
+        ).values_list('object_id', 'meteor_id'))
+        cache_mappings(content_type.pk, query)
+        result.update(query)
+        result.update(create_meteor_ids(model, [
+            obj_pk for obj_pk in unmapped
+            if result[obj_pk] is None
+        ]))
     for obj_pk, meteor_id in result.items():
         if meteor_id is None:
             result[obj_pk] = get_meteor_id(model, obj_pk)
@@ -119,37 +268,37 @@ def get_object_id(model, meteor_id):
     """Return an object ID for the given meteor_id."""
     if meteor_id is None:
         return None
-    # Django model._meta is now public API -> pylint: disable=W0212
-    meta = model._meta
 
     if model is ObjectMapping:
         # this doesn't make sense - raise TypeError
         raise TypeError("Can't map ObjectMapping instances through self.")
+    strategy = ID_RESOLVER.strategy(model)
 
-    if isinstance(meta.pk, AleaIdField):
+    if strategy.alea_pk:
         # meteor_id is the primary key
         return meteor_id
 
-    alea_unique_fields = [
-        field
-        for field in meta.local_fields
-        if isinstance(field, AleaIdField) and field.unique
-    ]
-    if len(alea_unique_fields) == 1:
+    if strategy.alea_field is not None:
         # found an AleaIdField with unique=True, assume it's got the value.
         val = model.objects.values_list(
             'pk', flat=True,
         ).get(**{
-            alea_unique_fields[0].attname: meteor_id,
+            strategy.alea_field.attname: meteor_id,
         })
         if val:
             return val
 
     content_type = ContentType.objects.get_for_model(model)
-    return ObjectMapping.objects.filter(
-        content_type=content_type,
-        meteor_id=meteor_id,
-    ).values_list('object_id', flat=True).get()
+    object_id = ID_CACHE.get_object_id(content_type.pk, meteor_id)
+    if object_id is None:
+        object_id = prepared.get_value(
+            ObjectMapping.objects.filter(
+                content_type=content_type,
+                meteor_id=meteor_id,
+            ).values_list('object_id', flat=True),
+        )
+        cache_mappings(content_type.pk, [(object_id, meteor_id)])
+    return object_id
 
 
 def get_object_ids(model, meteor_ids):
@@ -157,29 +306,37 @@ def get_object_ids(model, meteor_ids):
     if model is ObjectMapping:
         # this doesn't make sense - raise TypeError
         raise TypeError("Can't map ObjectMapping instances through self.")
-    # Django model._meta is now public API -> pylint: disable=W0212
-    meta = model._meta
-    alea_unique_fields = [
-        field
-        for field in meta.local_fields
-        if isinstance(field, AleaIdField) and field.unique and not field.null
-    ]
+    strategy = ID_RESOLVER.strategy(model)
     result = collections.OrderedDict(
         (str(meteor_id), None)
         for meteor_id
         in meteor_ids
     )
-    if len(alea_unique_fields) == 1:
-        aid = alea_unique_fields[0].name
+    if not strategy.object_mapping:
+        if strategy.alea_pk:
+            # Django model._meta is now public API -> pylint: disable=W0212
+            aid = model._meta.pk.name
+        else:
+            aid = strategy.alea_field.name
         query = model.objects.filter(**{
             '%s__in' % aid: meteor_ids,
         }).values_list(aid, 'pk')
     else:
         content_type = ContentType.objects.get_for_model(model)
-        query = ObjectMapping.objects.filter(
-                content_type=content_type,
-                meteor_id__in=meteor_ids,
-        ).values_list('meteor_id', 'object_id')
+        for meteor_id in result:
+            result[meteor_id] = ID_CACHE.get_object_id(
+                content_type.pk, meteor_id,
+            )
+        query = list(ObjectMapping.objects.filter(
+            content_type=content_type,
+            meteor_id__in=[
+                meteor_id for meteor_id, object_id in result.items()
+                if object_id is None
+            ],
+        ).values_list('meteor_id', 'object_id'))
+        cache_mappings(content_type.pk, [
+            (object_id, meteor_id) for meteor_id, object_id in query
+        ])
     for meteor_id, object_id in query:
         result[meteor_id] = object_id
     return result
@@ -187,20 +344,14 @@ def get_object_ids(model, meteor_ids):
 
 def get_object(model, meteor_id, *args, **kwargs):
     """Return an object for the given meteor_id."""
-    # Django model._meta is now public API -> pylint: disable=W0212
-    meta = model._meta
-    if isinstance(meta.pk, AleaIdField):
+    strategy = ID_RESOLVER.strategy(model)
+    if strategy.alea_pk:
         # meteor_id is the primary key
         return model.objects.filter(*args, **kwargs).get(pk=meteor_id)
 
-    alea_unique_fields = [
-        field
-        for field in meta.local_fields
-        if isinstance(field, AleaIdField) and field.unique and not field.null
-    ]
-    if len(alea_unique_fields) == 1:
+    if not strategy.object_mapping:
         return model.objects.filter(*args, **kwargs).get(**{
-            alea_unique_fields[0].name: meteor_id,
+            strategy.alea_field.name: meteor_id,
         })
 
     return model.objects.filter(*args, **kwargs).get(
@@ -248,6 +399,65 @@ class AleaIdField(models.CharField):
         return value
 
 
+class EJSONField(models.Field):
+
+    """Field storing EJSON values in a PostgreSQL `jsonb` column."""
+
+    empty_strings_allowed = False
+    description = 'EJSON value (stored as jsonb)'
+
+    def db_type(self, connection):
+        """Use PostgreSQL native `jsonb` type."""
+        return 'jsonb'
+
+    def select_format(self, compiler, sql, params):
+        """Select `jsonb` as text so psycopg2 leaves decoding to us."""
+        return '%s::text' % sql, params
+
+    def from_db_value(self, value, expression, connection, context):
+        """Decode EJSON once as the value is loaded from the database."""
+        if value is None:
+            return value
+        if not isinstance(value, six.string_types):
+            # not selected through select_format (eg: hand written SQL), so
+            # psycopg2 already decoded the `jsonb` value as plain JSON.
+            value = json.dumps(value)
+        return ejson.loads(value)
+
+    def get_prep_value(self, value):
+        """Encode value as EJSON text for the database."""
+        if value is None:
+            return None
+        return ejson.dumps(value)
+
+    def value_to_string(self, obj):
+        """Serialize value as EJSON text."""
+        return ejson.dumps(self.value_from_object(obj))
+
+
+class EJSONContains(models.Lookup):
+
+    """
+    JSONB containment lookup (`@>`) for EJSONField.
+
+    Usage: `Subscription.objects.filter(params__contains=['foo'])`
+    """
+
+    lookup_name = 'contains'
+
+    def get_prep_lookup(self):
+        """Encode lookup value as EJSON."""
+        return ejson.dumps(self.rhs)
+
+    def as_sql(self, compiler, connection):
+        """Generate SQL for containment test using GIN indexable operator."""
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        return '%s @> %%s::jsonb' % lhs, list(lhs_params) + [self.rhs]
+
+
+EJSONField.register_lookup(EJSONContains)
+
+
 # Please don't hate me...
 AID_KWARGS = {}
 
@@ -290,20 +500,46 @@ class ObjectMapping(models.Model):
 
         unique_together = [
             ['content_type', 'meteor_id'],
+            ['content_type', 'object_id'],
         ]
         index_together = [
-            ['content_type', 'object_id'],
             ['content_type', 'meteor_id'],
         ]
 
 
+@python_2_unicode_compatible
+class Heartbeat(models.Model):
+
+    """Liveness of a DDP server process, identified by its `server_addr`."""
+
+    server_addr = models.CharField(max_length=255, unique=True)
+    last_seen = models.DateTimeField()
+
+    def __str__(self):
+        """Text representation of heartbeat."""
+        return '%s@%s' % (self.server_addr, self.last_seen)
+
+
+@python_2_unicode_compatible
+class ChangeLog(models.Model):
+
+    """Recently sent change, replayed by servers that missed the NOTIFY."""
+
+    created = models.DateTimeField(db_index=True)
+    payload = models.TextField()
+
+    def __str__(self):
+        """Text representation of change."""
+        return '#%s@%s' % (self.pk, self.created)
+
+
 @python_2_unicode_compatible
 class Connection(models.Model, object):
 
     """Django DDP connection instance."""
 
     connection_id = AleaIdField()
-    server_addr = models.CharField(max_length=255)
+    server_addr = models.CharField(max_length=255, db_index=True)
     remote_addr = models.CharField(max_length=255)
     version = models.CharField(max_length=255)
 
@@ -325,7 +561,7 @@ class Subscription(models.Model, object):
     sub_id = models.CharField(max_length=17)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
     publication = models.CharField(max_length=255)
-    params_ejson = models.TextField(default='{}')
+    params = EJSONField(default=list)
 
     class Meta(object):
 
@@ -345,15 +581,15 @@ class Subscription(models.Model, object):
             self.params_ejson,
         )
 
-    def get_params(self):
-        """Get params dict."""
-        return ejson.loads(self.params_ejson or '{}')
+    def get_params_ejson(self):
+        """Get params as EJSON text."""
+        return ejson.dumps(self.params)
 
-    def set_params(self, vals):
-        """Set params dict."""
-        self.params_ejson = ejson.dumps(vals or {})
+    def set_params_ejson(self, val):
+        """Set params from EJSON text."""
+        self.params = ejson.loads(val or '[]')
 
-    params = property(get_params, set_params)
+    params_ejson = property(get_params_ejson, set_params_ejson)
 
 
 @python_2_unicode_compatible
@@ -10,12 +10,171 @@ import os
 import psycopg2  # green
 import psycopg2.extensions
 import socket
+import time
 
+from django.conf import settings
+from django.db import DatabaseError
 
-class PostgresGreenlet(gevent.Greenlet):
+from dddp import changelog
+
+
+# (idle, interval, count) TCP keepalive settings for the LISTEN connection.
+LISTEN_KEEPALIVE = getattr(settings, 'DDP_LISTEN_KEEPALIVE', (30, 10, 3))
+
+
+def deliver(connections, data):
+    """Send change `data` to those `connections` it is addressed to."""
+    sender = data.pop('_sender', None)
+    tx_id = data.pop('_tx_id', None)
+    data.pop('_change_id', None)
+    for connection_id in data.pop('_connection_ids'):
+        try:
+            websocket = connections[connection_id]
+        except KeyError:
+            continue  # connection not in this process
+        if connection_id == sender:
+            websocket.send(data, tx_id=tx_id)
+        else:
+            websocket.coalesce(data)
+
+
+def resync(connections):
+    """Resend all subscriptions of websocket `connections`."""
+    for websocket in list(connections.values()):
+        websocket.request_resync()
+
+
+def keepalive(conn_params):
+    """Set TCP keepalive `conn_params` for a LISTEN connection (if unset)."""
+    # notice dead connections (eg: dropped by the network) promptly.
+    for key, val in zip(
+            ['keepalives_idle', 'keepalives_interval', 'keepalives_count'],
+            LISTEN_KEEPALIVE,
+    ):
+        conn_params.setdefault(key, val)
+    conn_params.setdefault('keepalives', 1)
+    return conn_params
+
+
+def reassemble(chunks, payload):
+    """
+    Add NOTIFY `payload` chunk to `chunks`, return data once all have arrived.
+
+    >>> chunks = {}
+    >>> reassemble(chunks, '{"uuid": "x", "seq": 2, "fin": 1}|2]')
+    >>> reassemble(chunks, '{"uuid": "x", "seq": 1, "fin": 0}|[1, ')
+    [1, 2]
+    >>> chunks
+    {}
+    """
+    # read the header and check seq/fin.
+    hdr, chunk = payload.split('|', 1)
+    header = ejson.loads(hdr)
+    uuid = header['uuid']
+    size, parts = chunks.setdefault(uuid, [0, {}])
+    if header['fin']:
+        size = chunks[uuid][0] = header['seq']
+
+    # stash the chunk
+    parts[header['seq']] = chunk
+
+    if len(parts) != size:
+        # haven't got all the chunks yet
+        return None
+
+    # got the last chunk -> decode it.
+    data = ''.join(
+        chunk for _, chunk in sorted(parts.items())
+    )
+    del chunks[uuid]  # don't forget to cleanup!
+    return ejson.loads(data)
+
+
+class ChangeReceiver(object):
+
+    """
+    Deliver changes received via LISTEN to local websocket connections.
+
+    Subclasses provide `logger`, `connections` (connection_id: websocket),
+    `delivered` (initially None) and `lost_at` (time the LISTEN connection
+    was lost, or None).
+    """
+
+    def recover(self):
+        """Catch up on (or resync after) changes missed while not listening."""
+        if changelog.CHANGE_LOG:
+            self.catch_up()
+        elif self.lost_at is not None:
+            # no log to replay changes missed while disconnected from.
+            self.resync()
+            self.lost_at = None
+
+    def catch_up(self):
+        """Replay changes missed while disconnected, or resync everything."""
+        from django.db import connection
+        try:
+            if self.delivered is None:
+                # first connection, nothing missed yet.
+                self.delivered = changelog.DeliveredChanges(
+                    baseline=changelog.max_change_id(),
+                )
+                return
+            if self.lost_at is None:
+                return
+            changes = None
+            since = self.lost_at - changelog.CHANGE_LOG_REPLAY_SLACK
+            if time.time() - since < changelog.CHANGE_LOG_RETENTION:
+                changes = changelog.changes_since(
+                    self.delivered.replay_from(since),
+                )
+            if changes is None:
+                self.logger.warning(
+                    'Missed too many changes since %s, resyncing.',
+                    time.ctime(self.lost_at),
+                )
+                self.resync()
+            else:
+                self.logger.info(
+                    'Replaying %d changes since %s.',
+                    len(changes), time.ctime(self.lost_at),
+                )
+                for data in changes:
+                    self.receive(data)
+            self.lost_at = None
+        finally:
+            # connections are greenlet (or thread) local, don't leave this one
+            # lying about.
+            connection.close()
+
+    def receive(self, data):
+        """Process change `data` unless it has already been delivered."""
+        change_id = data.pop('_change_id', None)
+        if (
+            change_id is not None
+        ) and (
+            self.delivered is not None
+        ) and (
+            not self.delivered.add(change_id)
+        ):
+            return
+        self.process(data)
+
+    def resync(self):
+        """Resend all subscriptions of local connections."""
+        resync(self.connections)
+
+    def process(self, data):
+        """Deliver decoded change `data` to local websocket connections."""
+        deliver(self.connections, data)
+
+
+class PostgresGreenlet(ChangeReceiver, gevent.Greenlet):
 
     """Greenlet for multiplexing database operations."""
 
+    # max seconds between attempts to (re)connect to the database.
+    max_retry_delay = 5.0
+
     def __init__(self, conn):
         """Prepare async connection."""
         super(PostgresGreenlet, self).__init__()
@@ -25,6 +184,9 @@ class PostgresGreenlet(gevent.Greenlet):
         # queues for processing incoming sub/unsub requests and processing
         self.connections = {}
         self.chunks = {}
+        self.delivered = None
+        # time (if any) the LISTEN connection was lost, for catching up.
+        self.lost_at = None
         self._stop_event = gevent.event.Event()
 
         # connect to DB in async mode
@@ -33,18 +195,49 @@ class PostgresGreenlet(gevent.Greenlet):
         self.select_greenlet = None
 
     def _run(self):  # pylint: disable=method-hidden
-        """Spawn sub tasks, wait for stop signal."""
+        """Listen for changes, reconnecting as needed until stopped."""
+        delay = 0.1
+        while not self._stop_event.is_set():
+            try:
+                conn = self.connect()
+            except psycopg2.OperationalError as err:
+                self.logger.warning(
+                    'LISTEN connection failed, retrying in %.1fs: %s',
+                    delay, ('%s' % err).strip(),
+                )
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = 0.1
+            try:
+                self.listen(conn)
+            except (psycopg2.Error, DatabaseError):
+                # DatabaseError from the ORM (eg: catch_up) is just as fatal
+                # to this connection, don't let it kill the greenlet.
+                self.logger.exception('Lost LISTEN connection, reconnecting.')
+                if self.lost_at is None:
+                    self.lost_at = time.time()
+                self._stop_event.wait(delay)
+            finally:
+                self.chunks.clear()  # partial messages won't be completed.
+                if not conn.closed:
+                    conn.close()
+
+    def connect(self):
+        """Open async connection to the database."""
         conn_params = self.connection.get_connection_params()
         # See http://initd.org/psycopg/docs/module.html#psycopg2.connect and
         # http://www.postgresql.org/docs/current/static/libpq-connect.html
         # section 31.1.2 (Parameter Key Words) for details on available params.
-        conn_params.update(
-            async=True,
-            application_name='{} pid={} django-ddp'.format(
+        conn_params.update({
+            # `async` is a reserved word in Python 3.7+
+            'async': True,
+            'application_name': '{} pid={} django-ddp'.format(
                 socket.gethostname(),  # hostname
                 os.getpid(),  # PID
             )[:64],  # 64 characters for default PostgreSQL build config
-        )
+        })
+        keepalive(conn_params)
         conn = None
         while conn is None:
             try:
@@ -65,12 +258,18 @@ class PostgresGreenlet(gevent.Greenlet):
                     key, conn_params.pop(key),
                 )
         self.poll(conn)  # wait for conneciton to start
+        return conn
+
+    def listen(self, conn):
+        """LISTEN on conn, processing changes until stopped."""
+        cur = conn.cursor()
+        cur.execute('LISTEN "ddp";')
+        self.poll(conn)  # wait for LISTEN to take effect
+        self.recover()
 
         import logging
         logging.getLogger('dddp').info('=> Started PostgresGreenlet.')
 
-        cur = conn.cursor()
-        cur.execute('LISTEN "ddp";')
         while not self._stop_event.is_set():
             try:
                 self.select_greenlet = gevent.spawn(
@@ -86,7 +285,6 @@ class PostgresGreenlet(gevent.Greenlet):
         self.poll(conn)
         cur.close()
         self.poll(conn)
-        conn.close()
 
     def stop(self):
         """Stop subtasks and let run() finish."""
@@ -107,40 +305,9 @@ class PostgresGreenlet(gevent.Greenlet):
                         "Got NOTIFY (pid=%d, payload=%r)",
                         notify.pid, notify.payload,
                     )
-
-                    # read the header and check seq/fin.
-                    hdr, chunk = notify.payload.split('|', 1)
-                    # print('RECEIVE: %s' % hdr)
-                    header = ejson.loads(hdr)
-                    uuid = header['uuid']
-                    size, chunks = self.chunks.setdefault(uuid, [0, {}])
-                    if header['fin']:
-                        size = self.chunks[uuid][0] = header['seq']
-
-                    # stash the chunk
-                    chunks[header['seq']] = chunk
-
-                    if len(chunks) != size:
-                        # haven't got all the chunks yet
-                        continue  # process next NOTIFY in loop
-
-                    # got the last chunk -> process it.
-                    data = ''.join(
-                        chunk for _, chunk in sorted(chunks.items())
-                    )
-                    del self.chunks[uuid]  # don't forget to cleanup!
-                    data = ejson.loads(data)
-                    sender = data.pop('_sender', None)
-                    tx_id = data.pop('_tx_id', None)
-                    for connection_id in data.pop('_connection_ids'):
-                        try:
-                            websocket = self.connections[connection_id]
-                        except KeyError:
-                            continue  # connection not in this process
-                        if connection_id == sender:
-                            websocket.send(data, tx_id=tx_id)
-                        else:
-                            websocket.send(data)
+                    data = reassemble(self.chunks, notify.payload)
+                    if data is not None:
+                        self.receive(data)
                 break
             elif state == psycopg2.extensions.POLL_WRITE:
                 gevent.select.select([], [conn.fileno()], [])
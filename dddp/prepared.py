@@ -0,0 +1,230 @@
+"""Server-side prepared statements for hot DDP queries."""
+
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import hashlib
+import itertools
+import re
+import weakref
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:  # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+# use PREPARE/EXECUTE for hot queries (disable if connecting through a pooler
+# in transaction mode such as pgbouncer, which won't keep statements around).
+PREPARED_STATEMENTS = getattr(settings, 'DDP_PREPARED_STATEMENTS', True)
+# max statements prepared on any one database connection.
+PREPARED_STATEMENTS_MAX = int(
+    getattr(settings, 'DDP_PREPARED_STATEMENTS_MAX', 200),
+)
+# process wide counters of statements prepared and executed
+PREPARED_STATS = collections.Counter()
+
+PLACEHOLDER = re.compile(r'%%|%s')
+
+# SQLSTATE classes of errors PREPARE will keep failing with: syntax error or
+# access rule violation, feature not supported.
+UNPREPARABLE_CLASSES = ('42', '0A')
+DUPLICATE_PREPARED_STATEMENT = '42P05'
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+# {raw DB connection: set(statement names)} - entries go with the connection
+# so statements are prepared again after reconnecting.
+_PREPARED = weakref.WeakKeyDictionary()
+# statements the database refused to prepare, run those as they are.
+_UNPREPARABLE = set()
+
+
+def numbered(sql):
+    """
+    Return sql with `%s` placeholders replaced by `$1`, `$2`, ...
+
+    >>> print(numbered("SELECT %s, '100%%' WHERE x = %s"))
+    SELECT $1, '100%' WHERE x = $2
+    """
+    counter = itertools.count(1)
+    return PLACEHOLDER.sub(
+        lambda match: '%' if match.group() == '%%' else '$%d' % next(counter),
+        sql,
+    )
+
+
+def sqlstate(err):
+    """Return SQLSTATE code of DatabaseError `err` (or None)."""
+    # Django wraps driver exceptions, the original is the __cause__.
+    for exc in (err, getattr(err, '__cause__', None)):
+        code = getattr(exc, 'pgcode', None)
+        if code is not None:
+            return code
+    return None
+
+
+def statement_name(sql):
+    """Return statement name for sql."""
+    return 'dddp_%s' % hashlib.md5(sql.encode('utf-8')).hexdigest()[:20]
+
+
+def prepare(using, sql):
+    """Return name of statement for sql prepared on `using` (or None)."""
+    if not PREPARED_STATEMENTS:
+        return None
+    name = statement_name(sql)
+    if name in _UNPREPARABLE:
+        return None
+    conn = connections[using]
+    conn.ensure_connection()
+    prepared = _PREPARED.setdefault(conn.connection, set())
+    if name in prepared:
+        return name
+    if len(prepared) >= PREPARED_STATEMENTS_MAX:
+        PREPARED_STATS['over_limit'] += 1
+        return None
+    try:
+        # savepoint, so a failure doesn't break any transaction in progress.
+        with transaction.atomic(using=using):
+            with conn.cursor() as cursor:
+                cursor.execute('PREPARE %s AS %s' % (name, numbered(sql)))
+    except DatabaseError as err:
+        code = sqlstate(err) or ''
+        if code == DUPLICATE_PREPARED_STATEMENT:
+            # prepared by us before losing track (eg: behind a pooler).
+            prepared.add(name)
+            return name
+        PREPARED_STATS['errors'] += 1
+        if code[:2] in UNPREPARABLE_CLASSES:
+            _UNPREPARABLE.add(name)
+        return None
+    prepared.add(name)
+    PREPARED_STATS['prepared'] += 1
+    return name
+
+
+@contextlib.contextmanager
+def recoverable(using):
+    """Let EXECUTE in the block fail without breaking the transaction."""
+    if connections[using].in_atomic_block:
+        with transaction.atomic(using=using):  # savepoint
+            yield
+    else:
+        yield  # autocommit, a failed statement doesn't affect later ones.
+
+
+def missing(using, err):
+    """
+    Return True if EXECUTE failed with `err` as the statement is gone.
+
+    Statements go with DISCARD ALL/DEALLOCATE ALL, or when a pooler switches
+    database connections - forget all those prepared on `using` then, so
+    they're prepared again next time.
+    """
+    if sqlstate(err) != INVALID_SQL_STATEMENT_NAME:
+        return False
+    PREPARED_STATS['missing'] += 1
+    _PREPARED.pop(connections[using].connection, None)
+    return True
+
+
+def execute_sql(name, num_params):
+    """Return SQL to EXECUTE named statement with num_params params."""
+    if not num_params:
+        return 'EXECUTE %s' % name
+    return 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * num_params))
+
+
+def compiled(qs):
+    """Return (sql, params) for queryset, or None if it can't match."""
+    try:
+        return qs.query.get_compiler(using=qs.db).as_sql()
+    except EmptyResultSet:
+        return None
+
+
+def values(qs):
+    """Return list of row tuples for a `values_list()` queryset."""
+    query = compiled(qs)
+    if query is None:
+        return []
+    sql, params = query
+    name = prepare(qs.db, sql)
+    if name is not None:
+        try:
+            with recoverable(qs.db):
+                with connections[qs.db].cursor() as cursor:
+                    cursor.execute(execute_sql(name, len(params)), params)
+                    PREPARED_STATS['executed'] += 1
+                    return cursor.fetchall()
+        except DatabaseError as err:
+            if not missing(qs.db, err):
+                raise
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def objects(qs):
+    """Return iterable of model instances for a plain queryset."""
+    query = compiled(qs)
+    if query is None:
+        return []
+    sql, params = query
+    name = prepare(qs.db, sql)
+    if name is None:
+        return qs
+    try:
+        with recoverable(qs.db):
+            result = list(qs.model.objects.raw(
+                execute_sql(name, len(params)), params, using=qs.db,
+            ))
+    except DatabaseError as err:
+        if not missing(qs.db, err):
+            raise
+        return qs
+    PREPARED_STATS['executed'] += 1
+    return result
+
+
+def only(qs, results):
+    """Return the one item in results (at most 2 from qs), like `get()`."""
+    if not results:
+        raise qs.model.DoesNotExist(
+            '%s matching query does not exist.' % (
+                # Django model._meta is public API -> pylint: disable=W0212
+                qs.model._meta.object_name,
+            ),
+        )
+    if len(results) > 1:
+        raise qs.model.MultipleObjectsReturned(
+            'get() returned more than one %s.' % (
+                # Django model._meta is public API -> pylint: disable=W0212
+                qs.model._meta.object_name,
+            ),
+        )
+    return results[0]
+
+
+def get(qs):
+    """Prepared equivalent of `qs.get()`."""
+    return only(qs, list(objects(qs[:2])))
+
+
+def get_value(qs):
+    """Prepared equivalent of `qs.values_list(name, flat=True).get()`."""
+    return only(qs, values(qs[:2]))[0]
+
+
+def exists(qs):
+    """Prepared equivalent of `qs.exists()`."""
+    if (
+        qs.query.group_by is not None
+    ) or (
+        getattr(qs.query, 'annotations', None)
+    ):
+        return qs.exists()  # leave aggregate queries for Django to probe.
+    return bool(values(qs.order_by().values_list('pk')[:1]))
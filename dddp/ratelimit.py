@@ -0,0 +1,146 @@
+"""Django DDP rate limiting and admission control."""
+
+from __future__ import absolute_import, division
+
+import collections
+import contextlib
+import time
+
+import gevent.lock
+from django.conf import settings
+
+from dddp import MeteorError
+
+
+# {msg: (rate, burst)} limits per connection, eg: {'sub': (5, 50)} allows
+# bursts of 50 subs, refilled at 5 per second.
+RATE_LIMITS = getattr(settings, 'DDP_RATE_LIMITS', {})
+# {msg: (rate, burst)} limits shared by all connections to this process.
+GLOBAL_RATE_LIMITS = getattr(settings, 'DDP_GLOBAL_RATE_LIMITS', {})
+# max initial subscription loads running at once (0 for unlimited).
+SUB_LOAD_CONCURRENCY = int(getattr(settings, 'DDP_SUB_LOAD_CONCURRENCY', 0))
+# max subscriptions waiting to load before new ones are rejected.
+SUB_LOAD_QUEUE = int(getattr(settings, 'DDP_SUB_LOAD_QUEUE', 100))
+# seconds a subscription may wait to load before it is rejected.
+SUB_LOAD_TIMEOUT = float(getattr(settings, 'DDP_SUB_LOAD_TIMEOUT', 10))
+# process wide counters of rejected requests
+RATE_LIMIT_STATS = collections.Counter()
+
+
+def too_many_requests(reason, wait):
+    """Return MeteorError telling the client to back off for wait seconds."""
+    # same shape as the error sent by Meteor's DDPRateLimiter.
+    return MeteorError(
+        'too-many-requests', reason, {'timeToReset': int(wait * 1000)},
+    )
+
+
+class TokenBucket(object):
+
+    """
+    Token bucket allowing `rate` requests per second, in bursts of `burst`.
+
+    >>> import functools
+    >>> clock = functools.partial(next, iter([0, 0, 0, 0, 0.5]))
+    >>> bucket = TokenBucket(rate=1, burst=2, clock=clock)
+    >>> bucket.consume(), bucket.consume(), bucket.consume()
+    (0, 0, 1.0)
+    >>> bucket.consume()
+    0.5
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        """Create full bucket."""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def consume(self, tokens=1):
+        """Take tokens, returning 0 or seconds to wait until they're there."""
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+
+def buckets(limits):
+    """Return dict of {msg: TokenBucket} for {msg: (rate, burst)} limits."""
+    return {
+        msg: TokenBucket(rate, burst)
+        for msg, (rate, burst)
+        in limits.items()
+    }
+
+
+GLOBAL_BUCKETS = buckets(GLOBAL_RATE_LIMITS)
+
+
+def rate_limit(msg, connection_buckets):
+    """Raise MeteorError if msg exceeds connection or global rate limits."""
+    for scope, bucket in (
+            ('connection', connection_buckets.get(msg, None)),
+            ('global', GLOBAL_BUCKETS.get(msg, None)),
+    ):
+        if bucket is None:
+            continue
+        wait = bucket.consume()
+        if wait:
+            RATE_LIMIT_STATS['%s_%s' % (scope, msg)] += 1
+            raise too_many_requests(
+                'Error, too many requests. Please slow down.', wait,
+            )
+
+
+class AdmissionGate(object):
+
+    """Limit concurrent operations, with a bounded queue of waiters."""
+
+    def __init__(self, name, limit, max_waiting, timeout):
+        """Create gate admitting `limit` at a time (0 for unlimited)."""
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.waiting = 0
+        self._semaphore = gevent.lock.BoundedSemaphore(max(limit, 1))
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Wait for admission (or raise MeteorError) for the block."""
+        if not self.limit:
+            yield
+            return
+        if self._semaphore.locked():
+            if self.waiting >= self.max_waiting:
+                RATE_LIMIT_STATS['%s_rejected' % self.name] += 1
+                raise too_many_requests(
+                    'Server busy, please try again later.', self.timeout,
+                )
+            self.waiting += 1
+            try:
+                admitted = self._semaphore.acquire(timeout=self.timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                RATE_LIMIT_STATS['%s_timeouts' % self.name] += 1
+                raise too_many_requests(
+                    'Server busy, please try again later.', self.timeout,
+                )
+        else:
+            self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+SUB_LOADS = AdmissionGate(
+    'sub_loads', SUB_LOAD_CONCURRENCY, SUB_LOAD_QUEUE, SUB_LOAD_TIMEOUT,
+)
@@ -0,0 +1,210 @@
+"""Django DDP server heartbeat and stale connection reaper."""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import socket
+
+import gevent
+import gevent.event
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from dddp import meteor_random_id
+from dddp.changelog import CHANGE_LOG, prune
+from dddp.models import (
+    Connection, Heartbeat, Subscription, SubscriptionCollection,
+)
+
+
+# seconds between heartbeats (and reaping of stale connections).
+HEARTBEAT_INTERVAL = float(getattr(settings, 'DDP_HEARTBEAT_INTERVAL', 15))
+# seconds without a heartbeat before a server is considered dead.
+HEARTBEAT_TIMEOUT = float(getattr(settings, 'DDP_HEARTBEAT_TIMEOUT', 60))
+
+
+# deletes subscriptions (and their collections) of `dead_connections`.
+CASCADE_SQL = """
+dead_subscriptions AS (
+    DELETE FROM {subscription}
+    WHERE connection_id IN (SELECT id FROM dead_connections)
+    RETURNING id
+), dead_collections AS (
+    DELETE FROM {collection}
+    WHERE subscription_id IN (SELECT id FROM dead_subscriptions)
+    RETURNING id
+)
+"""
+COUNTS_SQL = """
+(SELECT COUNT(*) FROM dead_connections),
+(SELECT COUNT(*) FROM dead_subscriptions),
+(SELECT COUNT(*) FROM dead_collections)
+"""
+
+
+def tables():
+    """Return dict of quoted table names used by DDP connection tracking."""
+    # Django model._meta is public API -> pylint: disable=W0212
+    quote_name = connection.ops.quote_name
+    return {
+        'heartbeat': quote_name(Heartbeat._meta.db_table),
+        'connection': quote_name(Connection._meta.db_table),
+        'subscription': quote_name(Subscription._meta.db_table),
+        'collection': quote_name(SubscriptionCollection._meta.db_table),
+    }
+
+
+def delete_connections(connection_ids):
+    """Bulk delete connections along with their subscriptions."""
+    with connection.cursor() as cur:
+        cur.execute(
+            (
+                """
+                WITH dead_connections AS (
+                    DELETE FROM {connection}
+                    WHERE id = ANY(%s)
+                    RETURNING id
+                ),
+                """ + CASCADE_SQL + "SELECT " + COUNTS_SQL
+            ).format(**tables()),
+            [list(connection_ids)],
+        )
+        return cur.fetchone()
+
+
+def default_server_addr():
+    """Return a unique identifier for this server process."""
+    return '%s:%d:%s' % (
+        socket.gethostname(),
+        os.getpid(),
+        # PIDs get reused, make sure a restarted server can't adopt stale rows.
+        meteor_random_id(length=8),
+    )
+
+
+class ReaperGreenlet(gevent.Greenlet):
+
+    """Greenlet to heartbeat this server and reap connections of dead ones."""
+
+    def __init__(
+            self, server_addr=None,
+            interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT,
+            on_lost=None,
+    ):
+        """Prepare heartbeat state."""
+        super(ReaperGreenlet, self).__init__()
+        self.logger = logging.getLogger('dddp.reaper')
+        self.server_addr = server_addr or default_server_addr()
+        self.interval = interval
+        self.timeout = timeout
+        # called when peers have reaped our connections (heartbeat expired).
+        self.on_lost = on_lost
+        self.beaten = False
+        # running totals of rows reclaimed, by model name.
+        self.reaped = collections.Counter()
+        self._stop_event = gevent.event.Event()
+
+    def _run(self):  # pylint: disable=method-hidden
+        """Heartbeat and reap until asked to stop."""
+        while not self._stop_event.is_set():
+            try:
+                self.beat()
+                self.reap()
+                self.prune()
+            except DatabaseError:
+                self.logger.exception('Heartbeat failed, will retry.')
+            self._stop_event.wait(self.interval)
+        connection.close()
+
+    def stop(self):
+        """Stop heartbeat and let run() finish."""
+        self._stop_event.set()
+
+    def beat(self):
+        """
+        Record heartbeat for this server (using database clock).
+
+        Returns False if our heartbeat had expired, in which case peers have
+        reaped our connections (and subscriptions) so `on_lost` is called.
+        """
+        # Django model._meta is public API -> pylint: disable=W0212
+        table = connection.ops.quote_name(Heartbeat._meta.db_table)
+        lost = False
+        with connection.cursor() as cur:
+            cur.execute(
+                'UPDATE %s SET last_seen = now() WHERE server_addr = %%s' % (
+                    table,
+                ),
+                [self.server_addr],
+            )
+            if cur.rowcount == 0:
+                # heartbeat row is only ever deleted along with connections.
+                lost = self.beaten
+                cur.execute(
+                    'INSERT INTO %s (server_addr, last_seen) '
+                    'VALUES (%%s, now())' % table,
+                    [self.server_addr],
+                )
+        self.beaten = True
+        if lost:
+            self.logger.error(
+                'Heartbeat of %s expired, connections were reaped.',
+                self.server_addr,
+            )
+            if self.on_lost is not None:
+                self.on_lost()
+        return not lost
+
+    def reap(self, include_self=False):
+        """Bulk delete connections (and subs) of servers without heartbeat."""
+        # Single statement so the cascade can't be interleaved with new subs,
+        # connections without any live heartbeat (eg: from servers predating
+        # heartbeats) are reaped along with those of expired servers.
+        with connection.cursor() as cur:
+            cur.execute(
+                (
+                    """
+                WITH live AS (
+                    SELECT server_addr FROM {heartbeat}
+                    WHERE last_seen >= now() - %s * INTERVAL '1 second'
+                    AND server_addr IS DISTINCT FROM %s
+                ), dead_servers AS (
+                    DELETE FROM {heartbeat}
+                    WHERE server_addr NOT IN (SELECT server_addr FROM live)
+                    RETURNING id
+                ), dead_connections AS (
+                    DELETE FROM {connection}
+                    WHERE server_addr NOT IN (SELECT server_addr FROM live)
+                    RETURNING id
+                ),
+                    """ + CASCADE_SQL +
+                    "SELECT (SELECT COUNT(*) FROM dead_servers), " + COUNTS_SQL
+                ).format(**tables()),
+                [self.timeout, self.server_addr if include_self else None],
+            )
+            counts = collections.OrderedDict(zip(
+                ['servers', 'connections', 'subscriptions', 'collections'],
+                cur.fetchone(),
+            ))
+        if any(counts.values()):
+            self.reaped.update(counts)
+            self.logger.info(
+                'Reaped %s.', ', '.join(
+                    '%d %s' % (count, name) for name, count in counts.items()
+                ),
+            )
+        return counts
+
+    def prune(self):
+        """Delete changes older than the change log retention period."""
+        if not CHANGE_LOG:
+            return 0
+        count = prune()
+        self.reaped['changes'] += count
+        return count
+
+    def release(self):
+        """Bulk delete this server and all of its connections (at shutdown)."""
+        return self.reap(include_self=True)
@@ -0,0 +1,257 @@
+"""Django DDP host-level LISTEN relay for multi-process servers."""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import socket
+
+import ejson
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.server
+from django.conf import settings
+
+from dddp.postgres import PostgresGreenlet, deliver, resync
+
+# max messages queued for a worker before it is dropped (and so resyncs).
+WORKER_QUEUE_MAX = int(getattr(settings, 'DDP_RELAY_WORKER_QUEUE_MAX', 1000))
+
+
+def unix_listener(path, backlog=128):
+    """Bind a listening Unix domain socket at path."""
+    if os.path.exists(path):
+        os.unlink(path)  # stale socket from a previous relay.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+class RelayWorker(object):
+
+    """
+    Worker process connected to the relay.
+
+    Messages are queued for a writer greenlet per worker, so a worker that is
+    slow to read doesn't hold up the LISTEN greenlet (and so all the other
+    workers).  A worker that falls too far behind is dropped, it reconnects
+    and resyncs all its connections.
+    """
+
+    def __init__(self, sock, size=WORKER_QUEUE_MAX):
+        """Start writer for worker connected on sock."""
+        self.sock = sock
+        self.queue = gevent.queue.Queue(size)
+        self.writer = gevent.spawn(self.write)
+
+    def write(self):
+        """Send queued messages to the worker until it goes away."""
+        try:
+            for line in self.queue:
+                self.sock.sendall(line)
+        except socket.error:
+            self.drop()  # handle() will clean up.
+
+    def send(self, msg):
+        """Queue msg for worker, returning False if the queue is full."""
+        try:
+            self.queue.put_nowait(('%s\n' % ejson.dumps(msg)).encode('utf-8'))
+        except gevent.queue.Full:
+            return False
+        return True
+
+    def drop(self):
+        """Disconnect worker, handle() cleans up once the reader notices."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # already gone.
+
+    def close(self):
+        """Stop writer."""
+        self.writer.kill()
+
+
+class RelayGreenlet(PostgresGreenlet):
+
+    """
+    Hold the host's only LISTEN connection, relaying changes to workers.
+
+    Workers connect over a Unix domain socket and register the connection ids
+    they own, each change batch is reassembled and decoded once and then sent
+    to each worker with `_connection_ids` narrowed to those it owns.
+    """
+
+    def __init__(self, conn, path):
+        """Prepare relay listening at path."""
+        super(RelayGreenlet, self).__init__(conn)
+        self.logger = logging.getLogger('dddp.relay')
+        self.path = path
+        self.owners = {}  # connection_id: RelayWorker
+        self.server = None
+
+    def _run(self):  # pylint: disable=method-hidden
+        """Accept workers and relay NOTIFY traffic until stopped."""
+        self.server = gevent.server.StreamServer(
+            unix_listener(self.path), self.handle,
+        )
+        self.server.start()
+        try:
+            super(RelayGreenlet, self)._run()
+        finally:
+            self.server.stop()
+            os.unlink(self.path)
+
+    def handle(self, sock, address):
+        """Track connection ids registered by a worker."""
+        del address  # Unix sockets have no useful peer address.
+        worker = RelayWorker(sock)
+        owned = set()
+        try:
+            for line in sock.makefile('r'):
+                msg = ejson.loads(line)
+                for connection_id in msg.get('register', []):
+                    self.owners[connection_id] = worker
+                    owned.add(connection_id)
+                for connection_id in msg.get('unregister', []):
+                    if self.owners.get(connection_id, None) is worker:
+                        del self.owners[connection_id]
+                    owned.discard(connection_id)
+        except (socket.error, ValueError):
+            self.logger.exception('Dropping worker connection.')
+        finally:
+            for connection_id in owned:
+                if self.owners.get(connection_id, None) is worker:
+                    del self.owners[connection_id]
+            worker.close()
+
+    def process(self, data):
+        """Send change `data` to workers owning the addressed connections."""
+        by_worker = collections.defaultdict(list)
+        for connection_id in data['_connection_ids']:
+            worker = self.owners.get(connection_id, None)
+            if worker is not None:
+                by_worker[worker].append(connection_id)
+        for worker, connection_ids in by_worker.items():
+            data['_connection_ids'] = connection_ids
+            self.send(worker, data)
+
+    def resync(self):
+        """Ask all workers to resync their connections."""
+        for worker in set(self.owners.values()):
+            self.send(worker, {'_resync': True})
+
+    def send(self, worker, msg):
+        """Queue msg for worker, dropping the worker if it fell behind."""
+        if not worker.send(msg):
+            self.logger.warning(
+                'Worker fell %d messages behind, dropping it.',
+                worker.queue.maxsize,
+            )
+            worker.drop()
+
+
+class RelayConnections(dict):
+
+    """Dict of local websocket connections, registered with the relay."""
+
+    def __init__(self, client):
+        """Create empty registry for client."""
+        super(RelayConnections, self).__init__()
+        self.client = client
+
+    def __setitem__(self, connection_id, websocket):
+        """Add local connection, routing its changes here."""
+        super(RelayConnections, self).__setitem__(connection_id, websocket)
+        self.client.send_msg(register=[connection_id])
+
+    def __delitem__(self, connection_id):
+        """Remove local connection."""
+        super(RelayConnections, self).__delitem__(connection_id)
+        self.client.send_msg(unregister=[connection_id])
+
+    def pop(self, connection_id, *default):
+        """Remove local connection (if present), returning it."""
+        if connection_id not in self:
+            return super(RelayConnections, self).pop(connection_id, *default)
+        websocket = self[connection_id]
+        del self[connection_id]
+        return websocket
+
+    def clear(self):
+        """Remove all local connections."""
+        connection_ids = list(self)
+        super(RelayConnections, self).clear()
+        if connection_ids:
+            self.client.send_msg(unregister=connection_ids)
+
+
+class RelayClientGreenlet(gevent.Greenlet):
+
+    """Receive change batches from the host relay (in place of LISTEN)."""
+
+    # max seconds between attempts to (re)connect to the relay.
+    max_retry_delay = 5.0
+
+    def __init__(self, path):
+        """Prepare to connect to relay at path."""
+        super(RelayClientGreenlet, self).__init__()
+        self.logger = logging.getLogger('dddp.relay')
+        self.path = path
+        self.connections = RelayConnections(self)
+        self.sock = None
+        self._stop_event = gevent.event.Event()
+
+    def _run(self):  # pylint: disable=method-hidden
+        """Receive from relay, reconnecting as needed until stopped."""
+        delay = 0.1
+        reconnect = False
+        while not self._stop_event.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                sock.close()
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = 0.1
+            self.sock = sock
+            self.logger.info('Connected to relay at %s.', self.path)
+            # relay may have restarted, (re)register all our connections.
+            self.send_msg(register=list(self.connections))
+            if reconnect:
+                # changes sent while we were away are gone.
+                resync(self.connections)
+            reconnect = True
+            try:
+                for line in sock.makefile('r'):
+                    data = ejson.loads(line)
+                    if data.get('_resync', False):
+                        resync(self.connections)
+                    else:
+                        deliver(self.connections, data)
+            except socket.error:
+                self.logger.warning('Lost connection to relay.')
+            finally:
+                self.sock = None
+                sock.close()
+
+    def stop(self):
+        """Disconnect from relay and let run() finish."""
+        self._stop_event.set()
+        if self.sock is not None:
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+    def send_msg(self, **msg):
+        """Send msg to relay (dropped if not connected, sent on reconnect)."""
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendall(('%s\n' % ejson.dumps(msg)).encode('utf-8'))
+        except socket.error:
+            pass  # reader will notice and reconnect.
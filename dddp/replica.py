@@ -0,0 +1,100 @@
+"""Django DDP read replica routing for subscription loads."""
+
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import logging
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+
+
+# database alias of a streaming replica to read subscription data from.
+READ_REPLICA = getattr(settings, 'DDP_READ_REPLICA', None)
+# bytes of WAL the replica may lag behind the primary and still be used.
+MAX_LAG = int(getattr(settings, 'DDP_READ_REPLICA_MAX_LAG', 0))
+# process wide counters: hit (read from replica), fallback (read from
+# primary) and errors (replica check failed).
+REPLICA_STATS = collections.Counter()
+# DatabasePool lending replica connections (set by DDPLauncher if pooling).
+REPLICA_POOL = None
+
+LOGGER = logging.getLogger('dddp.replica')
+
+
+def wal_position(using):
+    """
+    Return current WAL flush position of primary database `using`.
+
+    Every (synchronously) committed transaction visible to the current
+    transaction lies at or before the flush position.  The write position
+    also includes WAL which hasn't been flushed (and so can't have been
+    streamed to a replica yet), such as records written by transactions
+    still in progress (including the current one).
+    """
+    conn = connections[using]
+    if conn.pg_version >= 100000:
+        sql = 'SELECT pg_current_wal_flush_lsn()::text'
+    elif conn.pg_version >= 90600:
+        sql = 'SELECT pg_current_xlog_flush_location()::text'
+    else:
+        sql = 'SELECT pg_current_xlog_location()::text'
+    # savepoint, so a failure doesn't break any transaction in progress.
+    with transaction.atomic(using=using):
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchone()[0]
+
+
+def replica_caught_up(replica, lsn, max_lag=MAX_LAG):
+    """Return True if `replica` has replayed WAL up to `lsn` - `max_lag`."""
+    conn = connections[replica]
+    if conn.pg_version >= 100000:
+        lag = 'pg_wal_lsn_diff(pg_last_wal_replay_lsn(), %s)'
+    else:
+        lag = 'pg_xlog_location_diff(pg_last_xlog_replay_location(), %s)'
+    with conn.cursor() as cursor:
+        # a database that isn't in recovery is as up to date as it gets.
+        cursor.execute(
+            'SELECT NOT pg_is_in_recovery() OR %s >= %%s' % lag,
+            [lsn, -max_lag],
+        )
+        return bool(cursor.fetchone()[0])
+
+
+@contextlib.contextmanager
+def read_replica(using):
+    """
+    Yield alias of a replica consistent with primary `using` (or None).
+
+    The replica is only used if it has replayed everything the primary has
+    flushed up until now (less DDP_READ_REPLICA_MAX_LAG bytes), which
+    includes the state seen by the current transaction on the primary -
+    otherwise reads fall back to the primary.  Allowing some lag trades
+    consistency for more reads from the replica: changes committed within
+    the allowed lag may be missing from the initial subscription data.
+    """
+    if READ_REPLICA is None or using is None or READ_REPLICA == using:
+        yield None
+        return
+    if REPLICA_POOL is None:
+        # greenlet keeps its replica connection, which is closed along with
+        # the primary when request_finished is sent (honouring CONN_MAX_AGE).
+        yield replica_alias(using)
+        return
+    with REPLICA_POOL.connection():
+        yield replica_alias(using)
+
+
+def replica_alias(using):
+    """Return READ_REPLICA if caught up with primary `using`, else None."""
+    alias = None
+    try:
+        if replica_caught_up(READ_REPLICA, wal_position(using)):
+            alias = READ_REPLICA
+    except DatabaseError:
+        REPLICA_STATS['errors'] += 1
+        LOGGER.exception('Replica check failed, using primary.')
+    REPLICA_STATS['hit' if alias else 'fallback'] += 1
+    return alias
@@ -1,17 +1,31 @@
 """Django DDP test suite."""
 from __future__ import absolute_import, unicode_literals
 
+import collections
+import contextlib
 import doctest
 import errno
+import logging
 import os
+import signal
 import socket
 import sys
+import time
 import unittest
 import django.test
 import ejson
 import gevent
+import gevent.pool
+import gevent.queue
+import six
 import dddp
 import dddp.alea
+import dddp.changelog
+import dddp.idcache
+import dddp.postgres
+import dddp.prepared
+import dddp.ratelimit
+import dddp.websocket
 from dddp.main import DDPLauncher
 # pylint: disable=E0611, F0401
 from six.moves.urllib_parse import urljoin
@@ -19,7 +33,14 @@ from six.moves.urllib_parse import urljoin
 os.environ['DJANGO_SETTINGS_MODULE'] = 'test_project.settings'
 
 DOCTEST_MODULES = [
+    dddp,
     dddp.alea,
+    dddp.changelog,
+    dddp.idcache,
+    dddp.postgres,
+    dddp.prepared,
+    dddp.ratelimit,
+    dddp.websocket,
 ]
 
 
@@ -351,6 +372,8 @@ class WebSocketTestCase(DDPServerTestCase):
                     },
                     'id': id_,
                 },
+                # sent in the same SockJS frame
+                {'msg': 'updated', 'methods': [id_]},
             ],
         )
 
@@ -394,10 +417,1325 @@ class WebSocketTestCase(DDPServerTestCase):
                         },
                         'id': id_,
                     },
+                    # sent in the same SockJS frame
+                    {'msg': 'updated', 'methods': [id_]},
                 ],
             )
 
 
+class ReaperTestCase(django.test.TransactionTestCase):
+
+    """Test heartbeat and reaping of stale connections."""
+
+    def test_reap_expired(self):
+        """Connections of servers without a recent heartbeat are reaped."""
+        import datetime
+        from django.utils import timezone
+        from dddp.models import Connection, Heartbeat, Subscription
+        from dddp.reaper import ReaperGreenlet
+        reaper = ReaperGreenlet(server_addr='live', timeout=60)
+        reaper.beat()
+        Heartbeat.objects.create(
+            server_addr='dead',
+            last_seen=timezone.now() - datetime.timedelta(minutes=5),
+        )
+        live = Connection.objects.create(server_addr='live')
+        dead = Connection.objects.create(server_addr='dead')
+        Subscription.objects.create(connection=dead, sub_id='a')
+        counts = reaper.reap()
+        self.assertEqual(
+            dict(counts),
+            {'servers': 1, 'connections': 1, 'subscriptions': 1,
+             'collections': 0},
+        )
+        self.assertEqual(
+            list(Connection.objects.values_list('pk', flat=True)), [live.pk],
+        )
+        self.assertEqual(reaper.reaped['connections'], 1)
+
+    def test_lost(self):
+        """Server notices when peers reaped it after a missed heartbeat."""
+        from dddp.models import Heartbeat
+        from dddp.reaper import ReaperGreenlet
+        lost = []
+        reaper = ReaperGreenlet(
+            server_addr='self', timeout=60, on_lost=lambda: lost.append(1),
+        )
+        self.assertTrue(reaper.beat())  # first heartbeat inserts the row.
+        self.assertTrue(reaper.beat())
+        Heartbeat.objects.filter(server_addr='self').delete()  # by a peer.
+        self.assertFalse(reaper.beat())
+        self.assertTrue(reaper.beat())
+        self.assertEqual(lost, [1])
+
+
+class HeartbeatTestCase(unittest.TestCase):
+
+    """Test liveness checks of DDP WebSocket connections."""
+
+    class StubWebSocket(object):
+
+        """WebSocket stub receiving `messages` then raising WebSocketError."""
+
+        closed = False
+
+        def __init__(self, messages):
+            self.messages = list(messages)
+
+        def receive(self):
+            """Return next message, or raise WebSocketError if none left."""
+            if not self.messages:
+                import geventwebsocket
+                raise geventwebsocket.WebSocketError()
+            return self.messages.pop(0)
+
+    def make_app(self, connection=None, version=None, messages=()):
+        """Return DDPWebSocketApplication last heard from long ago."""
+        app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+        app.ws = self.StubWebSocket(messages)
+        app.logger = logging.getLogger(__name__)
+        app.connection = connection
+        app.version = version
+        app.last_recv = 0
+        app.sent = []
+        app.aborted = False
+        app.send = app.sent.append
+        app.abort = lambda: setattr(app, 'aborted', True)
+        return app
+
+    def test_idle_abort(self):
+        """Connected DDP clients that stop answering pings are closed."""
+        app = self.make_app(connection=object(), version='1')
+        self.assertFalse(app.heartbeat())
+        self.assertTrue(app.aborted)
+
+    def test_reader_notes_arrival(self):
+        """Messages received while a handler is busy count as liveness."""
+        app = self.make_app(
+            connection=object(), version='1', messages=['a', 'b'],
+        )
+        app._inbox = gevent.queue.Queue(dddp.websocket.RECV_QUEUE_MAX)
+        app._reader()  # no handler has processed anything yet
+        self.assertNotEqual(app.last_recv, 0)
+        self.assertEqual(
+            [app._inbox.get() for _ in range(3)], ['a', 'b', StopIteration],
+        )
+        app.last_recv = 0
+        app._inbox.put('c')  # reader blocked on full inbox, say
+        self.assertTrue(app.heartbeat())
+        self.assertFalse(app.aborted)
+
+    def test_no_abort_without_ping(self):
+        """Clients that can't answer a ping are never closed as idle."""
+        for app in [
+                self.make_app(),  # no `connect` message yet
+                self.make_app(connection=object(), version='pre1'),
+        ]:
+            self.assertTrue(app.heartbeat())
+            self.assertFalse(app.aborted)
+            self.assertEqual(app.sent, ['h'])
+
+
+class ConflateTestCase(unittest.TestCase):
+
+    """Test queued collection msgs are collapsed into their net effect."""
+
+    @staticmethod
+    def msg(msg, id_='a', collection='c', **kwargs):
+        """Return collection msg."""
+        kwargs.update(msg=msg, collection=collection, id=id_)
+        return kwargs
+
+    def test_changed(self):
+        """Changes are merged, later fields and cleared win."""
+        self.assertEqual(
+            dddp.websocket.net_effect([
+                self.msg('changed', fields={'x': 1, 'y': 1}),
+                self.msg('changed', fields={'x': 2}, cleared=['y', 'z']),
+                self.msg('changed', fields={'z': 3}),
+            ]),
+            [self.msg('changed', fields={'x': 2, 'z': 3}, cleared=['y'])],
+        )
+
+    def test_added(self):
+        """Changes after `added` are folded into it, cleared fields go."""
+        self.assertEqual(
+            dddp.websocket.net_effect([
+                self.msg('added', fields={'x': 1, 'y': 1}),
+                self.msg('changed', fields={'x': 2}, cleared=['y']),
+            ]),
+            [self.msg('added', fields={'x': 2})],
+        )
+
+    def test_removed(self):
+        """Objects removed end up removed, unless client never had them."""
+        self.assertEqual(
+            dddp.websocket.net_effect([
+                self.msg('changed', fields={'x': 1}),
+                self.msg('removed'),
+            ]),
+            [self.msg('removed')],
+        )
+        self.assertEqual(
+            dddp.websocket.net_effect([
+                self.msg('added', fields={'x': 1}),
+                self.msg('changed', fields={'x': 2}),
+                self.msg('removed'),
+            ]),
+            [],
+        )
+
+    def test_readded(self):
+        """Objects removed then added again are sent as both."""
+        self.assertEqual(
+            dddp.websocket.net_effect([
+                self.msg('changed', fields={'x': 1}),
+                self.msg('removed'),
+                self.msg('added', fields={'x': 2}),
+                self.msg('changed', fields={'y': 3}),
+            ]),
+            [self.msg('removed'), self.msg('added', fields={'x': 2, 'y': 3})],
+        )
+
+    def test_conflate(self):
+        """Objects keep the position of their first msg, others stay put."""
+        self.assertEqual(
+            dddp.websocket.conflate([
+                'a["raw"]',
+                self.msg('changed', fields={'x': 1}),
+                self.msg('changed', collection='d', fields={'x': 1}),
+                {'msg': 'ready', 'subs': ['s']},
+                self.msg('changed', fields={'x': 2}),
+                self.msg('added', id_='b', fields={}),
+                self.msg('removed', id_='b'),
+            ]),
+            [
+                'a["raw"]',
+                self.msg('changed', fields={'x': 2}),
+                self.msg('changed', collection='d', fields={'x': 1}),
+                {'msg': 'ready', 'subs': ['s']},
+            ],
+        )
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    """Test coalescing of `changed` msgs for each connection."""
+
+    def setUp(self):
+        """Create app coalescing changes to collection `c` for 1 second."""
+        app = self.app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+        col = collections.namedtuple('Collection', 'coalesce_window')(1)
+        app.api = collections.namedtuple('API', 'get_col_by_name')(
+            {'c': col}.__getitem__,
+        )
+        app.ws = collections.namedtuple('WebSocket', 'closed')(False)
+        app.logger = logging.getLogger(__name__)
+        app.remote_ids = collections.defaultdict(set, c=set(['a', 'b']))
+        app._coalesce_pending = {}
+        app._tx_buffer = dddp.websocket.ReorderBuffer()
+        app.sent = []
+        app.enqueue = app.sent.append
+        app.timers = []
+        app.spawn_later = lambda seconds, func, *args: app.timers.append(
+            (seconds, func, args),
+        )
+
+    def flush(self):
+        """Close current coalescing windows."""
+        timers, self.app.timers[:] = list(self.app.timers), []
+        for _, func, args in timers:
+            func(*args)
+
+    @staticmethod
+    def changed(id_='a', collection='c', **fields):
+        """Return `changed` msg."""
+        return {
+            'msg': 'changed', 'collection': collection, 'id': id_,
+            'fields': fields,
+        }
+
+    def test_window(self):
+        """First change is sent, later ones are merged until window ends."""
+        self.app.coalesce(self.changed(x=1))
+        self.app.coalesce(self.changed(x=2, y=1))
+        self.app.coalesce(self.changed(x=3))
+        self.app.coalesce(self.changed('b', x=1))
+        self.assertEqual(
+            self.app.sent, [self.changed(x=1), self.changed('b', x=1)],
+        )
+        self.assertEqual([timer[0] for timer in self.app.timers], [1, 1])
+        self.flush()
+        self.assertEqual(self.app.sent[2:], [self.changed(x=3, y=1)])
+        # window reopened for `a` only (there were changes to send).
+        self.assertEqual(len(self.app.timers), 1)
+        self.flush()
+        self.assertEqual(self.app.timers, [])
+        self.app.coalesce(self.changed(x=4))
+        self.assertEqual(self.app.sent[3:], [self.changed(x=4)])
+
+    def test_uncoalesced(self):
+        """Other msgs and collections aren't held back."""
+        self.app.coalesce(self.changed(collection='dddp.logs', x=1))
+        self.app.coalesce(self.changed(collection='dddp.logs', x=2))
+        self.app.coalesce({'msg': 'ready', 'subs': ['s']})
+        self.assertEqual(len(self.app.sent), 3)
+        self.assertEqual(self.app.timers, [])
+
+    def test_superseded(self):
+        """Msgs sent for an object include any held back changes."""
+        self.app.coalesce(self.changed(x=1))
+        self.app.coalesce(self.changed(x=2))
+        self.app.send(self.changed(y=1))  # eg: caller's own change.
+        self.app.coalesce(self.changed('b', x=1))
+        self.app.coalesce(self.changed('b', x=2))
+        removed = {'msg': 'removed', 'collection': 'c', 'id': 'b'}
+        self.app.coalesce(removed)
+        self.flush()
+        self.assertEqual(
+            self.app.sent, [
+                self.changed(x=1),
+                self.changed(x=2, y=1),
+                self.changed('b', x=1),
+                removed,
+            ],
+        )
+
+
+class CloseTestCase(unittest.TestCase):
+
+    """Test websocket connections are closed once processing stops."""
+
+    def test_socket_error(self):
+        """on_close() from ws.receive() waits for the message in progress."""
+        events = []
+        app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+
+        class WebSocket(object):
+
+            """Receive one message, then fail like geventwebsocket does."""
+
+            closed = False
+            messages = ['a']
+
+            def receive(self):
+                """Return next message, or close on (pretend) socket error."""
+                if self.messages:
+                    return self.messages.pop(0)
+                app.on_close('Connection closed')
+                self.closed = True
+                return None
+
+        class Protocol(object):
+
+            """Dispatch messages to app, noting when they are processed."""
+
+            @staticmethod
+            def on_open():
+                """Nothing to do."""
+
+            @staticmethod
+            def on_message(message):
+                """Take a while processing message."""
+                events.append('start %s' % message)
+                gevent.sleep(0.01)
+                events.append('end %s' % message)
+
+            @staticmethod
+            def on_close():
+                """Close app."""
+                app.on_close()
+
+        class MethodPool(object):
+
+            """Method pool noting when it is killed."""
+
+            @staticmethod
+            def kill(block):
+                """Note teardown."""
+                events.append('close')
+
+        app.ws = WebSocket()
+        app.protocol = Protocol()
+        app.logger = logging.getLogger(__name__)
+        app.remote_addr = '127.0.0.1:1234'
+        app._method_pool = MethodPool()
+        app.handle()
+        self.assertEqual(events, ['start a', 'end a', 'close'])
+
+
+class UnblockTestCase(unittest.TestCase):
+
+    """Test methods calling `this.unblock()` run concurrently."""
+
+    def setUp(self):
+        """Create app running method handlers from self.methods."""
+        self.events = []
+        self.app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+        self.app._method_pool = gevent.pool.Pool(2)
+        self.app.process_pooled = lambda data: getattr(self, data['method'])()
+        dddp.this.user_id = None
+
+    def tearDown(self):
+        """Forget user."""
+        del dddp.this.user_id
+
+    def call(self, *methods):
+        """Call methods in order, return once they've all completed."""
+        for method in methods:
+            self.app.process_method({'msg': 'method', 'method': method})
+        self.app._method_pool.join()
+        return self.events
+
+    def slow(self):
+        """Unblock, then take a while to finish."""
+        self.events.append('slow')
+        dddp.this.unblock()
+        gevent.sleep(0.01)
+        self.events.append('slow done')
+
+    def blocking(self):
+        """Take a while to finish."""
+        gevent.sleep(0.01)
+        self.events.append('blocking done')
+
+    def fast(self):
+        """Finish right away."""
+        self.events.append('fast %s' % dddp.this.user_id)
+
+    def login(self):
+        """Change user, then unblock and change it again."""
+        dddp.this.user_id = 'user1'
+        dddp.this.unblock()
+        dddp.this.user_id = 'user2'
+        gevent.sleep(0.01)
+
+    def test_order(self):
+        """Later messages wait unless (or until) a method unblocks."""
+        self.assertEqual(
+            self.call('blocking', 'fast', 'slow', 'fast'),
+            ['blocking done', 'fast None', 'slow', 'fast None', 'slow done'],
+        )
+
+    def test_login(self):
+        """State as at unblock() is seen by later messages."""
+        self.assertEqual(self.call('login', 'fast'), ['fast user1'])
+        self.assertEqual(dddp.this.user_id, 'user1')
+
+    def test_concurrency_limit(self):
+        """Messages wait for a free slot when methods are at the limit."""
+        self.assertEqual(
+            self.call('slow', 'slow', 'fast'),
+            ['slow', 'slow', 'slow done', 'slow done', 'fast None'],
+        )
+
+
+class SaturatedPoolTestCase(unittest.TestCase):
+
+    """Test connection handling while the database pool is saturated."""
+
+    class SaturatedPool(object):
+
+        """Database pool with no free slots."""
+
+        def __init__(self):
+            self.direct_calls = 0
+
+        def connection(self):
+            """Time out waiting for a slot."""
+            from dddp.dbpool import PoolTimeout
+            raise PoolTimeout('Timed out waiting for a database connection.')
+
+        @contextlib.contextmanager
+        def direct(self):
+            """Provide an unpooled connection."""
+            self.direct_calls += 1
+            yield
+
+    def make_app(self):
+        """Return connected DDPWebSocketApplication using a saturated pool."""
+        app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+        app.logger = logging.getLogger(__name__)
+        app.api = collections.namedtuple('API', 'api_path_map')(dict)
+        app.db_pool = self.SaturatedPool()
+        app._rate_buckets = {}
+        app.sent = []
+        app.send = app.sent.append
+        return app
+
+    def test_on_close(self):
+        """Connection is forgotten and deleted without a pool slot."""
+        import dddp.reaper
+        app = self.make_app()
+        app.connection = collections.namedtuple('Connection', 'pk')(1)
+        app.pgworker = collections.namedtuple('Worker', 'connections')(
+            {1: app},
+        )
+        deleted = []
+        orig = dddp.reaper.delete_connections
+        dddp.reaper.delete_connections = deleted.extend
+        try:
+            app.on_close()
+        finally:
+            dddp.reaper.delete_connections = orig
+        self.assertEqual(app.pgworker.connections, {})
+        self.assertIsNone(app.connection)
+        self.assertEqual(deleted, [1])
+        self.assertEqual(app.db_pool.direct_calls, 1)
+
+    def test_busy_reply(self):
+        """Messages that can't get a pool slot get an error reply."""
+        app = self.make_app()
+        app.process_pooled({'msg': 'method', 'id': '1', 'method': 'x'})
+        self.assertEqual(
+            [reply['msg'] for reply in app.sent], ['result', 'updated'],
+        )
+        self.assertEqual(app.sent[0]['error']['error'], 503)
+
+    def test_ping(self):
+        """Ping doesn't wait for a pool slot, so always gets its pong."""
+        app = self.make_app()
+        app.connection = object()
+        app.process_pooled({'msg': 'ping', 'id': '1'})
+        self.assertEqual(app.sent, [{'msg': 'pong', 'id': '1'}])
+
+    def test_rate_limit_first(self):
+        """Rate limits apply before waiting for a pool slot."""
+        app = self.make_app()
+        app._rate_buckets = dddp.ratelimit.buckets({'sub': (0.001, 1)})
+        for id_ in ['a', 'b']:
+            app.process_pooled({'msg': 'sub', 'id': id_, 'name': 'x'})
+        self.assertEqual(
+            [reply['error'] for reply in app.sent],
+            [503, 'too-many-requests'],
+        )
+
+
+class ListenReconnectTestCase(unittest.TestCase):
+
+    """Test the LISTEN greenlet survives database errors."""
+
+    class Conn(object):
+
+        """Stand-in for a psycopg2 connection."""
+
+        allow_thread_sharing = False
+        closed = False
+
+        def close(self):
+            """Close connection."""
+            self.closed = True
+
+    def test_catch_up_error(self):
+        """ORM errors (eg: from catch_up) cause a reconnect, not death."""
+        from django.db import DatabaseError
+        from dddp.postgres import PostgresGreenlet
+        conns = []
+
+        class Listener(PostgresGreenlet):
+
+            """Listener failing on first connection."""
+
+            def connect(self):
+                """Return new connection."""
+                conns.append(ListenReconnectTestCase.Conn())
+                return conns[-1]
+
+            def listen(self, conn):
+                """Fail first time, then stop."""
+                if len(conns) == 1:
+                    raise DatabaseError('catch up failed')
+                self._stop_event.set()
+
+        listener = Listener(self.Conn())
+        listener._run()
+        self.assertEqual(len(conns), 2)
+        self.assertTrue(all(conn.closed for conn in conns))
+        self.assertIsNotNone(listener.lost_at)  # catch up from here.
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    """Test worker processes are restarted and reloaded."""
+
+    def setUp(self):
+        """Create supervisor of short lived workers."""
+        from dddp.main import Supervisor
+        self.sup = Supervisor(2, self.exit)
+        self.sup.restart_delay = 0
+
+    def tearDown(self):
+        """Kill any workers still running."""
+        self.sup.stop(signal.SIGKILL)
+        self.reap(list(self.sup.workers))
+
+    @staticmethod
+    def exit(slot):
+        """Worker exiting right away."""
+        del slot
+
+    @staticmethod
+    def wait(slot):
+        """Worker running until killed."""
+        del slot
+        gevent.sleep(30)
+
+    def reap(self, pids):
+        """Reap workers until pids have gone."""
+        for _ in range(500):
+            if not set(pids).intersection(self.sup.workers):
+                return
+            self.sup.reap()
+            gevent.sleep(0.01)
+        self.fail('Workers %r never exited.' % (pids,))
+
+    def slots(self):
+        """Return {slot: (generation, target)} of workers."""
+        return {
+            slot: (generation, target.__name__)
+            for generation, slot, _, target
+            in self.sup.workers.values()
+        }
+
+    def test_restart(self):
+        """Workers that die are restarted in their slot."""
+        pids = [self.sup.spawn(slot) for slot in range(2)]
+        self.reap(pids)
+        self.assertEqual(self.slots(), {0: (0, 'exit'), 1: (0, 'exit')})
+
+    def test_stop(self):
+        """Workers aren't restarted once stopping."""
+        self.sup.worker = self.wait
+        pids = [self.sup.spawn(slot) for slot in range(2)]
+        self.sup.stop(signal.SIGTERM)
+        self.reap(pids)
+        self.assertEqual(self.sup.workers, {})
+
+    def test_reload(self):
+        """SIGHUP replaces workers, keeping the relay running."""
+        self.sup.worker = self.wait
+        relay = self.sup.spawn('relay', self.wait)
+        pids = [self.sup.spawn(slot) for slot in range(2)]
+        self.sup.reload()  # as done by the SIGHUP handler.
+        self.reap(pids)  # old workers sent SIGQUIT.
+        self.assertIn(relay, self.sup.workers)
+        self.assertEqual(
+            self.slots(),
+            {'relay': (None, 'wait'), 0: (1, 'wait'), 1: (1, 'wait')},
+        )
+
+    def test_relay_restart(self):
+        """Relay is restarted when it dies, even after reloading."""
+        self.sup.generation = 1
+        relay = self.sup.spawn('relay', self.exit)
+        self.reap([relay])
+        self.assertEqual(self.slots(), {'relay': (None, 'exit')})
+
+
+class RelayConnectionsTestCase(unittest.TestCase):
+
+    """Test local connections are (un)registered with the relay."""
+
+    def test_register(self):
+        """Adding and removing connections (in any way) tells the relay."""
+        from dddp.relay import RelayConnections
+
+        class Client(object):
+
+            """Relay client recording messages sent."""
+
+            def __init__(self):
+                self.sent = []
+
+            def send_msg(self, **msg):
+                """Record msg."""
+                self.sent.append(msg)
+
+        client = Client()
+        connections = RelayConnections(client)
+        for connection_id in 'abcd':
+            connections[connection_id] = connection_id.upper()
+        del connections['a']
+        self.assertEqual(connections.pop('b', None), 'B')
+        self.assertIsNone(connections.pop('b', None))
+        connections.clear()
+        self.assertEqual(connections, {})
+        self.assertEqual(
+            client.sent[4:6], [{'unregister': ['a']}, {'unregister': ['b']}],
+        )
+        self.assertEqual(sorted(client.sent[6]['unregister']), ['c', 'd'])
+        self.assertEqual(len(client.sent), 7)
+
+
+class DeliveredChangesTestCase(unittest.TestCase):
+
+    """Test tracking of changes delivered, for replaying missed ones."""
+
+    def setUp(self):
+        """Track changes delivered after change 10 at a controlled time."""
+        self.now = 1000
+        self.delivered = dddp.changelog.DeliveredChanges(
+            baseline=10, retention=60, clock=lambda: self.now,
+        )
+
+    def test_duplicates(self):
+        """Changes are only delivered once."""
+        self.assertEqual(
+            [self.delivered.add(change_id) for change_id in [12, 11, 12, 11]],
+            [True, True, False, False],
+        )
+
+    def test_replay_from(self):
+        """Replay starts after the last change delivered before then."""
+        self.assertEqual(self.delivered.replay_from(self.now), 10)
+        self.delivered.add(13)
+        self.now += 10
+        self.delivered.add(11)  # committed after 13.
+        self.now += 10
+        self.delivered.add(14)
+        self.assertEqual(self.delivered.replay_from(1000), 13)
+        self.assertEqual(self.delivered.replay_from(1015), 13)
+        self.assertEqual(self.delivered.replay_from(1020), 14)
+        self.assertEqual(self.delivered.replay_from(999), 10)
+
+    def test_expiry(self):
+        """Changes delivered long ago move the baseline forward."""
+        self.delivered.add(12)
+        self.now += 61
+        self.delivered.add(13)
+        self.assertEqual(self.delivered.baseline, 12)
+        self.assertEqual(self.delivered.replay_from(0), 12)
+        self.assertTrue(self.delivered.add(12))  # forgotten.
+
+
+class ChangeLogReplayTestCase(django.test.TransactionTestCase):
+
+    """Test changes missed while LISTEN was disconnected are replayed."""
+
+    class Receiver(dddp.postgres.ChangeReceiver):
+
+        """Receiver noting changes processed and resyncs."""
+
+        def __init__(self):
+            """Start out never connected."""
+            self.logger = logging.getLogger(__name__)
+            self.connections = {}
+            self.delivered = None
+            self.lost_at = None
+            self.received = []
+            self.resyncs = 0
+
+        def process(self, data):
+            """Note data processed."""
+            self.received.append(data)
+
+        def resync(self):
+            """Note resync."""
+            self.resyncs += 1
+
+    def setUp(self):
+        """Enable change log, connect receiver."""
+        self.saved = {
+            name: getattr(dddp.changelog, name)
+            for name in ('CHANGE_LOG', 'CHANGE_LOG_MAX_REPLAY')
+        }
+        dddp.changelog.CHANGE_LOG = True
+        self.receiver = self.Receiver()
+        self.log_change(0)
+        self.receiver.recover()  # first connection, nothing missed.
+
+    def tearDown(self):
+        """Restore change log settings."""
+        for name, val in self.saved.items():
+            setattr(dddp.changelog, name, val)
+
+    @staticmethod
+    def log_change(num):
+        """Log change, returning its ID."""
+        from django.db import connection
+        with connection.cursor() as cursor:
+            return dddp.changelog.log_change(cursor, {'num': num})
+
+    def reconnect(self):
+        """Lose connection after changes 1 and 2, with 2 delivered."""
+        self.log_change(1)
+        change_id = self.log_change(2)
+        self.receiver.receive({'num': 2, '_change_id': change_id})
+        self.receiver.lost_at = time.time()
+        self.receiver.recover()
+        self.assertIsNone(self.receiver.lost_at)
+
+    def test_replay(self):
+        """Missed changes are replayed, those delivered aren't repeated."""
+        self.reconnect()
+        self.assertEqual(self.receiver.received, [{'num': 2}, {'num': 1}])
+        self.assertEqual(self.receiver.resyncs, 0)
+
+    def test_too_many(self):
+        """Connections are resynced if too many changes were missed."""
+        dddp.changelog.CHANGE_LOG_MAX_REPLAY = 1
+        self.reconnect()
+        self.assertEqual(self.receiver.received, [{'num': 2}])
+        self.assertEqual(self.receiver.resyncs, 1)
+
+    def test_no_change_log(self):
+        """Connections are resynced if changes aren't logged."""
+        dddp.changelog.CHANGE_LOG = False
+        self.receiver.lost_at = time.time()
+        self.receiver.recover()
+        self.assertIsNone(self.receiver.lost_at)
+        self.assertEqual(self.receiver.resyncs, 1)
+
+
+class RelayTestCase(unittest.TestCase):
+
+    """Test the relay routes changes to worker processes."""
+
+    def setUp(self):
+        """Create relay (not listening on a path)."""
+        from dddp.relay import RelayGreenlet
+        self.relay = RelayGreenlet(ListenReconnectTestCase.Conn(), None)
+        self.handlers = []
+        self.files = {}
+
+    def tearDown(self):
+        """Disconnect workers."""
+        gevent.killall(self.handlers)
+
+    def connect(self, *connection_ids):
+        """Return socket for new worker owning connection_ids."""
+        relay_sock, sock = socket.socketpair()
+        sock.settimeout(1)
+        self.handlers.append(gevent.spawn(self.relay.handle, relay_sock, None))
+        self.send(sock, register=list(connection_ids))
+        return sock
+
+    @staticmethod
+    def send(sock, **msg):
+        """Send msg to relay from worker sock, letting the relay read it."""
+        sock.sendall(('%s\n' % ejson.dumps(msg)).encode('utf-8'))
+        gevent.sleep(0.01)
+
+    def recv(self, sock):
+        """Return next message received by worker sock."""
+        if sock not in self.files:
+            self.files[sock] = sock.makefile('r')
+        return ejson.loads(self.files[sock].readline())
+
+    def test_register(self):
+        """Workers own the connections they register until unregistered."""
+        sock = self.connect('a', 'b')
+        self.assertEqual(sorted(self.relay.owners), ['a', 'b'])
+        self.assertIs(self.relay.owners['a'], self.relay.owners['b'])
+        self.send(sock, unregister=['a'])
+        self.assertEqual(sorted(self.relay.owners), ['b'])
+
+    def test_fan_out(self):
+        """Changes are sent to the owning workers only."""
+        sock_1 = self.connect('a', 'b')
+        sock_2 = self.connect('c')
+        self.connect('d')
+        self.relay.process(
+            {'msg': 'added', '_connection_ids': ['a', 'c', 'x']},
+        )
+        self.assertEqual(
+            self.recv(sock_1), {'msg': 'added', '_connection_ids': ['a']},
+        )
+        self.assertEqual(
+            self.recv(sock_2), {'msg': 'added', '_connection_ids': ['c']},
+        )
+        self.relay.resync()
+        self.assertEqual(self.recv(sock_1), {'_resync': True})
+        self.assertEqual(self.recv(sock_2), {'_resync': True})
+
+    def test_disconnect(self):
+        """Connections owned by a worker are forgotten when it goes away."""
+        sock = self.connect('a', 'b')
+        worker = self.relay.owners['a']
+        self.connect('c')
+        sock.close()
+        self.handlers[0].join(1)
+        self.assertTrue(self.handlers[0].ready())
+        self.assertEqual(sorted(self.relay.owners), ['c'])
+        self.assertTrue(worker.writer.dead)
+
+    def test_slow_worker(self):
+        """Workers falling behind are dropped rather than blocking."""
+        from dddp.relay import RelayWorker
+        relay_sock, sock = socket.socketpair()
+        sock.settimeout(1)
+        self.relay.owners['a'] = RelayWorker(relay_sock, size=1)
+        # no chance for the writer to run in between.
+        self.relay.process({'msg': 'added', '_connection_ids': ['a']})
+        self.relay.process({'msg': 'changed', '_connection_ids': ['a']})
+        self.assertEqual(sock.makefile('r').read(), '')  # disconnected.
+        self.relay.owners['a'].close()
+
+
+class ResyncTestCase(unittest.TestCase):
+
+    """Test coalescing of resync requests."""
+
+    def test_coalesce(self):
+        """At most one resync is pending or running per connection."""
+        app = dddp.websocket.DDPWebSocketApplication.__new__(
+            dddp.websocket.DDPWebSocketApplication,
+        )
+        spawned = []
+        app.spawn = lambda func, *args: spawned.append(func)
+        app.request_resync()
+        app.request_resync()
+        self.assertEqual(len(spawned), 1)
+        # requests while running cause exactly one more pass.
+        self.assertTrue(app._resync_next())
+        app.request_resync()
+        app.request_resync()
+        self.assertTrue(app._resync_next())
+        self.assertFalse(app._resync_next())
+        self.assertEqual(len(spawned), 1)
+        # idle again, so next request spawns.
+        app.request_resync()
+        self.assertEqual(len(spawned), 2)
+
+
+class EJSONFieldTestCase(django.test.TestCase):
+
+    """Test EJSONField storage, `contains` lookup and params filters."""
+
+    def setUp(self):
+        """Create some subscriptions with params."""
+        from dddp.models import Connection, Subscription
+        connection = Connection.objects.create(server_addr='test')
+        for sub_id, publication, params in [
+                ('a', 'Tasks', ['list1', {'done': False}]),
+                ('b', 'Tasks', ['list2']),
+                ('c', 'Other', ['list1']),
+        ]:
+            Subscription.objects.create(
+                connection=connection,
+                sub_id=sub_id,
+                publication=publication,
+                params=params,
+            )
+
+    def sub_ids(self, *args, **kwargs):
+        """Return sorted sub_ids of subscriptions matching filter."""
+        from dddp.models import Subscription
+        return sorted(
+            Subscription.objects.filter(
+                *args, **kwargs
+            ).values_list('sub_id', flat=True),
+        )
+
+    def test_round_trip(self):
+        """Params are decoded as EJSON when loaded."""
+        from dddp.models import Subscription
+        sub = Subscription.objects.get(sub_id='a')
+        self.assertEqual(sub.params, ['list1', {'done': False}])
+        self.assertEqual(
+            list(
+                Subscription.objects.filter(
+                    sub_id='a',
+                ).values_list('params', flat=True),
+            ),
+            [['list1', {'done': False}]],
+        )
+        sub.params_ejson = '[{"$date": 0}]'
+        sub.save()
+        self.assertEqual(
+            Subscription.objects.get(sub_id='a').params_ejson,
+            sub.params_ejson,
+        )
+
+    def test_contains(self):
+        """`params__contains` uses JSONB containment."""
+        self.assertEqual(self.sub_ids(params__contains=['list1']), ['a', 'c'])
+        self.assertEqual(
+            self.sub_ids(params__contains=[{'done': False}]), ['a'],
+        )
+        self.assertEqual(self.sub_ids(params__contains=['list3']), [])
+
+    def test_params_filter(self):
+        """Publications with get_params_filter narrow down subscriptions."""
+        from dddp.api import DDP, Publication
+
+        class Tasks(Publication):
+
+            """Publication of tasks in the list given as param."""
+
+            queries = []
+
+            def get_params_filter(self, model, obj):
+                """Only subscriptions to obj's list."""
+                return None if obj is None else [obj]
+
+        api = DDP()
+        api.register(Tasks)
+        # other publications are never restricted
+        self.assertEqual(
+            self.sub_ids(api.params_filter(None, 'list2')), ['b', 'c'],
+        )
+        # None means any params may match
+        self.assertIsNone(api.params_filter(None, None))
+
+
+class IdCacheTestCase(django.test.TransactionTestCase):
+
+    """Test caching of ObjectMapping meteor IDs."""
+
+    class Rollback(Exception):
+
+        """Abort transaction."""
+
+    def test_rollback(self):
+        """Mappings created by a rolled back transaction aren't cached."""
+        from django.contrib.contenttypes.models import ContentType
+        from django.db import transaction
+        from dddp.idcache import ID_CACHE
+        from dddp.models import get_meteor_id, get_meteor_ids
+        from django_todos.models import Task
+        ID_CACHE.clear()
+        task = Task.objects.create(text='task')
+        content_type = ContentType.objects.get_for_model(Task)
+        with self.assertRaises(self.Rollback):
+            with transaction.atomic():
+                rolled_back = get_meteor_id(task)
+                # read back within the transaction that created it.
+                get_meteor_ids(Task, [task.pk])
+                raise self.Rollback()
+        self.assertIsNone(ID_CACHE.get_meteor_id(content_type.pk, task.pk))
+        committed = get_meteor_id(task)
+        self.assertNotEqual(committed, rolled_back)
+        self.assertEqual(
+            list(get_meteor_ids(Task, [task.pk]).values()), [committed],
+        )
+        self.assertEqual(
+            ID_CACHE.get_meteor_id(content_type.pk, task.pk), committed,
+        )
+
+
+class SnapshotQueryTestCase(django.test.TransactionTestCase):
+
+    """Test collections read concurrently from an exported snapshot."""
+
+    def setUp(self):
+        """Create tasks and query for them twice."""
+        from dddp.api import API
+        from django_todos.models import Task
+        self.tasks = [
+            Task.objects.create(text='task %d' % num) for num in range(3)
+        ]
+        qs, col = API.qs_and_collection(Task.objects.order_by('pk'))
+        self.col_queries = [(col, qs), (col, qs)]
+
+    def tearDown(self):
+        """Forget fake websocket."""
+        del dddp.this.ws
+
+    def added_ids(self, db_pool=None):
+        """Return lists of meteor IDs sent as `added` for col_queries."""
+        from django.db import transaction
+        from dddp.api import API
+        dddp.this.ws = collections.namedtuple('WS', 'db_pool')(db_pool)
+        with transaction.atomic():
+            return [
+                [payload['id'] for payload in payloads]
+                for payloads
+                in API.concurrent_added_msgs(self.col_queries, 'default')
+            ]
+
+    def test_mappings_outside_snapshot(self):
+        """ObjectMappings are created outside the read only snapshot."""
+        from dddp.models import ObjectMapping, get_meteor_ids
+        from django_todos.models import Task
+        self.assertFalse(ObjectMapping.objects.exists())
+        added = self.added_ids()
+        expected = list(get_meteor_ids(
+            Task, [task.pk for task in self.tasks],
+        ).values())
+        self.assertEqual(added, [expected, expected])
+        self.assertEqual(ObjectMapping.objects.count(), len(self.tasks))
+
+    def test_pooled(self):
+        """Snapshot queries borrow connections from the pool."""
+        from dddp.dbpool import DatabasePool
+        db_pool = DatabasePool(size=1, timeout=1)
+        try:
+            self.assertEqual(
+                [len(ids) for ids in self.added_ids(db_pool)],
+                [len(self.tasks)] * 2,
+            )
+            self.assertEqual(db_pool.counts['acquired'], 2)
+            self.assertEqual(db_pool.counts['created'], 1)
+            self.assertEqual(db_pool.in_use, 0)
+        finally:
+            db_pool.close_all()
+
+
+class ReplicaTestCase(django.test.TestCase):
+
+    """Test routing of subscription reads to a read replica."""
+
+    def setUp(self):
+        """Route reads to a (pretend) replica."""
+        import dddp.replica
+        self.replica = dddp.replica
+        self.saved = {
+            name: getattr(dddp.replica, name)
+            for name in ('READ_REPLICA', 'replica_caught_up', 'wal_position')
+        }
+        dddp.replica.READ_REPLICA = 'replica'
+        dddp.replica.wal_position = lambda using: '0/3000060'
+        dddp.replica.REPLICA_STATS.clear()
+
+    def tearDown(self):
+        """Restore replica settings."""
+        for name, val in self.saved.items():
+            setattr(self.replica, name, val)
+
+    def read_from(self, lag=None):
+        """Return alias used for reads with replica lagging lag bytes."""
+        from django.db import OperationalError
+
+        def replica_caught_up(replica, lsn):
+            """Fake replica check."""
+            self.assertEqual((replica, lsn), ('replica', '0/3000060'))
+            if lag is None:
+                raise OperationalError('replica down')
+            return lag <= 0
+        self.replica.replica_caught_up = replica_caught_up
+        with self.replica.read_replica('default') as alias:
+            return alias
+
+    def test_hit(self):
+        """Caught up replica is used."""
+        self.assertEqual(self.read_from(0), 'replica')
+        self.assertEqual(self.replica.REPLICA_STATS, {'hit': 1})
+
+    def test_fallback(self):
+        """Reads fall back to the primary if the replica lags or fails."""
+        self.assertIsNone(self.read_from(8))
+        self.assertIsNone(self.read_from())
+        self.assertEqual(
+            self.replica.REPLICA_STATS, {'fallback': 2, 'errors': 1},
+        )
+
+    def test_same_database(self):
+        """Primary reads aren't routed (or counted) if it is the replica."""
+        self.replica.READ_REPLICA = 'default'
+        self.assertIsNone(self.read_from(0))
+        self.assertEqual(self.replica.REPLICA_STATS, {})
+
+    def test_primary_caught_up(self):
+        """A database not in recovery is always caught up."""
+        lsn = self.saved['wal_position']('default')
+        six.assertRegex(self, lsn, r'^[0-9A-F]+/[0-9A-F]+$')
+        self.assertTrue(self.saved['replica_caught_up']('default', lsn))
+        self.assertTrue(
+            self.saved['replica_caught_up']('default', lsn, max_lag=1024),
+        )
+
+
+class PreparedTestCase(django.test.TransactionTestCase):
+
+    """Test recovery from prepared statement failures."""
+
+    def setUp(self):
+        """Create task, forget statements prepared by other tests."""
+        from django.db import connection
+        from django_todos.models import Task
+        self.task = Task.objects.create(text='task')
+        self.qs = Task.objects.filter(pk=self.task.pk).values_list('text')
+        connection.close()  # statements go with the connection.
+        dddp.prepared.PREPARED_STATS.clear()
+
+    def test_deallocated(self):
+        """Statements gone from the connection are run unprepared."""
+        from django.db import connection, transaction
+        with transaction.atomic():
+            self.assertEqual(dddp.prepared.values(self.qs), [('task',)])
+            with connection.cursor() as cursor:
+                cursor.execute('DEALLOCATE ALL')
+            self.assertEqual(dddp.prepared.values(self.qs), [('task',)])
+            # transaction still usable, statement prepared again.
+            self.assertEqual(dddp.prepared.values(self.qs), [('task',)])
+        self.assertEqual(
+            dddp.prepared.PREPARED_STATS,
+            {'prepared': 2, 'executed': 2, 'missing': 1},
+        )
+
+    def test_lock_timeout(self):
+        """Statements failing to prepare for a while are prepared later."""
+        from django.db import connection
+        sql, _ = dddp.prepared.compiled(self.qs)
+        name = dddp.prepared.statement_name(sql)
+        locker = connection.get_new_connection(
+            connection.get_connection_params(),
+        )
+        try:
+            with locker.cursor() as cursor:
+                cursor.execute(
+                    'LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % (
+                        self.task._meta.db_table,
+                    ),
+                )
+            with connection.cursor() as cursor:
+                cursor.execute("SET lock_timeout = '10ms'")
+            self.assertIsNone(dddp.prepared.prepare('default', sql))
+        finally:
+            locker.close()
+        self.assertNotIn(name, dddp.prepared._UNPREPARABLE)
+        self.assertEqual(dddp.prepared.prepare('default', sql), name)
+        self.assertEqual(
+            dddp.prepared.PREPARED_STATS, {'errors': 1, 'prepared': 1},
+        )
+
+    def test_syntax_error(self):
+        """Statements the database can't prepare are never tried again."""
+        sql = 'SELEKT 1'
+        self.assertIsNone(dddp.prepared.prepare('default', sql))
+        self.assertIn(
+            dddp.prepared.statement_name(sql), dddp.prepared._UNPREPARABLE,
+        )
+        self.assertIsNone(dddp.prepared.prepare('default', sql))
+        self.assertEqual(dddp.prepared.PREPARED_STATS, {'errors': 1})
+
+
+class NullableAleaIdTestCase(django.test.TestCase):
+
+    """Test meteor IDs of a model with a nullable unique AleaIdField."""
+
+    def setUp(self):
+        """Create notes with and without an `aid` value."""
+        from django_todos.models import Note
+        self.filled = Note.objects.create(text='filled')
+        self.empty = Note.objects.create(text='empty')
+        Note.objects.filter(pk=self.empty.pk).update(aid=None)
+        self.empty.aid = None
+
+    def mappings(self):
+        """Return (object_id, meteor_id) of ObjectMappings for notes."""
+        from django.contrib.contenttypes.models import ContentType
+        from dddp.models import ObjectMapping
+        from django_todos.models import Note
+        return list(
+            ObjectMapping.objects.filter(
+                content_type=ContentType.objects.get_for_model(Note),
+            ).values_list('object_id', 'meteor_id'),
+        )
+
+    def test_get_meteor_ids(self):
+        """Mappings are only created for objects without an `aid`."""
+        from dddp.models import get_meteor_ids
+        from django_todos.models import Note
+        result = get_meteor_ids(Note, [self.filled.pk, self.empty.pk])
+        self.assertEqual(result[str(self.filled.pk)], self.filled.aid)
+        empty_pk = str(self.empty.pk)
+        self.assertEqual(self.mappings(), [(empty_pk, result[empty_pk])])
+
+    def test_create_object_mapping(self):
+        """Eager mappings are only created for objects without an `aid`."""
+        from dddp.api import DDP, Collection
+        from django_todos.models import Note
+
+        class Notes(Collection):
+
+            """Collection of notes."""
+
+            model = Note
+
+        api = DDP()
+        api.register(Notes)
+        api.create_object_mapping(Note, self.filled)
+        self.assertEqual(self.mappings(), [])
+        api.create_object_mapping(Note, self.empty)
+        self.assertEqual(
+            [object_id for object_id, _ in self.mappings()],
+            [str(self.empty.pk)],
+        )
+
+
+class BackfillAleaIdsTestCase(django.test.TestCase):
+
+    """Test batched backfill of empty AleaIdField values."""
+
+    class Interrupted(Exception):
+
+        """Backfill stopped part way through."""
+
+    def setUp(self):
+        """Create notes, all but the first without an `aid` value."""
+        from django.contrib.contenttypes.models import ContentType
+        from dddp.models import ObjectMapping
+        from django_todos.models import Note
+        self.notes = [
+            Note.objects.create(text='note %d' % num) for num in range(5)
+        ]
+        Note.objects.filter(
+            pk__in=[note.pk for note in self.notes[1:]],
+        ).update(aid=None)
+        # meteor ID already handed out for the last note.
+        ObjectMapping.objects.create(
+            content_type=ContentType.objects.get_for_model(Note),
+            object_id=str(self.notes[-1].pk),
+            meteor_id='MappedMeteorId123',
+        )
+
+    def aids(self):
+        """Return list of `aid` values for notes in pk order."""
+        from django_todos.models import Note
+        return list(Note.objects.order_by('pk').values_list('aid', flat=True))
+
+    def test_resume(self):
+        """Interrupted backfill resumes, skipping values already filled."""
+        from dddp.migrations import backfill_alea_ids
+        from django_todos.models import Note
+
+        def interrupt(*args):
+            """Stop after the first batch."""
+            raise self.Interrupted(args)
+
+        with self.assertRaises(self.Interrupted):
+            backfill_alea_ids(Note, 'aid', batch_size=3, report=interrupt)
+        partial = self.aids()
+        self.assertEqual(partial[0], self.notes[0].aid)
+        self.assertEqual([bool(aid) for aid in partial], [True] * 4 + [False])
+        reports = []
+        self.assertEqual(
+            backfill_alea_ids(
+                Note, 'aid', batch_size=3,
+                report=lambda *args: reports.append(args[2:4]),
+            ),
+            1,
+        )
+        self.assertEqual(reports, [(1, 1)])
+        self.assertEqual(self.aids(), partial[:4] + ['MappedMeteorId123'])
+
+    def test_command(self):
+        """Management command reports progress according to verbosity."""
+        from django.core.management import call_command
+        stdout = six.StringIO()
+        call_command(
+            'backfill_alea_ids', 'django_todos.Note',
+            verbosity=0, stdout=stdout,
+        )
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertTrue(all(self.aids()))
+        call_command('backfill_alea_ids', 'django_todos.Note', stdout=stdout)
+        self.assertIn(
+            'django_todos.Note: backfilled 0 rows.', stdout.getvalue(),
+        )
+
 
 def load_tests(loader, tests, pattern):
     """Specify which test cases to run."""
@@ -2,25 +2,37 @@
 
 from __future__ import absolute_import, print_function
 
-import atexit
 import collections
-import inspect
+import contextlib
+import functools
 import itertools
+import socket
 import sys
+import time
 import traceback
 
-from six.moves import range as irange
-
 import ejson
 import gevent
+import gevent.event
+import gevent.pool
+import gevent.queue
 import geventwebsocket
+import six
 from django.conf import settings
 from django.core import signals
+from django.core.exceptions import ImproperlyConfigured
 from django.core.handlers.base import BaseHandler
 from django.core.handlers.wsgi import WSGIRequest
-from django.db import connection, transaction
+from django.db import (
+    connection, close_old_connections, transaction, DatabaseError,
+)
 
-from dddp import alea, this, ADDED, CHANGED, REMOVED, MeteorError
+from dddp import (
+    alea, this, ADDED, CHANGED, REMOVED, ArgSpec, MeteorError,
+    TX_NONE, TX_ATOMIC, TX_SNAPSHOT, TX_POLICIES,
+)
+from dddp.dbpool import PoolTimeout
+from dddp.ratelimit import buckets, rate_limit, RATE_LIMITS, SUB_LOADS
 
 
 def safe_call(func, *args, **kwargs):
@@ -56,59 +68,275 @@ def dprint(name, val):
 
 def validate_kwargs(func, kwargs):
     """Validate arguments to be supplied to func."""
-    func_name = func.__name__
-    argspec = inspect.getargspec(func)
-    all_args = argspec.args[:]
-    defaults = list(argspec.defaults or [])
-
-    # ignore implicit 'self' argument
-    if inspect.ismethod(func) and all_args[:1] == ['self']:
-        all_args[:1] = []
-
-    # don't require arguments that have defaults
-    if defaults:
-        required = all_args[:-len(defaults)]
-    else:
-        required = all_args[:]
-
-    # translate 'foo_' to avoid reserved names like 'id'
-    trans = {
-        arg: arg.endswith('_') and arg[:-1] or arg
-        for arg
-        in all_args
-    }
-    for key in list(kwargs):
-        key_adj = '%s_' % key
-        if key_adj in all_args:
-            kwargs[key_adj] = kwargs.pop(key)
-
-    # figure out what we're missing
-    supplied = sorted(kwargs)
-    missing = [
-        trans.get(arg, arg) for arg in required
-        if arg not in supplied
-    ]
-    if missing:
-        raise MeteorError(
-            400,
-            func.err,
-            'Missing required arguments to %s: %s' % (
-                func_name,
-                ' '.join(missing),
-            ),
-        )
+    ArgSpec(func).validate_kwargs(kwargs)
 
-    # figure out what is extra
-    extra = [
-        arg for arg in supplied
-        if arg not in all_args
-    ]
-    if extra:
-        raise MeteorError(
-            400,
-            func.err,
-            'Unknown arguments to %s: %s' % (func_name, ' '.join(extra)),
-        )
+
+@contextlib.contextmanager
+def transaction_policy(policy, using=None):
+    """Context manager to run a block under the given transaction policy."""
+    if policy == TX_NONE:
+        yield
+        return
+    conn = transaction.get_connection(using)
+    outermost = not conn.in_atomic_block
+    with transaction.atomic(using=using):
+        if policy == TX_SNAPSHOT and outermost:
+            # must be the first statement in the transaction.
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, '
+                    'READ ONLY',
+                )
+        yield
+
+
+def merge_changed(old, new):
+    """
+    Merge two `changed` messages for the same object, `new` taking precedence.
+
+    >>> merged = merge_changed(
+    ...     {'msg': 'changed', 'id': 'a', 'fields': {'x': 1, 'y': 2}},
+    ...     {'msg': 'changed', 'id': 'a', 'fields': {'x': 3},
+    ...      'cleared': ['y']},
+    ... )
+    >>> sorted(merged['fields'].items()), merged['cleared']
+    ([('x', 3)], ['y'])
+    """
+    new_fields = new.get('fields', {})
+    fields = dict(old.get('fields', {}))
+    fields.update(new_fields)
+    cleared = set(old.get('cleared', [])).difference(new_fields)
+    cleared.update(new.get('cleared', []))
+    for name in cleared:
+        fields.pop(name, None)
+    merged = dict(new)
+    merged.pop('fields', None)
+    merged.pop('cleared', None)
+    if fields:
+        merged['fields'] = fields
+    if cleared:
+        merged['cleared'] = sorted(cleared)
+    return merged
+
+
+def conflate(msgs):
+    """
+    Collapse queued `added`/`changed`/`removed` msgs into their net effect.
+
+    Each object is reduced to at most two messages at the position of its
+    first message, other messages keep their relative order.
+
+    >>> [(msg['msg'], msg.get('id'), msg.get('fields')) for msg in conflate([
+    ...     {'msg': 'added', 'collection': 'c', 'id': 'a', 'fields': {'x': 1}},
+    ...     {'msg': 'ready', 'subs': ['s']},
+    ...     {'msg': 'changed', 'collection': 'c', 'id': 'a',
+    ...      'fields': {'x': 2}},
+    ...     {'msg': 'changed', 'collection': 'c', 'id': 'b',
+    ...      'fields': {'y': 1}},
+    ...     {'msg': 'removed', 'collection': 'c', 'id': 'b'},
+    ...     {'msg': 'added', 'collection': 'c', 'id': 'd', 'fields': {}},
+    ...     {'msg': 'removed', 'collection': 'c', 'id': 'd'},
+    ... ])]
+    [('added', 'a', {'x': 2}), ('ready', None, None), ('removed', 'b', None)]
+    """
+    ops = {}
+    order = []
+    for msg in msgs:
+        if (
+            isinstance(msg, dict)
+        ) and (
+            msg.get('msg') in (ADDED, CHANGED, REMOVED)
+        ):
+            key = (msg['collection'], msg['id'])
+            if key not in ops:
+                ops[key] = []
+                order.append(key)
+            ops[key].append(msg)
+        else:
+            order.append(msg)
+    result = []
+    for item in order:
+        if isinstance(item, tuple):
+            result.extend(net_effect(ops[item]))
+        else:
+            result.append(item)
+    return result
+
+
+def net_effect(seq):
+    """Return msgs with the same net effect as the sequence for one object."""
+    had_before = seq[0]['msg'] != ADDED
+    if seq[-1]['msg'] == REMOVED:
+        return [seq[-1]] if had_before else []
+    added = [idx for idx, msg in enumerate(seq) if msg['msg'] == ADDED]
+    if not added:
+        return [functools.reduce(merge_changed, seq)]
+    start = added[-1]
+    msg = functools.reduce(merge_changed, seq[start:])
+    msg['msg'] = ADDED
+    msg.pop('cleared', None)
+    if had_before:
+        # object was removed before being added again.
+        return [seq[start - 1], msg]
+    return [msg]
+
+
+class ReorderBuffer(object):
+
+    """
+    Release items in sequential order of their reserved IDs.
+
+    Gaps in the sequence (eg: a reserved ID whose item never arrives) are
+    skipped once they have been open for `gap_timeout` seconds or more than
+    `max_size` items are waiting.  `on_skip(reason)` is called whenever items
+    are skipped or late items dropped so the caller can recover.
+
+    >>> buf = ReorderBuffer(max_size=2, gap_timeout=None)
+    >>> first, second, third, fourth = [buf.reserve() for _ in range(4)]
+    >>> buf.push(second, 'b')
+    []
+    >>> buf.push(first, 'a')
+    ['a', 'b']
+    >>> buf.push(buf.reserve(), 'e'), buf.push(buf.reserve(), 'f')
+    ([], [])
+    >>> buf.push(buf.reserve(), 'g')  # over max_size, skip the gap
+    ['e', 'f', 'g']
+    >>> buf.push(third, 'c')  # too late
+    []
+    >>> sorted(buf.stats.items())
+    [('gaps', 1), ('late', 1), ('released', 5), ('skipped', 2)]
+    """
+
+    def __init__(
+            self, max_size=None, gap_timeout=None, on_skip=None,
+            clock=time.time,
+    ):
+        """Initialise empty buffer."""
+        self.max_size = max_size
+        self.gap_timeout = gap_timeout
+        self.on_skip = on_skip
+        self.clock = clock
+        self.stats = collections.Counter()
+        self.gap_since = None
+        self._items = {}
+        self._id_gen = itertools.count()
+        self._next_id = 0
+
+    def __len__(self):
+        """Number of items waiting for a gap to be filled."""
+        return len(self._items)
+
+    def reserve(self):
+        """Reserve and return the next ID in the sequence."""
+        return next(self._id_gen)
+
+    def push(self, item_id, item):
+        """Add item, returning list of items now ready (in order)."""
+        if item_id < self._next_id:
+            # gap was already skipped, sending now would be out of order.
+            self.stats['late'] += 1
+            if self.on_skip is not None:
+                self.on_skip('late')
+            return []
+        self._items[item_id] = item
+        return self.expire()
+
+    def expire(self):
+        """Skip gaps as required, returning list of items now ready."""
+        ready = self._release()
+        if not self._items:
+            return ready
+        if (
+            self.max_size is not None and len(self._items) > self.max_size
+        ) or (
+            self.gap_timeout is not None
+            and self.clock() - self.gap_since >= self.gap_timeout
+        ):
+            skip_to = min(self._items)
+            self.stats['gaps'] += 1
+            self.stats['skipped'] += skip_to - self._next_id
+            self._next_id = skip_to
+            ready.extend(self._release())
+            if self.on_skip is not None:
+                self.on_skip('gap')
+        return ready
+
+    def clear(self):
+        """Drop all waiting items."""
+        self._items.clear()
+        self.gap_since = None
+
+    def _release(self):
+        """Return items from the head of the sequence, tracking gaps."""
+        ready = []
+        while self._next_id in self._items:
+            ready.append(self._items.pop(self._next_id))
+            self._next_id += 1
+        self.stats['released'] += len(ready)
+        if not self._items:
+            self.gap_since = None
+        elif ready or self.gap_since is None:
+            self.gap_since = self.clock()  # waiting on a (new) gap
+        return ready
+
+
+# limits on number/size of messages sent in a single SockJS frame
+SEND_BATCH_MAX_MSGS = int(getattr(settings, 'DDP_SEND_BATCH_MAX_MSGS', 1000))
+SEND_BATCH_MAX_BYTES = int(
+    getattr(settings, 'DDP_SEND_BATCH_MAX_BYTES', 64 * 1024),
+)
+
+
+# queued messages per connection before DDP_SLOW_CONSUMER_POLICY is applied
+SEND_QUEUE_HIGH_WATER = int(
+    getattr(settings, 'DDP_SEND_QUEUE_HIGH_WATER', 100000),
+)
+# 'resync' (conflate queued messages, then disconnect if still behind) or
+# 'disconnect' (close connection, client will reconnect and resync).
+SLOW_CONSUMER_POLICY = getattr(settings, 'DDP_SLOW_CONSUMER_POLICY', 'resync')
+# process wide counters for outbound queues
+SEND_QUEUE_STATS = collections.Counter()
+# process wide counters for tx-ordered message recovery
+TX_BUFFER_STATS = collections.Counter()
+
+# seconds of silence from client before sending a heartbeat (0 disables)
+HEARTBEAT_INTERVAL = float(
+    getattr(settings, 'DDP_WEBSOCKET_HEARTBEAT_INTERVAL', 15),
+)
+# seconds of silence from client before closing connection (0 disables)
+IDLE_TIMEOUT = float(getattr(settings, 'DDP_WEBSOCKET_IDLE_TIMEOUT', 45))
+# messages read ahead from the client while earlier ones are processed.
+RECV_QUEUE_MAX = int(getattr(settings, 'DDP_RECV_QUEUE_MAX', 100))
+
+# seconds to wait for a missing tx-ordered message before skipping it
+TX_GAP_TIMEOUT = float(getattr(settings, 'DDP_TX_GAP_TIMEOUT', 5))
+# max messages waiting for a missing tx-ordered message before skipping it
+TX_BUFFER_MAX = int(getattr(settings, 'DDP_TX_BUFFER_MAX', 1000))
+# 'skip' (just send what we have) or 'resync' (also resend all subs)
+TX_GAP_RECOVERY = getattr(settings, 'DDP_TX_GAP_RECOVERY', 'resync')
+
+# max methods running concurrently per connection (after `this.unblock()`)
+METHOD_CONCURRENCY = int(getattr(settings, 'DDP_METHOD_CONCURRENCY', 4))
+# greenlet local state that isn't shared with method greenlets.
+METHOD_LOCAL_STATE = ('alea_random', 'random_streams', 'unblock')
+
+# transaction policy by DDP message type, method endpoints may override the
+# policy for `method` using `api_endpoint(tx_policy=...)`.
+TRANSACTION_POLICIES = {
+    'connect': TX_ATOMIC,
+    'ping': TX_NONE,
+    'pong': TX_NONE,
+    'sub': TX_ATOMIC,
+    'unsub': TX_ATOMIC,
+    'method': TX_ATOMIC,
+}
+TRANSACTION_POLICIES.update(getattr(settings, 'DDP_TRANSACTION_POLICIES', {}))
+if not set(TRANSACTION_POLICIES.values()).issubset(TX_POLICIES):
+    raise ImproperlyConfigured(
+        'DDP_TRANSACTION_POLICIES values must be one of: %s' % (
+            ', '.join(TX_POLICIES),
+        ),
+    )
 
 
 class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
@@ -116,9 +344,19 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
     """Django DDP WebSocket application."""
 
     _tx_buffer = None
-    _tx_buffer_id_gen = None
-    _tx_next_id_gen = None
-    _tx_next_id = None
+    _tx_gap_timer = None
+    _coalesce_pending = None
+    _outbox = None
+    _outbox_event = None
+    _writer_greenlet = None
+    _heartbeat_greenlet = None
+    _method_pool = None
+    _rate_buckets = None
+    _inbox = None
+    _handler_greenlet = None
+    _resync_state = None
+    max_queue_depth = 0
+    last_recv = None
 
     methods = {}
     versions = [  # first item is preferred version
@@ -130,15 +368,73 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
     logger = None
     pgworker = None
     remote_addr = None
+    server_addr = None
+    db_pool = None
     version = None
     support = None
     connection = None
     remote_ids = None
     base_handler = BaseHandler()
+    _recv_argspecs = None
+
+    @classmethod
+    def recv_argspecs(cls):
+        """Cached dict of msg: ArgSpec for all recv_foo handlers."""
+        # look in cls.__dict__ so subclasses compile their own handlers.
+        if cls.__dict__.get('_recv_argspecs', None) is None:
+            cls._recv_argspecs = {
+                name[5:]: ArgSpec(getattr(cls, name), skip_self=True)
+                for name
+                in dir(cls)
+                if name.startswith('recv_') and callable(getattr(cls, name))
+            }
+        return cls._recv_argspecs
+
+    def recv_argspec(self, msg, handler):
+        """Return ArgSpec for recv_foo `handler` of given `msg`."""
+        try:
+            return self.recv_argspecs()[msg]
+        except KeyError:
+            # handler attached to the instance rather than the class.
+            return ArgSpec(handler)
 
     def get_tx_id(self):
         """Get the next TX msg ID."""
-        return next(self._tx_buffer_id_gen)
+        return self._tx_buffer.reserve()
+
+    def handle(self):
+        """Process messages in order while a reader greenlet receives them."""
+        # reading independently of processing means we still hear from the
+        # client (eg: `pong`) while a long running handler is busy.
+        self._inbox = gevent.queue.Queue(RECV_QUEUE_MAX)
+        self._handler_greenlet = gevent.getcurrent()
+        self.protocol.on_open()
+        reader = gevent.spawn(self._reader)
+        try:
+            while True:
+                message = self._inbox.get()
+                if message is StopIteration:
+                    break
+                self.protocol.on_message(message)
+        finally:
+            reader.kill(block=False)
+        self.protocol.on_close()
+
+    def _reader(self):
+        """Receive messages into `_inbox`, noting when each one arrived."""
+        while True:
+            try:
+                message = self.ws.receive()
+            except geventwebsocket.WebSocketError:
+                self._inbox.put(StopIteration)
+                return
+            if message is not None:
+                self.last_recv = time.time()
+                self._inbox.put(message)
+            elif self.ws.closed:
+                # closed by peer or on error, handle() takes it from here.
+                self._inbox.put(StopIteration)
+                return
 
     def on_open(self):
         """Handle new websocket connection."""
@@ -151,12 +447,21 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
         self.remote_ids = collections.defaultdict(set)
 
         # `_tx_buffer` collects outgoing messages which must be sent in order
-        self._tx_buffer = {}
-        # track the head of the queue (buffer) and the next msg to be sent
-        self._tx_buffer_id_gen = itertools.cycle(irange(sys.maxint))
-        self._tx_next_id_gen = itertools.cycle(irange(sys.maxint))
-        # start by waiting for the very first message
-        self._tx_next_id = next(self._tx_next_id_gen)
+        self._tx_buffer = ReorderBuffer(
+            max_size=TX_BUFFER_MAX,
+            gap_timeout=TX_GAP_TIMEOUT,
+            on_skip=self.on_tx_skip,
+        )
+        # `changed` msgs held back by coalescing, keyed on (collection, id)
+        self._coalesce_pending = {}
+        # outbound msgs, drained by a writer greenlet so a slow client can't
+        # hold up sending to other connections.
+        self._outbox = collections.deque()
+        # per connection rate limits for sub/method
+        self._rate_buckets = buckets(RATE_LIMITS)
+        # detect dead peers (eg: half-open TCP connections)
+        self.last_recv = time.time()
+        self.start_greenlets()
 
         this.remote_addr = self.remote_addr = \
             '{0[REMOTE_ADDR]}:{0[REMOTE_PORT]}'.format(
@@ -167,19 +472,74 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
         self.send('o')
         self.send('a["{\\"server_id\\":\\"0\\"}"]')
 
+    def start_greenlets(self):
+        """Spawn writer and heartbeat greenlets, create the method pool."""
+        self._outbox_event = gevent.event.Event()
+        self._writer_greenlet = self.spawn(self._writer)
+        # methods run in their own greenlets so they can `this.unblock()`
+        self._method_pool = gevent.pool.Pool(METHOD_CONCURRENCY)
+        if HEARTBEAT_INTERVAL:
+            self._heartbeat_greenlet = self.spawn(self._heartbeat)
+
+    def spawn(self, func, *args):
+        """Run `func(*args)` in the background."""
+        return gevent.spawn(func, *args)
+
+    def spawn_later(self, seconds, func, *args):
+        """Run `func(*args)` in the background after `seconds`."""
+        return gevent.spawn_later(seconds, func, *args)
+
     def __str__(self):
         """Show remote address that connected to us."""
         return self.remote_addr
 
     def on_close(self, *args, **kwargs):
         """Handle closing of websocket connection."""
+        handler = self._handler_greenlet
+        if handler is not None and gevent.getcurrent() is not handler:
+            # geventwebsocket calls on_close() from within ws.receive() on
+            # socket errors, ie: in the reader while a message may still be
+            # mid-dispatch.  The reader stops and handle() closes up once
+            # processing has finished.
+            return
+        if self._writer_greenlet is not None:
+            self._outbox.clear()
+            self._writer_greenlet.kill(block=False)
+            self._writer_greenlet = None
+        if self._tx_gap_timer is not None:
+            self._tx_gap_timer.kill(block=False)
+            self._tx_gap_timer = None
+        if self._heartbeat_greenlet is not None:
+            self._heartbeat_greenlet.kill(block=False)
+            self._heartbeat_greenlet = None
+        if self._method_pool is not None:
+            self._method_pool.kill(block=False)
         if self.connection is not None:
-            del self.pgworker.connections[self.connection.pk]
-            self.connection.delete()
+            connection_id = self.connection.pk
+            # stop change notifications even if the DB can't be reached.
+            self.pgworker.connections.pop(connection_id, None)
             self.connection = None
-        signals.request_finished.send(sender=self.__class__)
+            self.delete_connection(connection_id)
         safe_call(self.logger.info, '- %s %s', self, args or 'CLOSE')
 
+    def delete_connection(self, connection_id):
+        """Delete Connection row, bypassing the pool if it is saturated."""
+        from dddp.reaper import delete_connections
+        try:
+            try:
+                with self.db_connection():
+                    delete_connections([connection_id])
+            except PoolTimeout:
+                # teardown can't wait its turn, use a connection of our own.
+                with self.db_pool.direct():
+                    delete_connections([connection_id])
+        except DatabaseError:
+            # reaper cleans up after this server once its heartbeat stops.
+            safe_call(
+                self.logger.exception,
+                '%s failed deleting connection %s', self, connection_id,
+            )
+
     def on_message(self, message):
         """Process a message received from remote."""
         if self.ws.closed:
@@ -189,10 +549,116 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
 
             # process individual messages
             for data in self.ddp_frames_from_message(message):
-                self.process_ddp(data)
+                if (
+                    data.get('msg', None) == 'method'
+                ) and (
+                    self.connection is not None
+                ):
+                    self.process_method(data)
+                else:
+                    self.process_pooled(data)
+                # yield to other greenlets before processing next msg
+                gevent.sleep()
+        except geventwebsocket.WebSocketError:
+            self.ws.close()
+
+    def process_method(self, data):
+        """Run method in a greenlet, wait until it finishes or unblocks."""
+        unblocked = gevent.event.Event()
+        state = []  # greenlet local state as at completion or unblock()
+        shared = {
+            key: val
+            for key, val
+            in this.__dict__.items()
+            if key not in METHOD_LOCAL_STATE
+        }
+        # blocks reading further messages while at the concurrency limit.
+        greenlet = self._method_pool.spawn(
+            self._method_greenlet, data, shared, unblocked, state,
+        )
+        gevent.wait([greenlet, unblocked], count=1)
+        # later messages see state changes (eg: login) made up until now.
+        this.__dict__.update(
+            (key, val)
+            for key, val
+            in (state[0] if state else {}).items()
+            if key not in METHOD_LOCAL_STATE
+        )
+
+    def _method_greenlet(self, data, shared, unblocked, state):
+        """Process method message in a greenlet of its own."""
+        this.__dict__.update(shared)
+
+        def unblock():
+            """Let the connection process further messages."""
+            if not unblocked.is_set():
+                state.append(dict(this.__dict__))
+                unblocked.set()
+        this.unblock = unblock
+        try:
+            self.process_pooled(data)
+        finally:
+            unblock()
+            if self.db_pool is None:
+                # connections are greenlet local, don't leave broken or
+                # expired ones lying about (honouring CONN_MAX_AGE).
+                close_old_connections()
+
+    @contextlib.contextmanager
+    def db_connection(self, policy=None):
+        """Provide a database connection (if needed) for the block."""
+        if self.db_pool is not None and policy != TX_NONE:
+            with self.db_pool.connection():
+                yield
+            return
+        # TX_NONE handlers (eg: ping) rarely touch the DB, so don't wait for
+        # a pool slot - any connection they do open is closed afterwards.
+        try:
+            yield
+        finally:
+            if connection.connection is not None:
                 # emit request_finished signal to close DB connections
                 signals.request_finished.send(sender=self.__class__)
-        except geventwebsocket.WebSocketError:
+
+    def _heartbeat(self):
+        """Send heartbeats while idle, tear down the connection if no reply."""
+        while not self.ws.closed:
+            gevent.sleep(HEARTBEAT_INTERVAL)
+            if not self.heartbeat():
+                return
+
+    def heartbeat(self):
+        """Ping client if idle, return False if the connection was aborted."""
+        if self._inbox is not None and self._inbox.qsize():
+            # reader may be waiting for room in the inbox, so can't hear the
+            # client - but messages waiting to be processed show it's alive.
+            self.last_recv = time.time()
+        idle = time.time() - self.last_recv
+        # only DDP clients answer pings, a SockJS heartbeat gets no reply.
+        can_ping = self.connection is not None and self.version != 'pre1'
+        if can_ping and IDLE_TIMEOUT and idle >= IDLE_TIMEOUT:
+            safe_call(
+                self.logger.info, '%s idle for %.1fs, closing.', self, idle,
+            )
+            self.abort()
+            return False
+        if idle < HEARTBEAT_INTERVAL:
+            return True  # heard from client recently, no need to ask.
+        if can_ping:
+            # DDP ping, client replies with `pong` (handled in on_message).
+            self.send({'msg': 'ping'})
+        else:
+            # SockJS heartbeat frame, keeps intermediate proxies happy.
+            self.send('h')
+        return True
+
+    def abort(self):
+        """Close connection to unresponsive client via normal on_close path."""
+        try:
+            # unblocks the greenlet reading from the socket, which then calls
+            # on_close() - sending a close frame to a dead peer won't work.
+            self.ws.handler.socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
             self.ws.close()
 
     def ddp_frames_from_message(self, message):
@@ -204,12 +670,12 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
             self.reply(
                 'error', error=400, reason='Data is not valid EJSON',
             )
-            raise StopIteration
+            return
         if not isinstance(msgs, list):
             self.reply(
                 'error', error=400, reason='Invalid EJSON messages',
             )
-            raise StopIteration
+            return
         # process individual messages
         while msgs:
             # pop raw message from the list
@@ -225,10 +691,37 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
                     reason='Invalid SockJS DDP payload',
                     offendingMessage=raw,
                 )
+                continue
             yield data
-            if msgs:
-                # yield to other greenlets before processing next msg
-                gevent.sleep()
+
+    @contextlib.contextmanager
+    def admission(self, msg):
+        """Apply rate limits and admission control for the block."""
+        rate_limit(msg, self._rate_buckets)
+        if msg == 'sub':
+            with SUB_LOADS.admit():
+                yield
+        else:
+            yield
+
+    def process_pooled(self, data):
+        """Process a single DDP message holding a database connection."""
+        msg = data.get('msg', None)
+        try:
+            # admit before taking a pool slot (and opening a transaction), so
+            # waiting or rejected messages don't hold connections others need.
+            with self.admission(msg), self.db_connection(
+                    self.tx_policy(msg, data),
+            ):
+                self.process_ddp(data)
+        except MeteorError as err:
+            self.reply_error(msg, data.get('id', None), data, err)
+        except PoolTimeout:
+            # pool saturated, tell the client rather than dropping it.
+            self.reply_error(
+                msg, data.get('id', None), data,
+                MeteorError(503, 'Server busy, try again later.'),
+            )
 
     def process_ddp(self, data):
         """Process a single DDP message."""
@@ -246,50 +739,70 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
             self.dispatch(msg, data)
         except Exception as err:  # pylint: disable=broad-except
             # This should be the only protocol exception handler
-            kwargs = {
-                'msg': {'method': 'result'}.get(msg, 'error'),
+            self.reply_error(msg, msg_id, data, err)
+
+    def reply_error(self, msg, msg_id, data, err):
+        """Reply to DDP message `msg` with error `err`."""
+        kwargs = {
+            'msg': {'method': 'result'}.get(msg, 'error'),
+        }
+        if msg_id is not None:
+            kwargs['id'] = msg_id
+        if isinstance(err, MeteorError):
+            error = err.as_dict()
+        else:
+            error = {
+                'error': 500,
+                'reason': 'Internal server error',
             }
-            if msg_id is not None:
-                kwargs['id'] = msg_id
-            if isinstance(err, MeteorError):
-                error = err.as_dict()
-            else:
-                error = {
-                    'error': 500,
-                    'reason': 'Internal server error',
-                }
-            if kwargs['msg'] == 'error':
-                kwargs.update(error)
-            else:
-                kwargs['error'] = error
-            if not isinstance(err, MeteorError):
-                # not a client error, should always be logged.
-                stack, _ = safe_call(
-                    self.logger.error, '%r %r', msg, data, exc_info=1,
+        if kwargs['msg'] == 'error':
+            kwargs.update(error)
+        else:
+            kwargs['error'] = error
+        if not isinstance(err, MeteorError):
+            # not a client error, should always be logged.
+            stack, _ = safe_call(
+                self.logger.error, '%r %r', msg, data, exc_info=1,
+            )
+            if stack is not None:
+                # something went wrong while logging the error, revert to
+                # writing a stack trace to stderr.
+                traceback.print_exc(file=sys.stderr)
+                sys.stderr.write(
+                    'Additionally, while handling the above error the '
+                    'following error was encountered:\n'
                 )
-                if stack is not None:
-                    # something went wrong while logging the error, revert to
-                    # writing a stack trace to stderr.
-                    traceback.print_exc(file=sys.stderr)
-                    sys.stderr.write(
-                        'Additionally, while handling the above error the '
-                        'following error was encountered:\n'
-                    )
-                    sys.stderr.write(stack)
-            elif settings.DEBUG:
-                print('ERROR: %s' % err)
-                dprint('msg', msg)
-                dprint('data', data)
-                error.setdefault('details', traceback.format_exc())
-                # print stack trace for client errors when DEBUG is True.
-                print(error['details'])
-            self.reply(**kwargs)
-            if msg_id and msg == 'method':
-                self.reply('updated', methods=[msg_id])
-
-    @transaction.atomic
+                sys.stderr.write(stack)
+        elif settings.DEBUG:
+            print('ERROR: %s' % err)
+            dprint('msg', msg)
+            dprint('data', data)
+            error.setdefault('details', traceback.format_exc())
+            # print stack trace for client errors when DEBUG is True.
+            print(error['details'])
+        self.reply(**kwargs)
+        if msg_id and msg == 'method':
+            self.reply('updated', methods=[msg_id])
+
+    def tx_policy(self, msg, kwargs):
+        """Return transaction policy for dispatching msg."""
+        if msg == 'method':
+            try:
+                handler = self.api.api_path_map()[kwargs['method']]
+            except (KeyError, TypeError):
+                handler = None  # dispatch will report the error.
+            policy = getattr(handler, 'tx_policy', None)
+            if policy is not None:
+                return policy
+        return TRANSACTION_POLICIES.get(msg, TX_ATOMIC)
+
     def dispatch(self, msg, kwargs):
         """Dispatch msg to appropriate recv_foo handler."""
+        with transaction_policy(self.tx_policy(msg, kwargs)):
+            self._dispatch(msg, kwargs)
+
+    def _dispatch(self, msg, kwargs):
+        """Validate and call recv_foo handler for msg."""
         # enforce calling 'connect' first
         if self.connection is None and msg != 'connect':
             self.reply('error', reason='Must connect first')
@@ -304,7 +817,6 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
                     'error', error=400, reason='Malformed method invocation',
                 )
                 return
-
         # lookup method handler
         try:
             handler = getattr(self, 'recv_%s' % msg)
@@ -312,7 +824,7 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
             raise MeteorError(404, 'Method not found')
 
         # validate handler arguments
-        validate_kwargs(handler, kwargs)
+        self.recv_argspec(msg, handler).validate_kwargs(kwargs)
 
         # dispatch to handler
         handler(**kwargs)
@@ -322,22 +834,28 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
         # buffer data until we get pre-requisite data
         if tx_id is None:
             tx_id = self.get_tx_id()
-        self._tx_buffer[tx_id] = data
-
-        # de-queue messages from buffer
-        while self._tx_next_id in self._tx_buffer:
-            # pull next message from buffer
-            data = self._tx_buffer.pop(self._tx_next_id)
-            if self._tx_buffer:
-                safe_call(self.logger.debug, 'TX found %d', self._tx_next_id)
-            # advance next message ID
-            self._tx_next_id = next(self._tx_next_id_gen)
-            if not isinstance(data, basestring):
+        self._send_ready(self._tx_buffer.push(tx_id, data))
+
+    def _send_ready(self, ready):
+        """Queue messages released from `_tx_buffer` for sending."""
+        for data in ready:
+            if not isinstance(data, six.string_types):
                 # ejson payload
                 msg = data.get('msg', None)
                 if msg in (ADDED, CHANGED, REMOVED):
+                    # payload may be shared with other connections and won't
+                    # be encoded until later, so take a copy to modify.
+                    data = dict(data)
                     ids = self.remote_ids[data['collection']]
                     meteor_id = data['id']
+                    key = (data['collection'], meteor_id)
+                    pending = self._coalesce_pending.get(key, None)
+                    if pending is not None:
+                        # this msg supersedes any held back changes.
+                        self._coalesce_pending[key] = None
+                        if msg == CHANGED:
+                            # ...which may be to other fields, keep those.
+                            data = merge_changed(pending, data)
                     if msg == ADDED:
                         if meteor_id in ids:
                             msg = data['msg'] = CHANGED
@@ -353,22 +871,190 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
                             ids.remove(meteor_id)
                         except KeyError:
                             continue  # client doesn't have this, don't send.
-                data = 'a%s' % ejson.dumps([ejson.dumps(data)])
-            # send message
-            safe_call(self.logger.debug, '> %s %r', self, data)
+            self.enqueue(data)
+        if (
+            self._tx_buffer.gap_since is not None
+        ) and (
+            self._tx_gap_timer is None
+        ):
+            # make sure the gap gets skipped even if nothing else is sent.
+            self._tx_gap_timer = self.spawn_later(
+                TX_GAP_TIMEOUT, self._tx_gap_expired,
+            )
+
+    def _tx_gap_expired(self):
+        """Skip `_tx_buffer` gap which has been open too long."""
+        self._tx_gap_timer = None
+        if not self.ws.closed:
+            self._send_ready(self._tx_buffer.expire())
+
+    def on_tx_skip(self, reason):
+        """Recover from skipped (or late) tx-ordered messages."""
+        TX_BUFFER_STATS[reason] += 1
+        safe_call(
+            self.logger.warning,
+            '%s TX %s, %d waiting, recovery: %s (%r).',
+            self, reason, len(self._tx_buffer), TX_GAP_RECOVERY,
+            dict(self._tx_buffer.stats),
+        )
+        if TX_GAP_RECOVERY == 'resync':
+            # we don't know what was missed, resend everything subscribed.
+            self.request_resync()
+
+    def request_resync(self):
+        """Schedule a resync, coalescing with any pending or running one."""
+        if self._resync_state is None:
+            self._resync_state = 'pending'
+            self.spawn(self.resync)
+        elif self._resync_state == 'running':
+            # running resync may have read state from before the skip.
+            self._resync_state = 'pending'
+
+    def _resync_next(self):
+        """Return True if another resync pass is due, marking it running."""
+        if self._resync_state == 'pending':
+            self._resync_state = 'running'
+            return True
+        self._resync_state = None
+        return False
+
+    def resync(self):
+        """Resend current state of all subscriptions for this connection."""
+        try:
+            while self._resync_next():
+                if self.connection is None or self.ws.closed:
+                    continue
+                this.ws = self
+                this.send = self.send
+                with self.db_connection():
+                    self.api.resync(self)
+        finally:
+            self._resync_state = None
+            if self.db_pool is None:
+                # connections are greenlet local, don't leave one lying about.
+                connection.close()
+
+    @property
+    def queue_depth(self):
+        """Number of messages waiting to be sent to WebSocket client."""
+        return len(self._outbox)
+
+    def enqueue(self, data):
+        """Queue data for writer greenlet, enforcing slow consumer policy."""
+        self._outbox.append(data)
+        depth = len(self._outbox)
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        if SEND_QUEUE_HIGH_WATER and depth > SEND_QUEUE_HIGH_WATER:
+            self.slow_consumer()
+        self._outbox_event.set()
+
+    def slow_consumer(self):
+        """Apply DDP_SLOW_CONSUMER_POLICY to a connection over high water."""
+        SEND_QUEUE_STATS['slow_consumers'] += 1
+        depth = len(self._outbox)
+        if SLOW_CONSUMER_POLICY == 'resync':
+            # drop superseded msgs, resyncing each object to its latest state.
+            self._outbox = collections.deque(conflate(self._outbox))
+            SEND_QUEUE_STATS['conflated'] += depth - len(self._outbox)
+            if len(self._outbox) <= SEND_QUEUE_HIGH_WATER // 2:
+                return
+        safe_call(
+            self.logger.warning,
+            '%s slow consumer with %d messages queued, disconnecting.',
+            self, len(self._outbox),
+        )
+        SEND_QUEUE_STATS['disconnected'] += 1
+        self._outbox.clear()
+        if self._writer_greenlet is not None:
+            self._writer_greenlet.kill(block=False)
+            self._writer_greenlet = None
+        # closing sends a frame which may block on a slow socket.
+        self.spawn(self.ws.close)
+
+    def _writer(self):
+        """Send queued messages, batching EJSON payloads into SockJS frames."""
+        while True:
+            while not self._outbox:
+                self._outbox_event.clear()
+                self._outbox_event.wait()
+            if self.ws.closed:
+                return
+            data = self.next_frame()
             try:
                 self.ws.send(data)
             except geventwebsocket.WebSocketError:
                 self.ws.close()
                 self._tx_buffer.clear()
-                break
-        num_waiting = len(self._tx_buffer)
-        if num_waiting > 10:
-            safe_call(
-                self.logger.warn,
-                'TX received %d, waiting for %d, have %d waiting: %r.',
-                tx_id, self._tx_next_id, num_waiting, self._tx_buffer,
-            )
+                self._outbox.clear()
+                return
+
+    def next_frame(self):
+        """Pop next frame to send, batching EJSON payloads from the outbox."""
+        data = self._outbox.popleft()
+        if not isinstance(data, six.string_types):
+            msgs = [ejson.dumps(data)]
+            size = len(msgs[0])
+            while (
+                self._outbox
+            ) and (
+                not isinstance(self._outbox[0], six.string_types)
+            ) and (
+                len(msgs) < SEND_BATCH_MAX_MSGS
+            ) and (
+                size < SEND_BATCH_MAX_BYTES
+            ):
+                msgs.append(ejson.dumps(self._outbox.popleft()))
+                size += len(msgs[-1])
+            data = 'a%s' % ejson.dumps(msgs)
+            SEND_QUEUE_STATS['msgs'] += len(msgs)
+        SEND_QUEUE_STATS['frames'] += 1
+        safe_call(self.logger.debug, '> %s %r', self, data)
+        return data
+
+    def coalesce(self, data):
+        """
+        Send data, coalescing repeated `changed` messages for an object.
+
+        The first `changed` message for an object is sent immediately and
+        opens a window of `Collection.coalesce_window` seconds.  Further
+        `changed` messages for the same object within the window are merged
+        and sent as one message when the window closes.  Any other message
+        for the object (eg: `removed`) supersedes the held back changes.
+        """
+        msg = data.get('msg', None)
+        if msg not in (ADDED, CHANGED, REMOVED):
+            self.send(data)
+            return
+        key = (data['collection'], data['id'])
+        if msg == CHANGED:
+            if key in self._coalesce_pending:
+                pending = self._coalesce_pending[key]
+                self._coalesce_pending[key] = data if pending is None \
+                    else merge_changed(pending, data)
+                return
+            window = self.coalesce_window(data['collection'])
+            if window:
+                self._coalesce_pending[key] = None  # nothing held back yet
+                self.spawn_later(window, self._coalesce_flush, key, window)
+        self.send(data)
+
+    def coalesce_window(self, collection):
+        """Return coalescing window (seconds) for named collection."""
+        try:
+            return self.api.get_col_by_name(collection).coalesce_window
+        except KeyError:
+            return None  # not a registered collection (eg: dddp.logs)
+
+    def _coalesce_flush(self, key, window):
+        """Send held back changes for key at end of coalescing window."""
+        data = self._coalesce_pending.pop(key, None)
+        if data is None or self.ws.closed:
+            return  # no changes during window, next change is sent promptly.
+        # keep coalescing for another window after sending.
+        self._coalesce_pending[key] = None
+        self.spawn_later(window, self._coalesce_flush, key, window)
+        self.send(data)
 
     def reply(self, msg, **kwargs):
         """Send EJSON reply to remote."""
@@ -389,21 +1075,14 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
             raise MeteorError(400, 'Client version/support mismatch.')
         else:
             from dddp.models import Connection
-            cur = connection.cursor()
-            cur.execute('SELECT pg_backend_pid()')
-            (backend_pid,) = cur.fetchone()
-            this.version = version
+            this.version = self.version = version
             this.support = support
             self.connection = Connection.objects.create(
-                server_addr='%d:%s' % (
-                    backend_pid,
-                    self.ws.handler.socket.getsockname(),
-                ),
+                server_addr=self.server_addr,
                 remote_addr=self.remote_addr,
                 version=version,
             )
             self.pgworker.connections[self.connection.pk] = self
-            atexit.register(self.on_close, 'Shutting down.')
             self.reply('connected', session=self.connection.connection_id)
     recv_connect.err = 'Malformed connect'
 
@@ -415,6 +1094,11 @@ class DDPWebSocketApplication(geventwebsocket.WebSocketApplication):
             self.reply('pong', id=id_)
     recv_ping.err = 'Malformed ping'
 
+    def recv_pong(self, id_=None):
+        """DDP pong handler."""
+        del id_  # reply to our heartbeat, receiving it is all that matters.
+    recv_pong.err = 'Malformed pong'
+
     def recv_sub(self, id_, name, params):
         """DDP sub handler."""
         self.api.sub(id_, name, *params)
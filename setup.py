@@ -6,6 +6,7 @@ import os.path
 import posixpath  # all path specs in this file are UNIX-style paths
 import shutil
 import subprocess
+import sys
 from distutils import log
 from distutils.version import StrictVersion
 import setuptools.command.build_py
@@ -127,6 +128,27 @@ class build_meteor(setuptools.command.build_py.build_py):
         )
 
 
+class build_py(setuptools.command.build_py.build_py):
+
+    """Build pure Python modules, skipping any this Python can't compile."""
+
+    # modules using syntax introduced in later Python releases.
+    min_python = {
+        ('dddp', 'asgi'): (3, 5),
+    }
+
+    def find_package_modules(self, package, package_dir):
+        """Return (package, module, path) for modules that can be built."""
+        return [
+            (pkg, mod, path)
+            for (pkg, mod, path)
+            in setuptools.command.build_py.build_py.find_package_modules(
+                self, package, package_dir,
+            )
+            if sys.version_info >= self.min_python.get((pkg, mod), (0,))
+        ]
+
+
 class build_ext(setuptools.command.build_ext.build_ext):
 
     def run(self):
@@ -251,6 +273,7 @@ setuptools.setup(
         'websocket_client',
     ],
     cmdclass={
+        'build_py': build_py,
         'build_ext': build_ext,
         'build_meteor': build_meteor,
     },
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Benchmark DDP server engines: connection density and fan-out latency.
+
+Start the server under test from this directory, eg: the gevent launcher::
+
+    $ DJANGO_SETTINGS_MODULE=test_project.settings dddp 127.0.0.1:8000
+
+or the asyncio engine under an ASGI server::
+
+    $ uvicorn test_project.asgi:application --port 8001
+
+Then run the benchmark against each, giving the server PID so its memory use
+can be measured::
+
+    $ ./bench.py --url ws://127.0.0.1:8000 --pid 1234 --clients 1000
+
+Clients subscribe to `Tasks`, then each round inserts a Task and measures
+the time until every client has received the `added` message.
+"""
+from __future__ import absolute_import, division, print_function
+
+from gevent.monkey import patch_all
+patch_all()
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+import ejson
+import gevent
+import gevent.event
+import websocket
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'test_project.settings'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_kb(pid):
+    """Return resident set size (KiB) of process pid (Linux only)."""
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    raise ValueError('No VmRSS for PID %d' % pid)
+
+
+class BenchClient(object):
+
+    """DDP client subscribed to Tasks, recording arrival of `added` msgs."""
+
+    def __init__(self, url, sent, latencies):
+        """Prepare client."""
+        self.url = url
+        self.sent = sent
+        self.latencies = latencies
+        self.ready = gevent.event.Event()
+        self.websocket = None
+
+    def send(self, **msg):
+        """Send a SockJS wrapped msg."""
+        self.websocket.send(ejson.dumps([ejson.dumps(msg)]))
+
+    def recv(self):
+        """Return list of msgs from next SockJS frame."""
+        raw = self.websocket.recv()
+        if not raw.startswith('a'):
+            return []  # open/heartbeat frame
+        return [ejson.loads(msg) for msg in ejson.loads(raw[1:])]
+
+    def run(self):
+        """Connect, subscribe and record latencies until closed."""
+        self.websocket = websocket.create_connection(
+            '%s/sockjs/1/bench/websocket' % self.url,
+        )
+        self.send(msg='connect', version='1', support=['1'])
+        self.send(msg='sub', id='tasks', name='Tasks', params=[])
+        try:
+            while True:
+                for msg in self.recv():
+                    if msg.get('msg') == 'ready':
+                        self.ready.set()
+                    elif msg.get('msg') == 'ping':
+                        self.send(msg='pong')
+                    elif msg.get('msg') == 'added':
+                        sent = self.sent.get(msg['fields'].get('text'))
+                        if sent is not None:
+                            self.latencies[msg['fields']['text']].append(
+                                time.time() - sent,
+                            )
+        except websocket.WebSocketException:
+            pass
+
+
+def percentile(values, pct):
+    """Return pct percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='ws://127.0.0.1:8000')
+    parser.add_argument('--pid', type=int, help='PID of server under test.')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    from django_todos.models import Task
+
+    sent = {}
+    latencies = collections.defaultdict(list)
+    clients = [
+        BenchClient(args.url, sent, latencies) for _ in range(args.clients)
+    ]
+    rss_before = rss_kb(args.pid) if args.pid else None
+    start = time.time()
+    greenlets = [gevent.spawn(client.run) for client in clients]
+    for client in clients:
+        client.ready.wait(args.timeout)
+    print('%d clients subscribed in %.2fs' % (
+        sum(client.ready.is_set() for client in clients), time.time() - start,
+    ))
+    if rss_before is not None:
+        rss_after = rss_kb(args.pid)
+        print('server RSS %d KiB -> %d KiB, %.1f KiB per connection' % (
+            rss_before, rss_after, (rss_after - rss_before) / args.clients,
+        ))
+
+    for round_num in range(args.rounds):
+        text = 'bench %d %f' % (round_num, time.time())
+        sent[text] = time.time()
+        Task.objects.create(text=text)
+        deadline = time.time() + args.timeout
+        while len(latencies[text]) < args.clients and time.time() < deadline:
+            gevent.sleep(0.01)
+        values = sorted(latencies[text])
+        if not values:
+            print('round %d: no deliveries' % round_num)
+            continue
+        print(
+            'round %d: %d/%d delivered, p50 %.1fms p99 %.1fms max %.1fms' % (
+                round_num, len(values), args.clients,
+                percentile(values, 50) * 1000,
+                percentile(values, 99) * 1000,
+                values[-1] * 1000,
+            ),
+        )
+        Task.objects.filter(text=text).delete()
+
+    gevent.killall(greenlets, block=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import dddp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_todos', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Note',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('text', models.TextField()),
+                ('aid', dddp.models.AleaIdField(max_length=17, unique=True, null=True, verbose_name='Alea ID')),
+            ],
+            bases=(models.Model,),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 
+from dddp.models import AleaIdField
+
 
 @python_2_unicode_compatible
 class Task(models.Model):
@@ -12,3 +14,12 @@ class Task(models.Model):
 
     def __str__(self):
         return self.text
+
+
+@python_2_unicode_compatible
+class Note(models.Model):
+    text = models.TextField()
+    aid = AleaIdField(unique=True, null=True)
+
+    def __str__(self):
+        return self.text
@@ -0,0 +1,14 @@
+"""
+ASGI config for test_project project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+"""
+
+import os
+os.environ["DJANGO_SETTINGS_MODULE"] = "test_project.settings"
+
+import django
+django.setup()
+
+from dddp.asgi import DDPApplication
+application = DDPApplication()